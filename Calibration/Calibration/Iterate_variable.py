@@ -2,15 +2,28 @@
 Code to run JULES using a series of values for a given variable
 """
 import os
-import datetime
+import time
+import shutil
+import hashlib
+from queue import Queue, Empty
+from contextlib import nullcontext
 from logging import exception
 
 import Calibration.Namelist_management.Duplicate as Duplicate
 import Calibration.Run_JULES.Run_JULES as Run_JULES
 import Calibration.Namelist_management.Edit_variable as Edit_variable
 import Calibration.Namelist_management.Read as Read
-from Calibration.general.file_management import make_folder
-from Calibration.Calibration.setup_calibration_files import setup_calibration_run_folders
+from Calibration.general.file_management import make_folder, delete_folder
+from Calibration.general.parallel import run_in_parallel, prefetch
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.ensemble_archive import EnsembleArchive
+from Calibration.general.dump_archive import DumpArchive
+from Calibration.Calibration.input_staging import stage_inputs
+from Calibration.general.pipeline import PostProcessingPipeline
+from Calibration.general.tracing import span, traced
+from Calibration.general.telemetry import CampaignMonitor
+from Calibration.Calibration.setup_calibration_files import setup_calibration_run_folders, setup_worker_folders, \
+    setup_output_files, RUN_INFO_DATABASE, RUN_INFO_CSV
 
 def iterate_variables(jules_executable_address,
                       master_namelist_address,
@@ -23,7 +36,20 @@ def iterate_variables(jules_executable_address,
                       keep_dump_files = False,
                       tmp_folder = None,
                       overwrite_tmp_files = False,
-                      append_to_run_info = False):
+                      append_to_run_info = False,
+                      n_workers = 1,
+                      ensemble_archive_address = None,
+                      dump_archive_address = None,
+                      resume = False,
+                      output_cache = None,
+                      score_function = None,
+                      post_processing_threads = 1,
+                      prefetch_runs = True,
+                      sandbox_pool = None,
+                      staging_folder = None,
+                      monitor = None,
+                      run_supervisor = None,
+                      autotuner = None):
 
     """
     Iterate over a series of values for a given variable
@@ -37,99 +63,68 @@ def iterate_variables(jules_executable_address,
         or list of namelist files (list of str)
     :param variable_values: Values of the variable to iterate over as a 1D list of strings (list of strings)
         or lait of lists containing each set of variable values to try (list of lists of str)
+        or any iterable or generator of either, which is consumed one set of values at a time (iterable)
     :param output_folder: Location of output folder (str)
     :param run_id_prefix: Prefix for all run ids (str)
     :param keep_dump_files: If True, keeps the JULES dump files (bool) (optional)
     :param tmp_folder: Location of the temporary folder (str) (optional)
     :param overwrite_tmp_files: If True, overwrites any existing tmp files (bool) (optional)
-    :param append_to_run_info: If True, appends to any existing run_info.csv file (bool) (optional)
-    :return:
+    :param append_to_run_info: If True, appends to any existing run records (bool) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param ensemble_archive_address: If given, the outputs are collected into this single NetCDF4 ensemble file
+                                     instead of one file per run (str) (optional)
+    :param dump_archive_address: If given with keep_dump_files, the dump files are kept in this compressed,
+                                 deduplicated archive folder instead of a folder per run (str) (optional)
+    :param resume: If True, continues an interrupted sweep in the same output folder,
+                   skipping values that already have a complete output (bool) (optional)
+    :param output_cache: Cache shared between campaigns, used to reuse the output of any identical earlier run
+                         instead of running JULES again (OutputCache) (optional)
+    :param score_function: Function giving the score of an output file, recorded with each run (callable) (optional)
+    :param post_processing_threads: Number of background threads moving, archiving and scoring finished runs
+                                    while the next runs go, or 0 to do this between runs (int) (optional)
+    :param prefetch_runs: If True, gives each worker two temporary folders and prepares the next run in one
+                          while JULES runs in the other (bool) (optional)
+    :param sandbox_pool: Pool to take ready-made temporary folders from instead of setting up tmp_folder
+                         (SandboxPool) (optional)
+    :param staging_folder: If given, the driving and ancillary files are staged to this node-local folder once
+                           and the runs read them from there, see stage_inputs (str) (optional)
+    :param monitor: Monitor to report the progress of the sweep to, by default progress is printed and written
+                    to <output_folder><run_id_prefix>_telemetry.jsonl (CampaignMonitor) (optional)
+    :param run_supervisor: Supervisor running JULES, retrying failed runs and duplicating late runs in free
+                           temporary folders (RunSupervisor) (optional)
+    :param autotuner: Autotuner choosing how many of the n_workers runs go at once from the CPU, memory and
+                      disk use of the runs (ConcurrencyAutotuner) (optional)
+    :return: Output file address for each set of variable values (list of str)
     """
 
-    # Manage the case where the user only wants to iterate over one variable
-    if type(variable_names) is str:
-        variable_names = [variable_names]
-        variable_namelists = [variable_namelists]
-        variable_namelist_files = [variable_namelist_files]
-        variable_values = [variable_values]
-
-    tmp_folder, output_folder = setup_calibration_run_folders(master_namelist_address,
-                                                              output_folder,
-                                                              variable_names,
-                                                              tmp_folder = tmp_folder,
-                                                              overwrite_existing_folders = overwrite_tmp_files,
-                                                              use_existing_run_info = append_to_run_info,
-                                                              setup_dump_files = keep_dump_files)
-
-    variable_namelist_files_full = [tmp_folder + "namelist/" + file for file in variable_namelist_files]
-
-    # Get the output profile name
-    profile_name = Read.read_variable(tmp_folder + "namelist/output.nml",
-                                      "jules_output_profile",
-                                      "profile_name")
-
-    # Remove any quotes from the profile name
-    profile_name = profile_name.strip("'")
-    profile_name = profile_name.strip('"')
-
-    # Iterate over the values
-    for i, values in enumerate(variable_values):
-
-        # Set the current run id
-        current_run_id = run_id_prefix + f"_{datetime.datetime.now():%Y_%m_%d_%H_%M}"
-
-        # Write the run info to the run_info.csv file
-        with open(output_folder + "run_info.csv", "a") as run_info:
-            run_info.write(current_run_id + "." + profile_name + ".nc,"
-                           + f"{datetime.datetime.now():%Y-%m-%d %H:%M},"
-                           + ",".join(values) + "\n")
-
-        # Edit the variable
-        Edit_variable.edit_variable(variable_namelist_files_full,
-                                    variable_namelists,
-                                    variable_names,
-                                    values)
-
-
-
-        Edit_variable.edit_variable(tmp_folder + "namelist/output.nml",
-                                    "jules_output",
-                                    "run_id",
-                                    "'" + current_run_id + "'")
-
-        # Run JULES
-        Run_JULES.run_JULES(jules_executable_address, tmp_folder + "namelist/")
-
-        # Move the output from the temporary folder to the output folder
-        os.rename(tmp_folder + "output/" + current_run_id + "." + profile_name + ".nc",
-                  output_folder + current_run_id + "." + profile_name + ".nc")
-
-        # If user wants to keep dump files, move them to the output folder
-        if keep_dump_files:
-
-            # Make a folder for the dump files
-            current_dump_folder = output_folder + "/" + current_run_id + "_dump/"
-            os.mkdir(current_dump_folder)
-
-            output_files = os.listdir(tmp_folder + "output/")
-            for file in output_files:
-                if 'dump' in file:
-                    os.rename(tmp_folder + "output/" + file, current_dump_folder + file)
-
-        # Delete the temporary output folder contents
-        output_files = os.listdir(tmp_folder + "output/")
-        for file in output_files:
-            os.remove(tmp_folder + "output/" + file)
-
-    # Remove tmp folder and contents
-    for root, dirs, files in os.walk(tmp_folder, topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
-    os.rmdir(tmp_folder)
-
-    return
+    return iterate_soil_variable(jules_executable_address,
+                                 master_namelist_address,
+                                 None,
+                                 variable_names,
+                                 variable_namelists,
+                                 variable_namelist_files,
+                                 variable_values,
+                                 None,
+                                 None,
+                                 output_folder,
+                                 run_id_prefix,
+                                 keep_dump_files = keep_dump_files,
+                                 tmp_folder = tmp_folder,
+                                 overwrite_tmp_files = overwrite_tmp_files,
+                                 append_to_run_info = append_to_run_info,
+                                 n_workers = n_workers,
+                                 ensemble_archive_address = ensemble_archive_address,
+                                 dump_archive_address = dump_archive_address,
+                                 resume = resume,
+                                 output_cache = output_cache,
+                                 score_function = score_function,
+                                 post_processing_threads = post_processing_threads,
+                                 prefetch_runs = prefetch_runs,
+                                 sandbox_pool = sandbox_pool,
+                                 staging_folder = staging_folder,
+                                 monitor = monitor,
+                                 run_supervisor = run_supervisor,
+                                 autotuner = autotuner)
 
 def iterate_soil_variable(jules_executable_address,
                           master_namelist_address,
@@ -145,13 +140,27 @@ def iterate_soil_variable(jules_executable_address,
                           keep_dump_files = False,
                           tmp_folder = None,
                           overwrite_tmp_files = False,
-                          append_to_run_info = False):
+                          append_to_run_info = False,
+                          n_workers = 1,
+                          ensemble_archive_address = None,
+                          dump_archive_address = None,
+                          resume = False,
+                          output_cache = None,
+                          score_function = None,
+                          post_processing_threads = 1,
+                          prefetch_runs = True,
+                          sandbox_pool = None,
+                          staging_folder = None,
+                          monitor = None,
+                          run_supervisor = None,
+                          autotuner = None):
 
     """
     Iterate over a series of values for a given soil variable
     :param jules_executable_address: file address of the JULES executable (str)
     :param master_namelist_address: folder containing the namelists to copy (str)
     :param soil_ancillary_address: soil ancillary file to use (str)
+        or none if no soil variable is to be changed (None)
     :param variable_names: Variable to change (str)
         or list of variables to change (list of str)
         or none if no variable is to be changed (None)
@@ -163,25 +172,58 @@ def iterate_soil_variable(jules_executable_address,
         or none if no variable is to be changed (None)
     :param variable_values: Values of the variable to iterate over as a 1D list of strings (list of strings)
         or lait of lists containing each set of variable values to try (list of lists of str)
+        or any iterable or generator of either, which is consumed one set of values at a time (iterable)
         or none if no variable is to be changed (None)
     :param soil_variable_name: soil variable to iterate over (str)
         or list of soil variables to iterate over (list of str)
         or none if no soil variable is to be changed (None)
     :param soil_variable_values: soil variable values to iterate over (list of str)
         or list of lists of soil variable values to iterate over (list of lists of str)
+        or any iterable or generator of either, which is consumed one set of values at a time (iterable)
         or none if no soil variable is to be changed (None)
     :param output_folder: JULES output folder (str)
     :param run_id_prefix: Prefix for all run ids (str)
     :param keep_dump_files: save JULES dumpfiles (bool) (optional)
     :param tmp_folder: temporary folder to use (str) (optional)
     :param overwrite_tmp_files: overwrite any existing tmp files (bool) (optional)
-    :param append_to_run_info: append to any existing run_info.csv file (bool) (optional)
-    :return:
+    :param append_to_run_info: append to any existing run records (bool) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param ensemble_archive_address: If given, the outputs are collected into this single NetCDF4 ensemble file
+                                     instead of one file per run (str) (optional)
+    :param dump_archive_address: If given with keep_dump_files, the dump files are kept in this compressed,
+                                 deduplicated archive folder instead of a folder per run (str) (optional)
+    :param resume: If True, continues an interrupted sweep in the same output folder,
+                   skipping values that already have a complete output (bool) (optional)
+    :param output_cache: Cache shared between campaigns, used to reuse the output of any identical earlier run
+                         instead of running JULES again (OutputCache) (optional)
+    :param score_function: Function giving the score of an output file, recorded with each run (callable) (optional)
+    :param post_processing_threads: Number of background threads moving, archiving and scoring finished runs
+                                    while the next runs go, or 0 to do this between runs (int) (optional)
+    :param prefetch_runs: If True, gives each worker two temporary folders and prepares the next run in one
+                          while JULES runs in the other (bool) (optional)
+    :param sandbox_pool: Pool to take ready-made temporary folders from instead of setting up tmp_folder
+                         (SandboxPool) (optional)
+    :param staging_folder: If given, the driving and ancillary files are staged to this node-local folder once
+                           and the runs read them from there, see stage_inputs (str) (optional)
+    :param monitor: Monitor to report the progress of the sweep to, by default progress is printed and written
+                    to <output_folder><run_id_prefix>_telemetry.jsonl (CampaignMonitor) (optional)
+    :param run_supervisor: Supervisor running JULES, retrying failed runs and duplicating late runs in free
+                           temporary folders (RunSupervisor) (optional)
+    :param autotuner: Autotuner choosing how many of the n_workers runs go at once from the CPU, memory and
+                      disk use of the runs (ConcurrencyAutotuner) (optional)
+    :return: Output file address for each iteration (list of str)
     """
 
     # Check there are variables to iterate over
     if variable_values is None and soil_variable_values is None:
         exception("ERROR: No variables to iterate over.\n")
+        return []
+
+    # Count the runs, if the values aren't a generator, to estimate the time left
+    n_runs = None
+    for values in (variable_values, soil_variable_values):
+        if values is not None and hasattr(values, "__len__"):
+            n_runs = len(values)
 
     # Manage JULES variables input options
     # If no variable is to be changed, set the variables to empty lists
@@ -189,43 +231,78 @@ def iterate_soil_variable(jules_executable_address,
         variable_names = []
         variable_namelists = []
         variable_namelist_files = []
-        variable_values = []
+        variable_values = None
     # If only one variable is to be changed, set the variables to lists
     elif type(variable_names) is str:
         variable_names = [variable_names]
         variable_namelists = [variable_namelists]
         variable_namelist_files = [variable_namelist_files]
-        variable_values = [variable_values]
+        variable_values = ([value] for value in variable_values)
 
     # Manage soil variables input options
     # If no soil variable is to be changed, set the variables to empty lists
     if soil_variable_names is None:
         soil_variable_names = []
-        soil_variable_values = []
+        soil_variable_values = None
     # If only one soil variable is to be changed, set the variables to lists
     elif type(soil_variable_names) is str:
         soil_variable_names = [soil_variable_names]
-        soil_variable_values = [soil_variable_values]
-
-    # Check the number of iterations is the same for both variables
-    if len(variable_values) != len(soil_variable_values) and len(variable_values) > 0 and len(soil_variable_values) > 0:
-        exception(f"ERROR: The number of iterations for the JULES variables ({len(variable_values)})"
-                  + f" and soil variables ({len(soil_variable_values)}) must be the same.\n")
-
-    # Set up the temporary folders
-    tmp_folder, output_folder = setup_calibration_run_folders(master_namelist_address,
-                                                              output_folder,
-                                                              variable_names,
-                                                              tmp_folder = tmp_folder,
-                                                              overwrite_existing_folders = overwrite_tmp_files,
-                                                              use_existing_run_info = append_to_run_info,
-                                                              setup_dump_files = keep_dump_files)
-
-    # Make a copy of the soil ancillary file
-    tmp_soil_file = Duplicate.duplicate_soil_ancillary(soil_ancillary_address,
-                                                       tmp_folder,
-                                                       tmp_folder + "namelist/ancillaries.nml",
-                                                       overwrite=overwrite_tmp_files)
+        soil_variable_values = ([value] for value in soil_variable_values)
+
+    # Read the driving and ancillary files from node-local copies,
+    # taking the sandboxes from a pool set up from the staged namelists
+    if staging_folder is not None:
+        master_namelist_address = stage_inputs(master_namelist_address, staging_folder)
+        if sandbox_pool is not None:
+            sandbox_pool = sandbox_pool.for_master(master_namelist_address)
+
+    # Each worker needs a temporary folder, or two when prefetching
+    # so one can be prepared for the next run while JULES runs in the other
+    n_sandboxes = 2 * n_workers if prefetch_runs else n_workers
+
+    # Keep one more temporary folder free for duplicates of late runs, as prefetching keeps the others busy.
+    # Duplicates only start while fewer than n_workers runs are going, unless the supervisor sets its own limit
+    n_spare_sandboxes = 0
+    if run_supervisor is not None and run_supervisor.speculate:
+        n_spare_sandboxes = 1
+        n_sandboxes += n_spare_sandboxes
+        if run_supervisor.n_workers is None:
+            run_supervisor.n_workers = n_workers
+
+    if sandbox_pool is not None:
+        # Set up the output files and take the temporary folders from the pool
+        output_folder = setup_output_files(output_folder,
+                                           variable_names + soil_variable_names,
+                                           overwrite_existing_folders = overwrite_tmp_files or resume,
+                                           use_existing_run_info = append_to_run_info or resume,
+                                           setup_dump_file_folder = keep_dump_files)
+        worker_folders = [sandbox_pool.checkout() for _ in range(n_sandboxes)]
+        tmp_folder = worker_folders[0]
+    else:
+        # Set up the temporary folders
+        tmp_folder, output_folder = setup_calibration_run_folders(master_namelist_address,
+                                                                  output_folder,
+                                                                  variable_names + soil_variable_names,
+                                                                  tmp_folder = tmp_folder,
+                                                                  overwrite_existing_folders = overwrite_tmp_files or resume,
+                                                                  use_existing_run_info = append_to_run_info or resume,
+                                                                  setup_dump_files = keep_dump_files)
+
+        # Set up a temporary folder for each worker
+        worker_folders = setup_worker_folders(master_namelist_address,
+                                              tmp_folder,
+                                              n_sandboxes,
+                                              overwrite_tmp_files or resume)
+
+    # Make a copy of the soil ancillary file for each worker
+    worker_soil_files = [None] * n_sandboxes
+    if soil_ancillary_address is not None:
+        for worker, worker_folder in enumerate(worker_folders):
+            worker_soil_files[worker] = Duplicate.duplicate_soil_ancillary(soil_ancillary_address,
+                                                                           worker_folder,
+                                                                           worker_folder + "namelist/ancillaries.nml",
+                                                                           overwrite=overwrite_tmp_files or resume
+                                                                                     or sandbox_pool is not None)
 
     # Get the output profile name
     profile_name = Read.read_variable(tmp_folder + "namelist/output.nml",
@@ -236,85 +313,603 @@ def iterate_soil_variable(jules_executable_address,
     profile_name = profile_name.strip("'")
     profile_name = profile_name.strip('"')
 
-    # Set up variables to hold the current variable values
-    current_JULES_variable_values = []
-    current_soil_variable_values = []
+    # Worker folders not currently in use, and those kept for duplicates
+    free_workers = Queue()
+    for worker in range(n_sandboxes - n_spare_sandboxes):
+        free_workers.put(worker)
+    spare_workers = Queue()
+    for worker in range(n_sandboxes - n_spare_sandboxes, n_sandboxes):
+        spare_workers.put(worker)
+
+    # Open the run records
+    results_store = ResultsStore(output_folder + RUN_INFO_DATABASE)
+
+    # Collect the outputs into a single ensemble file if asked
+    ensemble_archive = None
+    if ensemble_archive_address is not None:
+        ensemble_archive = EnsembleArchive(ensemble_archive_address, variable_names + soil_variable_names)
+
+    # Keep the dump files in a deduplicated archive if asked
+    dump_archive = None
+    if keep_dump_files and dump_archive_address is not None:
+        dump_archive = DumpArchive(dump_archive_address)
+
+    # Report the progress of the sweep
+    if monitor is None:
+        monitor = CampaignMonitor(run_id_prefix,
+                                  n_runs = n_runs,
+                                  n_workers = n_workers,
+                                  log_address = output_folder + run_id_prefix + "_telemetry.jsonl")
+
+    # n_workers runs can be set up at once, the autotuner decides how many of them go
+    if autotuner is not None:
+        autotuner.set_max_concurrency(n_workers)
+
+    # Post-process finished runs in the background while the next runs go
+    pipeline = None
+    if post_processing_threads > 0:
+        pipeline = PostProcessingPipeline(n_threads = post_processing_threads,
+                                          max_pending = 2 * n_workers)
+
+    # Find the runs already completed by an earlier, interrupted, call
+    completed_runs = {}
+    recorded_runs = set()
+    if resume:
+        completed_runs = find_completed_runs(output_folder, profile_name, results_store, ensemble_archive)
+        recorded_runs = set(results_store.run_ids(status = "complete"))
+        print(f"Resuming sweep, {len(completed_runs)} runs already complete.")
+
+    def prepare_iteration(parameter_set):
+
+        # Get the variable values for the current iteration
+        i, current_JULES_variable_values, current_soil_variable_values = parameter_set
+
+        # Run ids depend only on the position in the sweep and the values used
+        current_run_id = make_run_id(run_id_prefix,
+                                     i,
+                                     variable_names + soil_variable_names,
+                                     current_JULES_variable_values + current_soil_variable_values)
+
+        # Values that already have a complete output don't need a sandbox
+        if current_run_id in completed_runs:
+            return parameter_set, current_run_id, None
+
+        # Take a free sandbox and set the variable values in it
+        worker = free_workers.get()
+        try:
+            prepare_parameter_set(worker_folders[worker],
+                                  current_run_id,
+                                  variable_names,
+                                  variable_namelists,
+                                  variable_namelist_files,
+                                  current_JULES_variable_values,
+                                  soil_variable_names,
+                                  current_soil_variable_values,
+                                  worker_soil_files[worker])
+        except BaseException:
+            free_workers.put(worker)
+            raise
+
+        return parameter_set, current_run_id, worker
+
+    # A supervised run can be duplicated in a spare sandbox, or a free one if the spares are in use
+    def get_spare_sandbox():
+        for workers in (spare_workers, free_workers):
+            try:
+                return worker_folders[workers.get_nowait()]
+            except Empty:
+                pass
+        return None
+
+    def return_spare_sandbox(sandbox):
+        worker = worker_folders.index(sandbox)
+        if worker >= n_sandboxes - n_spare_sandboxes:
+            spare_workers.put(worker)
+        else:
+            free_workers.put(worker)
+
+    def run_iteration(iteration):
+
+        # Prepare the sandbox now if it wasn't prepared while the previous run went
+        if not prefetch_runs:
+            iteration = prepare_iteration(iteration)
+
+        parameter_set, current_run_id, worker = iteration
+        i, current_JULES_variable_values, current_soil_variable_values = parameter_set
+
+        # Skip values that already have a complete output
+        if worker is None:
+            monitor.run_skipped(current_run_id, sweep_index = i)
+
+            # Replace the record if it was lost when the sweep was interrupted
+            if current_run_id not in recorded_runs:
+                results_store.add_run(current_run_id,
+                                      dict(zip(variable_names + soil_variable_names,
+                                               current_JULES_variable_values + current_soil_variable_values)),
+                                      campaign = run_id_prefix,
+                                      sweep_index = i,
+                                      output_path = completed_runs[current_run_id])
+
+            return i, completed_runs[current_run_id]
+
+        try:
+            with span("run", run_id = current_run_id, sweep_index = i):
+                output_file = run_parameter_set(jules_executable_address,
+                                                worker_folders[worker],
+                                                output_folder,
+                                                current_run_id,
+                                                profile_name,
+                                                variable_names,
+                                                variable_namelists,
+                                                variable_namelist_files,
+                                                current_JULES_variable_values,
+                                                soil_variable_names,
+                                                current_soil_variable_values,
+                                                worker_soil_files[worker],
+                                                keep_dump_files = keep_dump_files,
+                                                results_store = results_store,
+                                                ensemble_archive = ensemble_archive,
+                                                dump_archive = dump_archive,
+                                                output_cache = output_cache,
+                                                score_function = score_function,
+                                                pipeline = pipeline,
+                                                campaign = run_id_prefix,
+                                                sweep_index = i,
+                                                prepared = True,
+                                                monitor = monitor,
+                                                run_supervisor = run_supervisor,
+                                                get_spare_sandbox = get_spare_sandbox,
+                                                return_spare_sandbox = return_spare_sandbox,
+                                                autotuner = autotuner)
+        finally:
+            free_workers.put(worker)
+
+        return i, output_file
+
+    # Take each parameter set from the inputs only when a worker is ready for it.
+    # When prefetching, the sandbox for the next run is prepared while the current runs go.
+    iterations = parameter_sets(variable_values, soil_variable_values)
+    if prefetch_runs:
+        iterations = prefetch(prepare_iteration, iterations, n_ahead = n_workers)
+
+    output_files = {}
+    for i, output_file in run_in_parallel(run_iteration, iterations, n_workers = n_workers):
+        output_files[i] = output_file
+    output_files = [output_files[i] for i in sorted(output_files)]
+
+    # Wait for the last runs to be post-processed
+    if pipeline is not None:
+        pipeline.close()
+
+    if autotuner is not None:
+        monitor.emit("autotuner_report", **autotuner.report())
+        print(f"Autotuner {'settled on' if autotuner.settled else 'still exploring, at'} {autotuner.concurrency} JULES runs at once.")
+
+    monitor.close()
+
+    # Write the run records, keeping a csv copy for easy reading
+    results_store.export_csv(output_folder + RUN_INFO_CSV)
+    results_store.close()
+    if dump_archive is not None:
+        usage = dump_archive.usage()
+        print(f"Dump archive holds {usage['n_dumps']} dumps of {usage['dump_bytes']} bytes"
+              f" in {usage['stored_bytes']} bytes.")
+        dump_archive.close()
+
+    # Return the temporary folders to the pool, or remove them
+    if sandbox_pool is not None:
+        for worker_folder in worker_folders:
+            sandbox_pool.checkin(worker_folder)
+    else:
+        delete_folder(tmp_folder)
+
+    return output_files
+
+def make_run_id(run_id_prefix, sweep_index, names, values):
+    """
+    Makes a run id from the position of a run in a sweep and a hash of the values it uses.
+    The same sweep always gives the same run ids, and no two runs in a sweep share one.
+    :param run_id_prefix: Prefix for all run ids (str)
+    :param sweep_index: Position of the run in the sweep (int)
+    :param names: Names of the variables set for the run (list of str)
+    :param values: Values of the variables set for the run (list of str)
+    :return: run id (str)
+    """
+
+    values_string = ";".join(f"{name}={value}" for name, value in zip(names, values))
+    values_hash = hashlib.sha1(values_string.encode()).hexdigest()[:8]
 
-    # Calculate the number of iterations
-    n_iterations = max(len(variable_values), len(soil_variable_values))
+    return f"{run_id_prefix}_{sweep_index:06d}_{values_hash}"
 
-    # Iterate over the values
-    for i in range(n_iterations):
+def find_completed_runs(output_folder, profile_name, results_store, ensemble_archive = None):
+    """
+    Finds the runs of a sweep whose output is already complete.
+    Outputs are only moved into the output folder or ensemble file once JULES has finished,
+    so an output there is complete even if the run record was lost.
+    :param output_folder: JULES output folder (str)
+    :param profile_name: JULES output profile name (str)
+    :param results_store: Run records of the sweep (ResultsStore)
+    :param ensemble_archive: Ensemble file the outputs are collected in (EnsembleArchive) (optional)
+    :return: address of the output of each completed run, keyed by run id (dict of str)
+    """
 
-        # Set the current run id
-        current_run_id = run_id_prefix + f"_{datetime.datetime.now():%Y_%m_%d_%H_%M}"
+    completed_runs = {}
 
-        print(f"-- Running iteration {i} with run_id {current_run_id} --")
+    # Outputs in the output folder
+    for file in os.listdir(output_folder):
+        if file.endswith("." + profile_name + ".nc"):
+            completed_runs[file[:-len("." + profile_name + ".nc")]] = output_folder + file
 
-        # Get the variable values for the current iteration
-        if(len(variable_values) > 0):
-            current_JULES_variable_values = variable_values[i]
-        if(len(soil_variable_values) > 0):
-            current_soil_variable_values = soil_variable_values[i]
-
-        # Write the run info to the run_info.csv file
-        with open(output_folder + "run_info.csv", "a") as run_info:
-            out_string = current_run_id + "." + profile_name + ".nc," + f"{datetime.datetime.now():%Y-%m-%d %H:%M}"
-            if len(variable_names) > 0:
-                out_string += "," + ",".join(current_JULES_variable_values)
-            if len(soil_variable_names) > 0:
-                out_string += "," + ",".join(current_soil_variable_values)
-            out_string += "\n"
-            run_info.write(out_string)
-
-        # Edit JULES variables
-        Edit_variable.edit_variable(variable_namelist_files,
-                                    variable_namelists,
-                                    variable_names,
-                                    current_JULES_variable_values)
+    # Outputs in the ensemble file
+    if ensemble_archive is not None:
+        for run_id in ensemble_archive.run_ids():
+            completed_runs[run_id] = ensemble_archive.archive_address
 
-        # Edit soil variables
-        Edit_variable.edit_soil_variable(tmp_soil_file,
-                                         soil_variable_names,
-                                         current_soil_variable_values,
-                                         tmp_folder + "namelist/ancillaries.nml")
+    # Outputs recorded as complete elsewhere
+    for run_id, output_path in results_store.query("SELECT run_id, output_path FROM runs "
+                                                   + "WHERE status = 'complete' AND output_path IS NOT NULL"):
+        if run_id not in completed_runs and os.path.exists(output_path):
+            completed_runs[run_id] = output_path
 
-        # Edit the output file name
-        Edit_variable.edit_variable(tmp_folder + "namelist/output.nml",
-                                    "jules_output",
-                                    "run_id",
-                                    "'" + current_run_id + "'")
+    return completed_runs
 
-        # Run JULES
-        Run_JULES.run_JULES(jules_executable_address, tmp_folder + "namelist/")
+def parameter_sets(variable_values, soil_variable_values):
+    """
+    Pairs up the JULES and soil variable values for each iteration without building them up front.
+    :param variable_values: JULES variable values for each iteration (iterable of lists of str) or None
+    :param soil_variable_values: soil variable values for each iteration (iterable of lists of str) or None
+    :return: generator of (iteration number, JULES variable values, soil variable values)
+    """
 
-        # Move the output from the temporary folder to the output folder
-        os.rename(tmp_folder + "output/" + current_run_id + "." + profile_name + ".nc",
-                  output_folder + current_run_id + "." + profile_name + ".nc")
+    if variable_values is None and soil_variable_values is None:
+        return
+
+    variable_values = iter(variable_values) if variable_values is not None else None
+    soil_variable_values = iter(soil_variable_values) if soil_variable_values is not None else None
+
+    i = 0
+    while True:
+        current_JULES_variable_values = next(variable_values, None) if variable_values is not None else []
+        current_soil_variable_values = next(soil_variable_values, None) if soil_variable_values is not None else []
+
+        # Stop once the values have run out
+        JULES_finished = current_JULES_variable_values is None
+        soil_finished = current_soil_variable_values is None
+        if JULES_finished or soil_finished:
+            # Both sets of values should run out at the same time
+            if JULES_finished != soil_finished and variable_values is not None and soil_variable_values is not None:
+                exception(f"ERROR: The number of iterations for the JULES variables and soil variables must be the same."
+                          + f" Stopping after {i} iterations.\n")
+            return
+
+        yield i, list(current_JULES_variable_values), list(current_soil_variable_values)
+        i += 1
+
+def run_parameter_set(jules_executable_address,
+                      worker_folder,
+                      output_folder,
+                      current_run_id,
+                      profile_name,
+                      variable_names,
+                      variable_namelists,
+                      variable_namelist_files,
+                      variable_values,
+                      soil_variable_names,
+                      soil_variable_values,
+                      soil_file,
+                      keep_dump_files = False,
+                      results_store = None,
+                      ensemble_archive = None,
+                      dump_archive = None,
+                      output_cache = None,
+                      score_function = None,
+                      pipeline = None,
+                      campaign = None,
+                      sweep_index = None,
+                      prepared = False,
+                      monitor = None,
+                      run_supervisor = None,
+                      get_spare_sandbox = None,
+                      return_spare_sandbox = None,
+                      autotuner = None):
+    """
+    Runs JULES in a worker's temporary folder for one set of variable values,
+    then moves the output aside and hands it to finish_run to be moved to the output folder.
+    :param jules_executable_address: file address of the JULES executable (str)
+    :param worker_folder: temporary folder of the worker running JULES (str)
+    :param output_folder: JULES output folder (str)
+    :param current_run_id: run id to use for this run (str)
+    :param profile_name: JULES output profile name (str)
+    :param variable_names: Variables to change (list of str)
+    :param variable_namelists: Namelists containing the changing variables (list of str)
+    :param variable_namelist_files: Namelist files containing the changing variables (list of str)
+    :param variable_values: Values to set the variables to (list of str)
+    :param soil_variable_names: Soil variables to change (list of str)
+    :param soil_variable_values: Values to set the soil variables to (list of str)
+    :param soil_file: Address of the worker's copy of the soil ancillary file (str) or None
+    :param keep_dump_files: save JULES dumpfiles (bool) (optional)
+    :param results_store: Results store to record the run in (ResultsStore) (optional)
+    :param ensemble_archive: Ensemble file to add the output to instead of the output folder (EnsembleArchive) (optional)
+    :param dump_archive: Archive to add the dump files to instead of the output folder (DumpArchive) (optional)
+    :param output_cache: Cache to reuse the output of an identical earlier run from (OutputCache) (optional)
+    :param score_function: Function giving the score of an output file (callable) (optional)
+    :param pipeline: Pipeline to finish the run in, so the worker can start its next run straight away
+                     (PostProcessingPipeline) (optional)
+    :param campaign: Name of the sweep the run belongs to (str) (optional)
+    :param sweep_index: Position of the run in the sweep (int) (optional)
+    :param prepared: If True, the worker folder has already been set up for the run by prepare_parameter_set
+                     (bool) (optional)
+    :param monitor: Monitor to report the start and end of the run to (CampaignMonitor) (optional)
+    :param run_supervisor: Supervisor to run JULES with, retrying and duplicating the run if needed
+                           (RunSupervisor) (optional)
+    :param get_spare_sandbox: Function returning a free temporary folder to duplicate the run in, or None
+                              (callable) (optional)
+    :param return_spare_sandbox: Function given back a temporary folder from get_spare_sandbox (callable) (optional)
+    :param autotuner: Autotuner limiting the number of runs going at once (ConcurrencyAutotuner) (optional)
+    :return: Address the JULES output file or ensemble file will have once the run is finished (str),
+             or None if JULES did not produce an output
+    """
 
-        # If user wants to keep dump files, move them to the output folder
-        if keep_dump_files:
+    if not prepared:
+        prepare_parameter_set(worker_folder,
+                              current_run_id,
+                              variable_names,
+                              variable_namelists,
+                              variable_namelist_files,
+                              variable_values,
+                              soil_variable_names,
+                              soil_variable_values,
+                              soil_file)
+
+    if monitor is not None:
+        monitor.run_started(current_run_id, sweep_index = sweep_index, worker = worker_folder)
+    else:
+        print(f"-- Running run_id {current_run_id} --")
+
+    start_time = time.time()
+
+    # Run JULES, unless an identical run is already in the output cache
+    cache_key = None
+    cache_hit = False
+    if output_cache is not None:
+        with span("cache_fetch", run_id = current_run_id):
+            cache_key = output_cache.key(worker_folder + "namelist/", jules_executable_address)
+            cache_hit = output_cache.fetch(cache_key, worker_folder + "output/", current_run_id)
+
+    run_outcome = None
+    returncode = None
+    if cache_hit:
+        print(f"-- Reusing cached output for run_id {current_run_id} --")
+    elif run_supervisor is not None:
+        with autotuner.slot() if autotuner is not None else nullcontext():
+            run_outcome = run_supervisor.run(jules_executable_address,
+                                             worker_folder,
+                                             lambda folder: os.path.exists(folder + current_run_id + "." + profile_name + ".nc"),
+                                             run_id = current_run_id,
+                                             get_spare_sandbox = get_spare_sandbox,
+                                             return_spare_sandbox = return_spare_sandbox,
+                                             monitor = monitor)
+        returncode = run_outcome.returncode
+        if autotuner is not None:
+            autotuner.record(run_outcome.run_time,
+                             cpu_time = run_outcome.cpu_time,
+                             max_rss = run_outcome.max_rss,
+                             io_bytes = run_outcome.io_bytes)
+    elif autotuner is not None:
+        returncode = autotuner.run(jules_executable_address, worker_folder + "namelist/")
+    else:
+        returncode = Run_JULES.run_JULES(jules_executable_address, worker_folder + "namelist/")
+
+    end_time = time.time()
+
+    # Move the outputs aside so the worker's output folder is free for its next run
+    staging_folder = worker_folder + "output_" + current_run_id + "/"
+    with span("stage_output", run_id = current_run_id):
+        os.rename(worker_folder + "output/", staging_folder)
+        os.mkdir(worker_folder + "output/")
+
+    # Work out where the output will end up. A supervised run that gave up may have left a partial output
+    if run_outcome is not None and not run_outcome.succeeded:
+        print(f"JULES run for run_id {current_run_id} {run_outcome.outcome.replace('_', ' ')}.")
+        status = "failed"
+        output_file = None
+    elif os.path.exists(staging_folder + current_run_id + "." + profile_name + ".nc"):
+        status = "complete"
+        if ensemble_archive is not None:
+            output_file = ensemble_archive.archive_address
+        else:
+            output_file = output_folder + current_run_id + "." + profile_name + ".nc"
+    else:
+        print(f"JULES output for run_id {current_run_id} not found.")
+        status = "failed"
+        output_file = None
+
+    # Finish the run in the background if there is a pipeline
+    finish_arguments = (staging_folder,
+                        output_folder,
+                        current_run_id,
+                        profile_name,
+                        dict(zip(variable_names + soil_variable_names,
+                                 list(variable_values) + list(soil_variable_values))),
+                        status,
+                        start_time,
+                        end_time)
+    finish_keyword_arguments = {"keep_dump_files": keep_dump_files,
+                                "results_store": results_store,
+                                "ensemble_archive": ensemble_archive,
+                                "dump_archive": dump_archive,
+                                "output_cache": output_cache if not cache_hit else None,
+                                "cache_key": cache_key,
+                                "returncode": returncode,
+                                "score_function": score_function,
+                                "campaign": campaign,
+                                "sweep_index": sweep_index,
+                                "monitor": monitor,
+                                "attempts": run_outcome.attempts if run_outcome is not None else None,
+                                "outcome": run_outcome.outcome if run_outcome is not None else None}
+    if pipeline is not None:
+        pipeline.submit(finish_run, *finish_arguments, **finish_keyword_arguments)
+    else:
+        finish_run(*finish_arguments, **finish_keyword_arguments)
+
+    return output_file
+
+@traced()
+def prepare_parameter_set(worker_folder,
+                          current_run_id,
+                          variable_names,
+                          variable_namelists,
+                          variable_namelist_files,
+                          variable_values,
+                          soil_variable_names,
+                          soil_variable_values,
+                          soil_file):
+    """
+    Sets the variable values and run id for a run in a worker's temporary folder
+    :param worker_folder: temporary folder of the worker that will run JULES (str)
+    :param current_run_id: run id to use for this run (str)
+    :param variable_names: Variables to change (list of str)
+    :param variable_namelists: Namelists containing the changing variables (list of str)
+    :param variable_namelist_files: Namelist files containing the changing variables (list of str)
+    :param variable_values: Values to set the variables to (list of str)
+    :param soil_variable_names: Soil variables to change (list of str)
+    :param soil_variable_values: Values to set the soil variables to (list of str)
+    :param soil_file: Address of the worker's copy of the soil ancillary file (str) or None
+    """
 
-            # Make a folder for the dump files
-            current_dump_folder = output_folder + "/" + current_run_id + "_dump/"
-            os.mkdir(current_dump_folder)
+    # Edit JULES variables
+    if len(variable_names) > 0:
+        Edit_variable.edit_variable([worker_folder + "namelist/" + file for file in variable_namelist_files],
+                                    variable_namelists,
+                                    variable_names,
+                                    variable_values)
+
+    # Edit soil variables
+    if len(soil_variable_names) > 0:
+        Edit_variable.edit_soil_variable(soil_file,
+                                         soil_variable_names,
+                                         soil_variable_values,
+                                         worker_folder + "namelist/ancillaries.nml")
+
+    # Edit the output file name
+    Edit_variable.edit_variable(worker_folder + "namelist/output.nml",
+                                "jules_output",
+                                "run_id",
+                                "'" + current_run_id + "'")
+
+@traced()
+def finish_run(staging_folder,
+               output_folder,
+               current_run_id,
+               profile_name,
+               parameters,
+               status,
+               start_time,
+               end_time,
+               keep_dump_files = False,
+               results_store = None,
+               ensemble_archive = None,
+               dump_archive = None,
+               output_cache = None,
+               cache_key = None,
+               returncode = None,
+               score_function = None,
+               campaign = None,
+               sweep_index = None,
+               monitor = None,
+               attempts = None,
+               outcome = None):
+    """
+    Post-processes a finished JULES run: caches, scores and moves its outputs, then records the run.
+    :param staging_folder: Folder the run's outputs were moved to when JULES finished (str)
+    :param output_folder: JULES output folder (str)
+    :param current_run_id: run id of the run (str)
+    :param profile_name: JULES output profile name (str)
+    :param parameters: Variable names and values used for the run (dict of str)
+    :param status: Status of the run, "complete" or "failed" (str)
+    :param start_time: Time the run started, in seconds since the epoch (float)
+    :param end_time: Time JULES finished, in seconds since the epoch (float)
+    :param keep_dump_files: save JULES dumpfiles (bool) (optional)
+    :param results_store: Results store to record the run in (ResultsStore) (optional)
+    :param ensemble_archive: Ensemble file to add the output to instead of the output folder (EnsembleArchive) (optional)
+    :param dump_archive: Archive to add the dump files to instead of the output folder (DumpArchive) (optional)
+    :param output_cache: Cache to add the outputs to (OutputCache) (optional)
+    :param cache_key: Cache key of the run (str) (optional)
+    :param returncode: JULES return code, the outputs are only cached if it is 0 (int) (optional)
+    :param score_function: Function giving the score of an output file (callable) (optional)
+    :param campaign: Name of the sweep the run belongs to (str) (optional)
+    :param sweep_index: Position of the run in the sweep (int) (optional)
+    :param monitor: Monitor to report the end of the run to (CampaignMonitor) (optional)
+    :param attempts: Number of times JULES was started for the run (int) (optional)
+    :param outcome: How the supervised run went, see RunSupervisor (str) (optional)
+    """
 
-            output_files = os.listdir(tmp_folder + "output/")
+    staged_output = staging_folder + current_run_id + "." + profile_name + ".nc"
+
+    score = None
+    output_file = None
+    if status == "complete":
+
+        # Add the outputs to the cache, unless JULES crashed and left a truncated output
+        if output_cache is not None and returncode == 0:
+            with span("cache_store", run_id = current_run_id):
+                output_cache.store(cache_key, staging_folder, current_run_id)
+
+        # Score the output
+        if score_function is not None:
+            with span("score", run_id = current_run_id):
+                score = score_function(staged_output)
+
+        # Move the output from the temporary folder to the output folder or ensemble file
+        if ensemble_archive is not None:
+            with span("archive_output", run_id = current_run_id):
+                ensemble_archive.append(current_run_id, parameters, staged_output)
+            output_file = ensemble_archive.archive_address
+        else:
+            output_file = output_folder + current_run_id + "." + profile_name + ".nc"
+            with span("move_output", run_id = current_run_id):
+                shutil.move(staged_output, output_file)
+
+    # If user wants to keep dump files, move them to the output folder or dump archive
+    if keep_dump_files and dump_archive is not None:
+        with span("archive_dump_files", run_id = current_run_id):
+            dump_archive.add_folder(current_run_id, staging_folder)
+
+    elif keep_dump_files:
+
+        # Make a folder for the dump files
+        current_dump_folder = output_folder + "/" + current_run_id + "_dump/"
+        os.makedirs(current_dump_folder, exist_ok=True)
+
+        with span("move_dump_files", run_id = current_run_id):
+            output_files = os.listdir(staging_folder)
             for file in output_files:
                 if 'dump' in file:
-                    os.rename(tmp_folder + "output/" + file, current_dump_folder + file)
-
-        # Delete the temporary output folder contents
-        output_files = os.listdir(tmp_folder + "output/")
-        for file in output_files:
-            os.remove(tmp_folder + "output/" + file)
-
-    # Remove tmp folder and contents
-    for root, dirs, files in os.walk(tmp_folder, topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
-    os.rmdir(tmp_folder)
-
-    return
\ No newline at end of file
+                    shutil.move(staging_folder + file, current_dump_folder + file)
+
+    # Delete the rest of the temporary output
+    delete_folder(staging_folder)
+
+    # Record the run
+    if results_store is not None:
+        results_store.add_run(current_run_id,
+                              parameters,
+                              campaign = campaign,
+                              sweep_index = sweep_index,
+                              start_time = start_time,
+                              end_time = end_time,
+                              status = status,
+                              score = score,
+                              output_path = output_file,
+                              attempts = attempts,
+                              outcome = outcome)
+
+    if monitor is not None:
+        monitor.run_finished(current_run_id,
+                             start_time,
+                             end_time,
+                             status = status,
+                             score = score,
+                             sweep_index = sweep_index)
+
+    return output_file
@@ -0,0 +1,174 @@
+"""
+Command line entry point running iterate or optimise campaigns from a config file.
+
+The config file is JSON (or TOML, ending .toml) holding the arguments of iterate_variables or optimise_variable,
+plus "mode" ("iterate" or "optimise") and these optional entries:
+    "parameter_sets_csv": csv file of parameter sets to iterate over instead of "variable_values"
+    "observation_data": csv or netCDF file of observations (str), or {"address": ..., "index_column": ...} (dict),
+                        with "cache_folder" to load csv files through an ObservationStore, optionally with
+                        "time_period", "time_format" and other pandas.read_csv arguments
+    "output_cache": {"cache_folder": ..., "max_size_bytes": ...} (dict)
+    "sandbox_pool": {"pool_folder": ..., "max_idle_sandboxes": ...} (dict)
+    "staging_folder": node-local folder to stage the driving and ancillary files to (str), see stage_inputs
+    "run_supervisor": {"max_retries": ..., "deadline_factor": ..., ...} (dict), see RunSupervisor (iterate)
+    "autotuner": {"initial_concurrency": ..., "memory_limit": ..., ...} (dict), see ConcurrencyAutotuner (iterate)
+"""
+import sys
+import json
+import argparse
+from logging import exception
+
+
+def main(argv = None):
+    """
+    Runs a calibration campaign from a config file
+    :param argv: Command line arguments, defaults to sys.argv[1:] (list of str) (optional)
+    :return: exit code (int)
+    """
+
+    parser = argparse.ArgumentParser(prog="jules-calibrate",
+                                     description="Run a JULES calibration campaign from a config file.")
+    parser.add_argument("config", help="JSON or TOML config file of the campaign")
+    parser.add_argument("--mode", choices=["iterate", "optimise"], help="overrides the mode in the config file")
+    parser.add_argument("--n-workers", type=int, help="number of JULES runs to execute at the same time (iterate)")
+    parser.add_argument("--resume", action="store_true", help="resume an interrupted sweep (iterate)")
+    parser.add_argument("--trace", help="write a Chrome trace of the campaign stages to this JSON file")
+    arguments = parser.parse_args(argv)
+
+    config = read_config(arguments.config)
+
+    mode = arguments.mode if arguments.mode is not None else config.pop("mode", "iterate")
+    config.pop("mode", None)
+    if arguments.n_workers is not None:
+        config["n_workers"] = arguments.n_workers
+    if arguments.resume:
+        config["resume"] = True
+
+    tracer = None
+    if arguments.trace is not None:
+        from Calibration.general.tracing import enable_tracing
+        tracer = enable_tracing()
+
+    try:
+        run_campaign(mode, config)
+    finally:
+        if tracer is not None:
+            tracer.export_chrome_trace(arguments.trace)
+            tracer.print_summary()
+
+    return 0
+
+def read_config(config_address):
+    """
+    Reads a campaign config file
+    :param config_address: Address of the JSON or TOML config file (str)
+    :return: config (dict)
+    """
+
+    if config_address.endswith(".toml"):
+        import tomllib
+        with open(config_address, "rb") as file:
+            return tomllib.load(file)
+
+    with open(config_address, "r") as file:
+        return json.load(file)
+
+def run_campaign(mode, config):
+    """
+    Runs an iterate or optimise campaign, building the objects named in the config
+    :param mode: "iterate" or "optimise" (str)
+    :param config: arguments of iterate_variables or optimise_variable (dict)
+    :return: result of the campaign
+    """
+
+    config = dict(config)
+
+    # Cache and sandbox pool shared between campaigns
+    if isinstance(config.get("output_cache"), dict):
+        from Calibration.general.output_cache import OutputCache
+        config["output_cache"] = OutputCache(**config["output_cache"])
+
+    # Stage the inputs before any sandbox is made from the master namelists
+    if config.get("staging_folder") is not None:
+        from Calibration.Calibration.input_staging import stage_inputs
+        config["master_namelist_address"] = stage_inputs(config["master_namelist_address"],
+                                                         config.pop("staging_folder"))
+
+    if isinstance(config.get("sandbox_pool"), dict):
+        from Calibration.Calibration.sandbox_pool import get_sandbox_pool
+        config["sandbox_pool"] = get_sandbox_pool(config["master_namelist_address"], **config["sandbox_pool"])
+
+    if mode == "iterate":
+        from Calibration.Calibration.Iterate_variable import iterate_variables
+
+        # Retry failed runs and duplicate late ones
+        if isinstance(config.get("run_supervisor"), dict):
+            from Calibration.Run_JULES.run_supervisor import RunSupervisor
+            config["run_supervisor"] = RunSupervisor(**config["run_supervisor"])
+
+        # Tune the number of runs going at once
+        if isinstance(config.get("autotuner"), dict):
+            from Calibration.general.autotuner import ConcurrencyAutotuner
+            config["autotuner"] = ConcurrencyAutotuner(**config["autotuner"])
+
+        # Read the parameter sets a row at a time
+        if "parameter_sets_csv" in config:
+            from Calibration.Calibration.parameter_set_generators import read_parameter_sets
+
+            # Each row is a list of values, so a single variable is given as a list of one
+            if type(config["variable_names"]) is str:
+                for key in ("variable_names", "variable_namelists", "variable_namelist_files"):
+                    config[key] = [config[key]]
+
+            config["variable_values"] = read_parameter_sets(config.pop("parameter_sets_csv"),
+                                                            config["variable_names"])
+
+        return iterate_variables(**config)
+
+    if mode == "optimise":
+        from Calibration.Calibration.optimise_variable import optimise_variable
+
+        config["observation_data"] = read_observation_data(config["observation_data"],
+                                                           columns = config.get("observational_variable_keys"))
+
+        return optimise_variable(**config)
+
+    exception(f"ERROR: Unknown campaign mode ({mode}).\n")
+    return None
+
+def read_observation_data(observation_data, columns = None):
+    """
+    Reads observation data named in a config file
+    :param observation_data: csv or netCDF file address (str), or {"address": ..., "index_column": ...} (dict)
+    :param columns: Columns needed, the only ones read from an observation store (list of str) (optional)
+    :return: pandas dataframe of the observations indexed by time, or xarray dataset of gridded observations
+             from a netCDF file
+    """
+
+    import pandas as pd
+
+    if isinstance(observation_data, str):
+        observation_data = {"address": observation_data}
+
+    # Gridded observations are opened lazily and read a chunk at a time when scoring
+    if observation_data["address"].endswith(".nc"):
+        from xarray import open_dataset
+        return open_dataset(observation_data["address"])
+
+    # Load through the columnar cache so large csv files are only parsed once
+    if "cache_folder" in observation_data:
+        from Calibration.general.observation_store import ObservationStore
+        arguments = dict(observation_data)
+        store = ObservationStore(arguments.pop("cache_folder"))
+        return store.load(arguments.pop("address"),
+                          columns = columns,
+                          time_period = arguments.pop("time_period", None),
+                          index_column = arguments.pop("index_column", 0),
+                          **arguments)
+
+    return pd.read_csv(observation_data["address"],
+                       index_col=observation_data.get("index_column", 0),
+                       parse_dates=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""
+Code to explore large parameter sweeps by only running JULES for the members an emulator can't rule out
+"""
+import threading
+from collections import deque
+from logging import exception
+
+from Calibration.Calibration.Iterate_variable import iterate_soil_variable
+from Calibration.general.emulator import GaussianProcessEmulator
+from Calibration.general.results_store import to_float
+from Calibration.general.telemetry import CampaignMonitor
+
+
+def screen_parameter_sets(jules_executable_address,
+                          master_namelist_address,
+                          output_folder,
+                          run_id_prefix,
+                          score_function,
+                          variable_names = None,
+                          variable_namelists = None,
+                          variable_namelist_files = None,
+                          variable_values = None,
+                          soil_ancillary_address = None,
+                          soil_variable_names = None,
+                          soil_variable_values = None,
+                          n_initial = None,
+                          retrain_every = None,
+                          exploration = 2.0,
+                          uncertainty_threshold = 0.1,
+                          max_runs = None,
+                          seed = None,
+                          n_workers = 1,
+                          monitor = None,
+                          **iterate_arguments):
+    """
+    Runs a parameter sweep, using an emulator to skip the members that are clearly poor.
+    A random subset of n_initial members is run first. A Gaussian process emulator of the score is then
+    trained on the finished runs and predicts the rest of the design with an uncertainty. A member is only
+    run if it could be competitive (predicted score minus exploration standard deviations is below the best
+    score so far) or is poorly predicted (standard deviation above uncertainty_threshold times the spread of
+    the scores so far), most promising first. The emulator is retrained every retrain_every results, and the
+    sweep stops when no member is left worth running. Lower scores are better.
+    The sweep is run by iterate_soil_variable, so run ids follow the order the members are run in and
+    resume isn't supported.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param output_folder: JULES output folder (str)
+    :param run_id_prefix: Prefix for all run ids (str)
+    :param score_function: Function giving the score of an output file (callable)
+    :param variable_names: Namelist variables to change (str or list of str) (optional)
+    :param variable_namelists: Namelists containing the variables (str or list of str) (optional)
+    :param variable_namelist_files: Namelist files containing the variables (str or list of str) (optional)
+    :param variable_values: Design of the variable values, one set of values for each member (list of lists of str)
+                            or one value for each member if there is only one variable (list of str) (optional)
+    :param soil_ancillary_address: Soil ancillary file to use (str) (optional)
+    :param soil_variable_names: Soil variables to change (str or list of str) (optional)
+    :param soil_variable_values: Design of the soil variable values, as variable_values (optional)
+    :param n_initial: Number of members to run before the emulator is first trained, defaults to
+                      twice the number of variables plus two, and at least ten (int) (optional)
+    :param retrain_every: Number of new results between retraining the emulator, defaults to n_workers (int) (optional)
+    :param exploration: Number of standard deviations below the predicted score a member can be
+                        and still be competitive (float) (optional)
+    :param uncertainty_threshold: Standard deviation, relative to the spread of the scores, above which
+                                  a member is poorly predicted (float) (optional)
+    :param max_runs: Maximum number of members to run (int) (optional)
+    :param seed: Random seed used to pick the initial members (int) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param monitor: Monitor to report the progress of the sweep to (CampaignMonitor) (optional)
+    :param iterate_arguments: Other arguments of iterate_soil_variable, e.g. tmp_folder or post_processing_threads
+    :return: pandas dataframe with a row for each member: its values, score if run, predicted score and
+             standard deviation, whether it was run and its position in the sweep.
+             Also saved to <output_folder><run_id_prefix>_emulator_predictions.csv
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    # Manage the variable input options
+    if type(variable_names) is str:
+        variable_names = [variable_names]
+        variable_namelists = [variable_namelists]
+        variable_namelist_files = [variable_namelist_files]
+        variable_values = [[value] for value in variable_values]
+
+    if type(soil_variable_names) is str:
+        soil_variable_names = [soil_variable_names]
+        soil_variable_values = [[value] for value in soil_variable_values]
+
+    if variable_values is None and soil_variable_values is None:
+        exception("ERROR: No variables to iterate over.\n")
+        return None
+
+    variable_values = [list(values) for values in variable_values] if variable_values is not None else None
+    soil_variable_values = [list(values) for values in soil_variable_values] if soil_variable_values is not None else None
+
+    names = (variable_names or []) + (soil_variable_names or [])
+    design = [(variable_values[member] if variable_values is not None else [])
+              + (soil_variable_values[member] if soil_variable_values is not None else [])
+              for member in range(len(variable_values if variable_values is not None else soil_variable_values))]
+
+    # The emulator needs numeric values
+    numeric_design = [[to_float(value) for value in values] for values in design]
+    if any(value is None for values in numeric_design for value in values):
+        exception("ERROR: The emulator can only be used with numeric variable values.\n")
+        return None
+    numeric_design = np.array(numeric_design, dtype=float)
+
+    if n_initial is None:
+        n_initial = max(2 * len(names) + 2, 10)
+    if retrain_every is None:
+        retrain_every = n_workers
+
+    screen = EmulatorScreen(numeric_design,
+                            n_initial = n_initial,
+                            retrain_every = retrain_every,
+                            exploration = exploration,
+                            uncertainty_threshold = uncertainty_threshold,
+                            max_runs = max_runs,
+                            max_pending_results = 2 * n_workers,
+                            seed = seed)
+
+    # The screen hears about each finished run from the monitor
+    if monitor is None:
+        monitor = CampaignMonitor(run_id_prefix, n_workers = n_workers)
+    monitor.add_callback(screen.record)
+
+    # The member chosen for each run sets both the JULES and soil variable values
+    chosen_members = deque()
+
+    def leading_values(values):
+        while True:
+            member = screen.next_member()
+            if member is None:
+                return
+            chosen_members.append(member)
+            yield values[member]
+
+    def following_values(values):
+        while len(chosen_members) > 0:
+            yield values[chosen_members.popleft()]
+
+    if variable_values is not None:
+        variable_value_sets = leading_values(variable_values)
+        soil_variable_value_sets = following_values(soil_variable_values) if soil_variable_values is not None else None
+    else:
+        variable_value_sets = None
+        soil_variable_value_sets = leading_values(soil_variable_values)
+
+    iterate_soil_variable(jules_executable_address,
+                          master_namelist_address,
+                          soil_ancillary_address,
+                          variable_names,
+                          variable_namelists,
+                          variable_namelist_files,
+                          variable_value_sets,
+                          soil_variable_names,
+                          soil_variable_value_sets,
+                          output_folder,
+                          run_id_prefix,
+                          n_workers = n_workers,
+                          score_function = score_function,
+                          monitor = monitor,
+                          **iterate_arguments)
+
+    # Predict the whole design from every result
+    predicted_score, predicted_std = screen.predict_design()
+
+    scores = np.full(len(design), np.nan)
+    sweep_indices = np.full(len(design), -1)
+    for sweep_index, member in enumerate(screen.chosen):
+        scores[member] = screen.scores.get(member, np.nan)
+        sweep_indices[member] = sweep_index
+
+    predictions = pd.DataFrame(design, columns=names)
+    predictions["score"] = scores
+    predictions["predicted_score"] = predicted_score
+    predictions["predicted_std"] = predicted_std
+    predictions["run"] = sweep_indices >= 0
+    predictions["sweep_index"] = sweep_indices
+
+    if not output_folder.endswith("/"):
+        output_folder += "/"
+    predictions.to_csv(output_folder + run_id_prefix + "_emulator_predictions.csv", index_label="member")
+
+    print(f"Ran {len(screen.chosen)} of {len(design)} members, best score {np.nanmin(scores)}.")
+
+    return predictions
+
+class EmulatorScreen:
+    """
+    Chooses which members of a design to run next, from the results of the runs so far.
+    next_member is called by the sweep for each run, and record is given the monitor's events.
+    """
+
+    def __init__(self,
+                 design,
+                 n_initial,
+                 retrain_every,
+                 exploration = 2.0,
+                 uncertainty_threshold = 0.1,
+                 max_runs = None,
+                 max_pending_results = 2,
+                 seed = None):
+        """
+        :param design: Values of each member (numpy array, n_members by n_variables)
+        :param n_initial: Number of random members to run before the emulator is used (int)
+        :param retrain_every: Number of new results between retraining the emulator (int)
+        :param exploration: Number of standard deviations a member can be below its prediction (float) (optional)
+        :param uncertainty_threshold: Relative standard deviation above which a member is run (float) (optional)
+        :param max_runs: Maximum number of members to run (int) (optional)
+        :param max_pending_results: Number of runs that can be without a result when choosing a member (int) (optional)
+        :param seed: Random seed used to pick the initial members (int) (optional)
+        """
+
+        import numpy as np
+
+        self.design = design
+        self.n_initial = min(n_initial, len(design))
+        self.retrain_every = max(retrain_every, 1)
+        self.exploration = exploration
+        self.uncertainty_threshold = uncertainty_threshold
+        self.max_runs = max_runs if max_runs is not None else len(design)
+        self.max_pending_results = max_pending_results
+
+        self.input_bounds = np.stack([design.min(axis=0), design.max(axis=0)], axis=1)
+        self.random_order = np.random.default_rng(seed).permutation(len(design))
+        self.remaining = np.ones(len(design), dtype=bool)
+
+        # Member run at each position in the sweep, and the score of each finished member (NaN if it failed)
+        self.chosen = []
+        self.scores = {}
+
+        self.predicted_score = None
+        self.predicted_std = None
+        self._n_results_at_fit = 0
+
+        self._condition = threading.Condition()
+
+    def record(self, event):
+        """
+        Records the result of a run from a monitor event
+        :param event: monitor event (dict)
+        """
+
+        if event["event"] not in ("run_end", "run_failed", "run_skipped") or event.get("sweep_index") is None:
+            return
+
+        score = event.get("score")
+        with self._condition:
+            member = self.chosen[event["sweep_index"]]
+            self.scores[member] = float(score) if score is not None else float("nan")
+            self._condition.notify_all()
+
+    def next_member(self):
+        """
+        Chooses the next member to run, waiting for results if too many runs are without one
+        :return: position of the member in the design (int), or None if no member is left worth running
+        """
+
+        while True:
+            with self._condition:
+                if len(self.chosen) >= self.max_runs or not self.remaining.any():
+                    return None
+
+                if len(self.chosen) < self.n_initial:
+                    return self._choose(self.random_order[len(self.chosen)])
+
+                while len(self.chosen) - len(self.scores) > self.max_pending_results:
+                    self._condition.wait()
+
+                n_pending = len(self.chosen) - len(self.scores)
+                retrain = (self.predicted_score is None
+                           or len(self.scores) - self._n_results_at_fit >= self.retrain_every)
+                results = dict(self.scores)
+
+            # Fit outside the lock, so finished runs can still be recorded
+            if retrain:
+                self._fit(results)
+
+            with self._condition:
+                member = self._select()
+                if member is not None:
+                    return self._choose(member)
+
+                # Nothing looks worth running now, but the runs still going could change that
+                if n_pending == 0:
+                    return None
+                while len(self.chosen) > len(self.scores):
+                    self._condition.wait()
+                self.predicted_score = None
+
+    def _choose(self, member):
+        self.chosen.append(int(member))
+        self.remaining[member] = False
+        return int(member)
+
+    def _fit(self, results):
+        """
+        Trains the emulator on the finished runs and predicts the members not yet run
+        :param results: score of each finished member (dict)
+        """
+
+        import numpy as np
+
+        members = [member for member, score in results.items() if np.isfinite(score)]
+        self._n_results_at_fit = len(results)
+        self._results = results
+
+        # Fall back to random order until there is enough to fit to
+        if len(members) < 2 or np.ptp([results[member] for member in members]) == 0:
+            self.predicted_score = np.zeros(len(self.design))
+            self.predicted_std = np.full(len(self.design), np.inf)
+            return
+
+        emulator = GaussianProcessEmulator().fit(self.design[members],
+                                                 [results[member] for member in members],
+                                                 input_bounds = self.input_bounds)
+        self.predicted_score, self.predicted_std = emulator.predict(self.design)
+
+    def _select(self):
+        """
+        Finds the most promising member that could be competitive or is poorly predicted
+        :return: position of the member in the design (int), or None if there isn't one
+        """
+
+        import numpy as np
+
+        candidates = np.flatnonzero(self.remaining)
+
+        # Without a usable emulator, run members in random order
+        if np.isinf(self.predicted_std).all():
+            return next(member for member in self.random_order if self.remaining[member])
+
+        scores = np.array([score for score in self._results.values() if np.isfinite(score)])
+        lower_bound = self.predicted_score[candidates] - self.exploration * self.predicted_std[candidates]
+
+        competitive = lower_bound < scores.min()
+        poorly_predicted = self.predicted_std[candidates] > self.uncertainty_threshold * scores.std()
+
+        worth_running = competitive | poorly_predicted
+        if not worth_running.any():
+            return None
+
+        return int(candidates[worth_running][np.argmin(lower_bound[worth_running])])
+
+    def predict_design(self):
+        """
+        Predicts the score of every member from all the results
+        :return: predicted score (numpy array), standard deviation (numpy array)
+        """
+
+        self._fit(dict(self.scores))
+        return self.predicted_score, self.predicted_std
@@ -0,0 +1,326 @@
+"""
+Code to calibrate namelist variables with an iterative ensemble smoother (ES-MDA)
+"""
+import math
+from logging import exception
+
+from Calibration.Calibration.evaluator import JULESEvaluator
+from Calibration.Calibration.parameter_set_generators import latin_hypercube_parameter_sets
+
+
+def calibrate_ensemble_smoother(jules_executable_address,
+                                master_namelist_address,
+                                variable_names,
+                                variable_namelists,
+                                variable_namelist_files,
+                                observation_data,
+                                observational_variable_keys,
+                                jules_out_variable_keys,
+                                run_id_prefix,
+                                variable_bounds,
+                                variable_formats = None,
+                                n_members = 50,
+                                n_iterations = 4,
+                                inflation_factors = None,
+                                observation_errors = None,
+                                relative_observation_error = 0.1,
+                                run_posterior = True,
+                                obs_variable_weights = None,
+                                output_folder = None,
+                                tmp_folder = None,
+                                overwrite_tmp_files = False,
+                                overwrite_output_files = False,
+                                append_to_run_info = False,
+                                n_workers = 1,
+                                output_cache = None,
+                                seed = None,
+                                monitor = None,
+                                verbose = False):
+    """
+    Calibrates namelist variables with an ensemble smoother with multiple data assimilation (ES-MDA).
+    An ensemble of parameter sets is drawn from a Latin hypercube over the bounds and run in parallel. Each
+    member is then moved towards the observations using the ensemble covariance between the parameters and
+    the simulated observations, with the observation errors inflated by the inflation factor of the iteration,
+    and the updated ensemble is run again. The inflation factors add up (as 1 / factor) to one, so after the
+    last update the ensemble samples the posterior. Parameters are updated in logit space so they stay within
+    their bounds. Members whose run fails are dropped from the ensemble.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param variable_names: Name of the variable to calibrate (str) or list of variables to calibrate (list of str)
+    :param variable_namelists: Namelist containing each variable (str or list of str)
+    :param variable_namelist_files: Namelist file containing each variable (str or list of str)
+    :param observation_data: pandas dataframe of the observations indexed by time
+    :param observational_variable_keys: Keys of the variables in the observation data used to assess model
+                                        (str or list of str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file used to assess model
+                                    (str or list of str)
+    :param run_id_prefix: Prefix to add to the run ids (str)
+    :param variable_bounds: Lower and upper bound of each variable, the range of the prior (list of tuples)
+    :param variable_formats: Format string used to write each value, e.g. "5*{}" (list of str) (optional)
+    :param n_members: Number of members in the ensemble (int) (optional)
+    :param n_iterations: Number of updates, used when inflation_factors isn't given (int) (optional)
+    :param inflation_factors: Observation error inflation factor of each update, which should add up to one as
+                              1 / factor, defaults to n_iterations for every update (list of float) (optional)
+    :param observation_errors: Standard deviation of the errors of each observed variable (list of float) (optional)
+    :param relative_observation_error: Observation error as a fraction of the standard deviation of each observed
+                                       variable, used when observation_errors isn't given (float) (optional)
+    :param run_posterior: If True, runs the final ensemble so its members have scores (bool) (optional)
+    :param obs_variable_weights: Weights used for the scores recorded for each run (list of float) (optional)
+    :param output_folder: Address to save the run records and ensembles in (str) (optional)
+    :param tmp_folder: Temporary folder to use (str) (optional)
+    :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+    :param overwrite_output_files: If True, overwrites an existing output folder (bool) (optional)
+    :param append_to_run_info: If True, appends to existing run records (bool) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param output_cache: Cache used to reuse the output of any identical earlier run (OutputCache) (optional)
+    :param seed: Random seed for the prior ensemble and the observation perturbations (int) (optional)
+    :param monitor: Monitor to report the progress of the runs to (CampaignMonitor) (optional)
+    :param verbose: If True, prints progress (bool) (optional)
+    :return: pandas dataframe of the final ensemble, with the variable values of each member (and its score
+             and run id if run_posterior), and the mean and standard deviation of each variable in the
+             attrs "mean" and "std"
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    # -- Setup ---------------------------------------------------------------------------------
+
+    # Manage the case where the user only wants to calibrate one variable
+    if type(variable_names) is str:
+        variable_names = [variable_names]
+        variable_namelists = [variable_namelists]
+        variable_namelist_files = [variable_namelist_files]
+        variable_bounds = [variable_bounds] if type(variable_bounds[0]) not in (list, tuple) else variable_bounds
+
+    if type(observational_variable_keys) is str:
+        observational_variable_keys = [observational_variable_keys]
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+
+    if inflation_factors is None:
+        inflation_factors = [float(n_iterations)] * n_iterations
+    if abs(sum(1 / factor for factor in inflation_factors) - 1) > 1e-6:
+        print(f"Warning: the inverse inflation factors add up to {sum(1 / factor for factor in inflation_factors)},"
+              + " not one, so the final ensemble won't sample the posterior.")
+
+    bounds = np.array(variable_bounds, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    # Observed values, one row per time with an observation of every variable
+    observations = observation_data[observational_variable_keys].dropna()
+    if len(observations) == 0:
+        exception("ERROR: No times with an observation of every variable in observational_variable_keys.")
+        return None
+
+    # Set from the times the first successful run covers, as the observations may run past the simulation
+    observed = None
+    errors = None
+
+    evaluator = JULESEvaluator(jules_executable_address,
+                               master_namelist_address,
+                               variable_names,
+                               variable_namelists,
+                               variable_namelist_files,
+                               observation_data,
+                               observational_variable_keys,
+                               jules_out_variable_keys,
+                               run_id_prefix,
+                               variable_formats = variable_formats,
+                               obs_variable_weights = obs_variable_weights,
+                               output_folder = output_folder,
+                               tmp_folder = tmp_folder,
+                               overwrite_tmp_files = overwrite_tmp_files,
+                               overwrite_output_files = overwrite_output_files,
+                               append_to_run_info = append_to_run_info,
+                               n_workers = n_workers,
+                               output_cache = output_cache,
+                               monitor = monitor,
+                               verbose = verbose)
+
+    def simulate(ensemble):
+        """
+        Runs every member of the ensemble
+        :return: scores (numpy array), simulated observations, one row per member with NaN rows for failed
+                 members, or None if no observations could be compared (numpy array), run ids (list of str)
+        """
+
+        nonlocal observations, observed, errors
+
+        scores, run_ids, outputs = evaluator.evaluate_batch(ensemble, return_output = True)
+
+        # Only use the observations inside the simulation period
+        if observed is None:
+            JULES_data = next((JULES_data for JULES_data in outputs if JULES_data is not None), None)
+            if JULES_data is None:
+                return scores, None, run_ids
+            observations = observations.loc[observations.index.intersection(JULES_data.index)]
+            if len(observations) == 0:
+                return scores, None, run_ids
+            observed = observations.to_numpy(dtype=float).ravel()
+
+            # Standard deviation of the error of each observed value
+            if observation_errors is None:
+                variable_errors = [relative_observation_error * observations[key].std()
+                                   for key in observational_variable_keys]
+            else:
+                variable_errors = observation_errors
+            errors = np.tile(np.asarray(variable_errors, dtype=float), len(observations))
+            errors = np.where(errors > 0, errors, 1e-12)
+
+        simulated = np.full((len(ensemble), len(observed)), np.nan)
+        for member, JULES_data in enumerate(outputs):
+            if JULES_data is None:
+                continue
+            # Simulated values at the observed times, NaN where the run doesn't cover them
+            JULES_data = JULES_data[jules_out_variable_keys].reindex(observations.index)
+            simulated[member] = JULES_data.to_numpy(dtype=float).ravel()
+
+        return scores, simulated, run_ids
+
+    # Prior ensemble from a Latin hypercube over the bounds
+    ensemble = np.array([[float(value) for value in values]
+                         for values in latin_hypercube_parameter_sets(variable_bounds,
+                                                                      n_samples = n_members,
+                                                                      batch_size = n_members,
+                                                                      seed = seed)])
+    ensembles = []
+
+    # -- Updates -------------------------------------------------------------------------------
+    for iteration, inflation_factor in enumerate(inflation_factors):
+        print(f"Ensemble smoother update {iteration + 1} of {len(inflation_factors)}: "
+              + f"running {len(ensemble)} members")
+
+        scores, simulated, run_ids = simulate(ensemble)
+        ensembles.append(ensemble_table(ensemble, scores, run_ids, variable_names, iteration))
+        if simulated is None:
+            exception("ERROR: No member runs succeeded with an output overlapping the observations.")
+            evaluator.close()
+            return None
+
+        # Drop members whose runs failed
+        succeeded = np.all(np.isfinite(simulated), axis=1)
+        if not succeeded.all():
+            print(f"Dropping {np.sum(~succeeded)} failed members from the ensemble.")
+        ensemble = ensemble[succeeded]
+        simulated = simulated[succeeded]
+        if len(ensemble) < 2:
+            exception("ERROR: Fewer than two ensemble members left, can't update the ensemble.")
+            evaluator.close()
+            return None
+
+        ensemble = update_ensemble(ensemble, simulated, observed, errors, inflation_factor, bounds, rng)
+
+        if evaluator.monitor is not None:
+            evaluator.monitor.emit("ensemble_update",
+                                   iteration = iteration + 1,
+                                   n_members = len(ensemble),
+                                   mean_score = float(np.nanmean(np.where(np.isfinite(scores), scores, np.nan))),
+                                   mean = dict(zip(variable_names, ensemble.mean(axis=0).tolist())),
+                                   std = dict(zip(variable_names, ensemble.std(axis=0, ddof=1).tolist())))
+
+    # -- Posterior -----------------------------------------------------------------------------
+    if run_posterior:
+        print(f"Running the {len(ensemble)} members of the final ensemble")
+        scores, _, run_ids = simulate(ensemble)
+    else:
+        scores, run_ids = None, None
+    posterior = ensemble_table(ensemble, scores, run_ids, variable_names, len(inflation_factors))
+    ensembles.append(posterior)
+
+    evaluator.close()
+
+    if evaluator.output_folder is not None:
+        pd.concat(ensembles, ignore_index=True).to_csv(evaluator.output_folder + run_id_prefix + "_ensembles.csv",
+                                                       index=False)
+
+    posterior = posterior.drop(columns="iteration")
+    posterior.attrs["mean"] = dict(zip(variable_names, ensemble.mean(axis=0).tolist()))
+    posterior.attrs["std"] = dict(zip(variable_names, ensemble.std(axis=0, ddof=1).tolist()))
+
+    print("Calibrated values:")
+    for name in variable_names:
+        print(f"{name} = {posterior.attrs['mean'][name]:.6g} +/- {posterior.attrs['std'][name]:.3g}")
+
+    return posterior
+
+def update_ensemble(ensemble, simulated, observed, errors, inflation_factor, bounds, rng):
+    """
+    Moves each member of an ensemble towards perturbed observations with the ensemble Kalman gain.
+    The gain is worked out in the space of the ensemble members, so the cost grows with the number of
+    observations only linearly.
+    :param ensemble: Variable values of each member (numpy array, n_members by n_variables)
+    :param simulated: Simulated observations of each member (numpy array, n_members by n_observations)
+    :param observed: Observations (numpy array, n_observations)
+    :param errors: Standard deviation of the error of each observation (numpy array, n_observations)
+    :param inflation_factor: Factor the observation error variances are multiplied by (float)
+    :param bounds: Lower and upper bound of each variable (numpy array, n_variables by 2)
+    :param rng: Random number generator for the observation perturbations (numpy Generator)
+    :return: updated variable values of each member (numpy array, n_members by n_variables)
+    """
+
+    import numpy as np
+
+    n_members = len(ensemble)
+
+    # Update in logit space so the members stay inside the bounds
+    parameters = to_logit(ensemble, bounds)
+
+    # Anomalies from the ensemble means, scaled so their products are covariances
+    parameter_anomalies = (parameters - parameters.mean(axis=0)) / math.sqrt(n_members - 1)
+    simulated_anomalies = (simulated - simulated.mean(axis=0)) / math.sqrt(n_members - 1)
+
+    # Perturbed observations, one set per member
+    variances = inflation_factor * errors * errors
+    perturbed = observed + math.sqrt(inflation_factor) * errors * rng.standard_normal((n_members, len(observed)))
+
+    # K (d - D) = dM (I + dD^T R^-1 dD)^-1 dD^T R^-1 (d - D), with the diagonal error covariance R
+    weighted_anomalies = simulated_anomalies / variances
+    member_covariance = np.eye(n_members) + weighted_anomalies @ simulated_anomalies.T
+    innovations = weighted_anomalies @ (perturbed - simulated).T
+    parameters = parameters + (parameter_anomalies.T @ np.linalg.solve(member_covariance, innovations)).T
+
+    return from_logit(parameters, bounds)
+
+def to_logit(values, bounds):
+    """
+    Maps variable values inside their bounds onto the real line
+    :param values: Variable values (numpy array, ... by n_variables)
+    :param bounds: Lower and upper bound of each variable (numpy array, n_variables by 2)
+    :return: transformed values (numpy array)
+    """
+
+    import numpy as np
+
+    fractions = (values - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+    fractions = np.clip(fractions, 1e-9, 1 - 1e-9)
+
+    return np.log(fractions / (1 - fractions))
+
+def from_logit(values, bounds):
+    """
+    Maps transformed variable values back inside their bounds, see to_logit
+    :param values: Transformed values (numpy array, ... by n_variables)
+    :param bounds: Lower and upper bound of each variable (numpy array, n_variables by 2)
+    :return: variable values (numpy array)
+    """
+
+    import numpy as np
+
+    return bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) / (1 + np.exp(-values))
+
+def ensemble_table(ensemble, scores, run_ids, variable_names, iteration):
+    """
+    Makes a table of the members of an ensemble
+    :return: pandas dataframe with the iteration and the variable values, score and run id of each member
+    """
+
+    import pandas as pd
+
+    table = pd.DataFrame(ensemble, columns=variable_names)
+    table.insert(0, "iteration", iteration)
+    if scores is not None:
+        table["score"] = scores
+        table["run_id"] = run_ids
+
+    return table
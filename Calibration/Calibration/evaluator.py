@@ -0,0 +1,437 @@
+"""
+Code to score JULES runs for given variable values, for driving a calibration from any optimiser
+"""
+import os
+import time
+import threading
+from queue import Queue
+from logging import exception
+
+from Calibration.Calibration.setup_calibration_files import setup_tmp_folders, setup_worker_folders
+from Calibration.Calibration.optimise_variable import read_JULES_output, compare_to_obs
+from Calibration.Calibration.gridded_scoring import score_gridded_output, DEFAULT_MEMORY_BUDGET
+from Calibration.Calibration.input_staging import stage_inputs
+from Calibration.Namelist_management.Edit_variable import edit_variable
+from Calibration.Namelist_management.Read import read_variable
+from Calibration.Namelist_management.Outpur_nml_management import is_in_output
+from Calibration.Run_JULES.Run_JULES import run_JULES
+from Calibration.general.file_management import make_folder, delete_folder
+from Calibration.general.parallel import run_in_parallel
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.telemetry import CampaignMonitor
+from Calibration.general.tracing import span
+
+
+class JULESEvaluator:
+    """
+    Objective function of a calibration: the score of a JULES run against the observations for a vector of
+    variable values. It is set up once, with a temporary folder per worker, and then evaluates single points
+    with evaluate(x) or a matrix of points at the same time with evaluate_batch(X). Calling the evaluator
+    follows the scipy convention, so it can be given to scipy.optimize directly, including with
+    vectorized=True (a 2D x holds one point per column). Points can also be evaluated from several threads
+    at once, e.g. by optuna with n_jobs or a nevergrad executor, up to n_workers runs at a time.
+    Runs are named <run_id_prefix>_<n> and recorded as in optimise_variable.
+    """
+
+    def __init__(self,
+                 jules_executable_address,
+                 master_namelist_address,
+                 variable_names,
+                 variable_namelists,
+                 variable_namelist_files,
+                 observation_data,
+                 observational_variable_keys,
+                 jules_out_variable_keys,
+                 run_id_prefix,
+                 variable_formats = None,
+                 obs_variable_weights = None,
+                 output_folder = None,
+                 tmp_folder = None,
+                 overwrite_tmp_files = False,
+                 overwrite_output_files = False,
+                 append_to_run_info = False,
+                 n_workers = 1,
+                 output_cache = None,
+                 staging_folder = None,
+                 gridded_output = False,
+                 memory_budget = DEFAULT_MEMORY_BUDGET,
+                 failure_score = float("inf"),
+                 monitor = None,
+                 verbose = False):
+        """
+        Sets up the evaluator
+        :param jules_executable_address: Address of the JULES executable (str)
+        :param master_namelist_address: Address of the master namelist folder (str)
+        :param variable_names: Name of the variable to set (str) or list of variables to set (list of str)
+        :param variable_namelists: Namelist containing each variable (str or list of str)
+        :param variable_namelist_files: Namelist file containing each variable (str or list of str)
+        :param observation_data: Observations to compare to, as for optimise_variable
+        :param observational_variable_keys: Keys of the variables in the observation data used to assess model
+                                            (str or list of str)
+        :param jules_out_variable_keys: Keys of the variables in the JULES output file used to assess model
+                                        (str or list of str)
+        :param run_id_prefix: Prefix to add to the run ids (str)
+        :param variable_formats: Format string used to write each value, e.g. "5*{}" (list of str) (optional)
+        :param obs_variable_weights: Weights to apply to each compared variable (list of float) (optional)
+        :param output_folder: Address to save the run records in (str) (optional)
+        :param tmp_folder: Temporary folder to use (str) (optional)
+        :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+        :param overwrite_output_files: If True, overwrites an existing output folder (bool) (optional)
+        :param append_to_run_info: If True, appends to existing run records (bool) (optional)
+        :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+        :param output_cache: Cache used to reuse the output of any identical earlier run (OutputCache) (optional)
+        :param staging_folder: If given, the driving and ancillary files are staged to this node-local folder once
+                               and the runs read them from there, see stage_inputs (str) (optional)
+        :param gridded_output: If True, the output is scored a chunk at a time, see score_gridded_output (bool) (optional)
+        :param memory_budget: Memory allowed for the chunks of a gridded output being scored, in bytes (int) (optional)
+        :param failure_score: Score given to runs that fail or don't overlap the observations (float) (optional)
+        :param monitor: Monitor to report the progress of the runs to (CampaignMonitor) (optional)
+        :param verbose: If True, prints progress (bool) (optional)
+        """
+
+        # Manage the case where the user only wants to set one variable
+        if type(variable_names) is str:
+            variable_names = [variable_names]
+            variable_namelists = [variable_namelists]
+            variable_namelist_files = [variable_namelist_files]
+
+        if type(observational_variable_keys) is str:
+            observational_variable_keys = [observational_variable_keys]
+        if type(jules_out_variable_keys) is str:
+            jules_out_variable_keys = [jules_out_variable_keys]
+
+        if len(variable_names) != len(variable_namelists) or len(variable_names) != len(variable_namelist_files):
+            exception("ERROR: variable_names, variable_namelists and variable_namelist_files must be the same length.")
+        if len(observational_variable_keys) != len(jules_out_variable_keys):
+            exception("ERROR: obs_variable_keys and jules_out_variable_keys must be the same length.")
+
+        self.jules_executable_address = jules_executable_address
+        self.variable_names = variable_names
+        self.variable_namelists = variable_namelists
+        self.variable_namelist_files = variable_namelist_files
+        self.variable_formats = variable_formats if variable_formats is not None else ["{}"] * len(variable_names)
+        self.observational_variable_keys = observational_variable_keys
+        self.jules_out_variable_keys = jules_out_variable_keys
+        self.run_id_prefix = run_id_prefix
+        self.obs_variable_weights = obs_variable_weights
+        self.n_workers = n_workers
+        self.output_cache = output_cache
+        self.gridded_output = gridded_output
+        self.memory_budget = memory_budget
+        self.failure_score = failure_score
+        self.verbose = verbose
+
+        self.observation_data = observation_data if gridded_output else observation_data[observational_variable_keys]
+
+        # Read the driving and ancillary files from node-local copies
+        if staging_folder is not None:
+            master_namelist_address = stage_inputs(master_namelist_address, staging_folder)
+
+        # Set up a temporary folder for each worker
+        if tmp_folder is None:
+            tmp_folder = os.getcwd() + "/tmp/"
+        self.tmp_folder = setup_tmp_folders(master_namelist_address, tmp_folder, overwrite_tmp_files)
+        self._free_workers = Queue()
+        for worker_folder in setup_worker_folders(master_namelist_address, self.tmp_folder, n_workers,
+                                                  overwrite_tmp_files):
+            self._free_workers.put(worker_folder)
+
+        self.profile_name = read_variable(self.tmp_folder + "namelist/output.nml",
+                                          "jules_output_profile",
+                                          "profile_name").strip("'").strip('"')
+
+        if not is_in_output(jules_out_variable_keys, self.tmp_folder + "namelist/output.nml"):
+            exception("ERROR: One or more of jules_out_variable_keys ("
+                      + str(jules_out_variable_keys)
+                      + ") are not in the output namelist.")
+
+        # Setup output folder and run records
+        self.output_folder = None
+        self.results_store = None
+        if output_folder is not None:
+            self.output_folder = make_folder(output_folder, overwrite_existing=overwrite_output_files)
+
+            run_info_address = self.output_folder + run_id_prefix + "_run_info.sqlite"
+            if not append_to_run_info and os.path.isfile(run_info_address):
+                os.remove(run_info_address)
+
+            self.results_store = ResultsStore(run_info_address)
+
+        if monitor is None:
+            monitor = CampaignMonitor(run_id_prefix,
+                                      n_workers = n_workers,
+                                      log_address = self.output_folder + run_id_prefix + "_telemetry.jsonl"
+                                                    if self.output_folder is not None else None,
+                                      verbose = verbose)
+        self.monitor = monitor
+
+        self._lock = threading.Lock()
+        self.n_evaluations = 0
+
+        # Best point so far, as (values, score, run id)
+        self.best = None
+
+    def evaluate(self, x, return_output = False):
+        """
+        Runs JULES for one vector of variable values and scores it
+        :param x: Value of each variable (array like)
+        :param return_output: If True, also returns the run id and the JULES output compared to the observations
+                              (bool) (optional)
+        :return: score of the run (float), or failure_score if the run failed, and if return_output the run id
+                 (str) and pandas dataframe of the JULES output indexed by time, or None if the run failed or
+                 the output is gridded
+        """
+
+        score, _, current_run_id, JULES_data = self._evaluate(x)
+
+        if return_output:
+            return score, current_run_id, JULES_data
+
+        return score
+
+    def evaluate_objectives(self, x):
+        """
+        Runs JULES for one vector of variable values and scores each compared variable separately
+        :param x: Value of each variable (array like)
+        :return: RMSE of each variable in observational_variable_keys, all failure_score if the run failed
+                 (numpy array), run id (str)
+        """
+
+        import numpy as np
+
+        _, rmse_values, current_run_id, _ = self._evaluate(x)
+
+        if rmse_values is None:
+            return np.full(len(self.observational_variable_keys), self.failure_score), current_run_id
+
+        return np.asarray(rmse_values, dtype=float), current_run_id
+
+    def _evaluate(self, x):
+        """
+        Runs JULES for one vector of variable values in a free worker folder
+        :param x: Value of each variable (array like)
+        :return: score (float), or failure_score if the run failed, RMSE of each variable (list of float) or None,
+                 run id (str) and JULES output (pandas dataframe) or None
+        """
+
+        import numpy as np
+
+        values = [float(value) for value in np.ravel(x)]
+        if len(values) != len(self.variable_names):
+            raise ValueError(f"Expected {len(self.variable_names)} variable values, got {len(values)}")
+
+        with self._lock:
+            self.n_evaluations += 1
+            run_index = self.n_evaluations
+        current_run_id = f"{self.run_id_prefix}_{run_index}"
+
+        worker_folder = self._free_workers.get()
+        try:
+            with span("run", run_id = current_run_id):
+                score, rmse_values, JULES_data = self._run(worker_folder, current_run_id, run_index, values)
+        finally:
+            self._free_workers.put(worker_folder)
+
+        if score is None:
+            return self.failure_score, None, current_run_id, JULES_data
+
+        with self._lock:
+            if self.best is None or score < self.best[1]:
+                self.best = (values, score, current_run_id)
+
+        return score, rmse_values, current_run_id, JULES_data
+
+    def evaluate_batch(self, X, return_output = False):
+        """
+        Runs JULES for several vectors of variable values at the same time, n_workers at a time
+        :param X: Values of the variables, one row per point (array like, n_points by n_variables)
+        :param return_output: If True, also returns the run id and JULES output of each point, see evaluate
+                              (bool) (optional)
+        :return: score of each point (numpy array), and if return_output the run id (list of str) and JULES output
+                 (list) of each point
+        """
+
+        import numpy as np
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+
+        scores = np.empty(len(X))
+        run_ids = [None] * len(X)
+        outputs = [None] * len(X)
+        for i, (score, run_id, JULES_data) in run_in_parallel(lambda argument: (argument[0],
+                                                                                self.evaluate(argument[1],
+                                                                                              return_output = True)),
+                                                              enumerate(X),
+                                                              n_workers = self.n_workers):
+            scores[i] = score
+            run_ids[i] = run_id
+            outputs[i] = JULES_data
+
+        if return_output:
+            return scores, run_ids, outputs
+
+        return scores
+
+    def evaluate_objectives_batch(self, X):
+        """
+        Runs JULES for several vectors of variable values at the same time, n_workers at a time, scoring each
+        compared variable separately
+        :param X: Values of the variables, one row per point (array like, n_points by n_variables)
+        :return: RMSE of each variable for each point, see evaluate_objectives (numpy array, n_points by
+                 n_compared_variables), run id of each point (list of str)
+        """
+
+        import numpy as np
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+
+        objectives = np.empty((len(X), len(self.observational_variable_keys)))
+        run_ids = [None] * len(X)
+        for i, (point_objectives, run_id) in run_in_parallel(lambda argument: (argument[0],
+                                                                               self.evaluate_objectives(argument[1])),
+                                                             enumerate(X),
+                                                             n_workers = self.n_workers):
+            objectives[i] = point_objectives
+            run_ids[i] = run_id
+
+        return objectives, run_ids
+
+    def __call__(self, x):
+        """
+        Scores one point, or a point per column of a 2D array as scipy passes with vectorized=True
+        :param x: Value of each variable (array like), or n_variables by n_points array
+        :return: score (float) or score of each point (numpy array)
+        """
+
+        import numpy as np
+
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 2:
+            return self.evaluate_batch(x.T)
+
+        return self.evaluate(x)
+
+    def _run(self, worker_folder, current_run_id, run_index, values):
+        """
+        Runs JULES in a worker's temporary folder and scores the output
+        :param worker_folder: temporary folder of the worker running JULES (str)
+        :param current_run_id: run id to use for this run (str)
+        :param run_index: number of the run (int)
+        :param values: Value of each variable (list of float)
+        :return: score of the run (float), RMSE of each variable (list of float) and the JULES output (pandas
+                 dataframe), or None for each if the run failed
+        """
+
+        variable_values = [self.variable_formats[i].format(value) for i, value in enumerate(values)]
+        edit_variable([worker_folder + "namelist/" + file for file in self.variable_namelist_files],
+                      self.variable_namelists,
+                      self.variable_names,
+                      variable_values)
+        edit_variable(worker_folder + "namelist/output.nml",
+                      "jules_output",
+                      "run_id",
+                      "'" + current_run_id + "'")
+
+        self.monitor.run_started(current_run_id, sweep_index = run_index, worker = worker_folder)
+        start_time = time.time()
+
+        # Reuse the output of an identical earlier run if there is one
+        cache_key = None
+        returncode = 0
+        if self.output_cache is not None:
+            cache_key = self.output_cache.key(worker_folder + "namelist/", self.jules_executable_address)
+            if self.output_cache.fetch(cache_key, worker_folder + "output/", current_run_id):
+                cache_key = None
+            else:
+                returncode = run_JULES(self.jules_executable_address, worker_folder + "namelist/")
+        else:
+            returncode = run_JULES(self.jules_executable_address, worker_folder + "namelist/")
+        end_time = time.time()
+
+        # Move the outputs aside so the output folder is free for the next run
+        staging_folder = worker_folder + "output_" + current_run_id + "/"
+        os.rename(worker_folder + "output/", staging_folder)
+        os.mkdir(worker_folder + "output/")
+
+        output_address = staging_folder + current_run_id + "." + self.profile_name + ".nc"
+
+        # A crashed run can leave a truncated output, so isn't scored or cached
+        if returncode != 0:
+            print(f"JULES exited with code {returncode} for run_id {current_run_id}.")
+            status = "failed"
+        else:
+            status = "complete" if os.path.exists(output_address) else "failed"
+
+        score = None
+        rmse_values = None
+        JULES_data = None
+        if status == "complete":
+            if self.gridded_output:
+                result = score_gridded_output(output_address,
+                                              self.observation_data,
+                                              self.observational_variable_keys,
+                                              self.jules_out_variable_keys,
+                                              obs_variable_weights = self.obs_variable_weights,
+                                              memory_budget = self.memory_budget,
+                                              return_variable_rmse = True,
+                                              verbose = self.verbose)
+                if result is not None:
+                    score, rmse_values = result
+            else:
+                JULES_data = read_JULES_output(output_address, self.jules_out_variable_keys)
+                if len(JULES_data.index.intersection(self.observation_data.index)) > 0:
+                    score, rmse_values = compare_to_obs(self.observation_data,
+                                                        JULES_data,
+                                                        self.observational_variable_keys,
+                                                        self.jules_out_variable_keys,
+                                                        obs_variable_weights = self.obs_variable_weights,
+                                                        return_variable_rmse = True,
+                                                        verbose = self.verbose)
+                else:
+                    print(f"JULES output for run_id {current_run_id} doesn't overlap the observations.")
+
+        if self.output_cache is not None and cache_key is not None and status == "complete":
+            self.output_cache.store(cache_key, staging_folder, current_run_id)
+        delete_folder(staging_folder)
+
+        if self.results_store is not None:
+            self.results_store.add_run(current_run_id,
+                                       dict(zip(self.variable_names, variable_values)),
+                                       campaign = self.run_id_prefix,
+                                       sweep_index = run_index,
+                                       start_time = start_time,
+                                       end_time = end_time,
+                                       status = status,
+                                       score = score,
+                                       scores = dict(zip(self.observational_variable_keys, rmse_values))
+                                                if rmse_values is not None and len(rmse_values) > 1 else None)
+
+        self.monitor.run_finished(current_run_id,
+                                  start_time,
+                                  end_time,
+                                  status = status,
+                                  score = score,
+                                  sweep_index = run_index)
+
+        return score, rmse_values, JULES_data
+
+    def close(self):
+        """
+        Writes the run records and removes the temporary folders
+        """
+
+        self.monitor.close()
+
+        if self.results_store is not None:
+            self.results_store.export_csv(self.output_folder + self.run_id_prefix + "_run_info.csv")
+            self.results_store.close()
+            self.results_store = None
+
+        if os.path.isdir(self.tmp_folder):
+            delete_folder(self.tmp_folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,220 @@
+"""
+Scoring of gridded and multi-point JULES output against observations, streamed in chunks so the output
+never has to fit in memory
+"""
+from logging import exception
+
+from Calibration.general.tracing import traced
+
+# Default memory allowed for the chunks of output and observations being compared at any one time, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+
+# Memory used per compared value: the model value, the observation, the error and its validity
+BYTES_PER_VALUE = 32
+
+
+@traced()
+def score_gridded_output(output_address,
+                         observations,
+                         obs_variable_keys,
+                         jules_out_variable_keys,
+                         time_period = None,
+                         obs_variable_weights = None,
+                         memory_budget = DEFAULT_MEMORY_BUDGET,
+                         cell_rmse_out_address = None,
+                         return_variable_rmse = False,
+                         return_cell_rmse = False,
+                         verbose = False):
+    """
+    Compares a gridded or multi-point JULES output to observations a chunk at a time. The output is read in
+    blocks of rows (y) and time steps sized to fit the memory budget, and the squared errors are added up
+    for each grid cell, so only the chunk being compared and the per-cell totals are held in memory.
+    The error of each variable is the mean squared error over every matched cell and time, as in compare_to_obs.
+    :param output_address: Address of the JULES output file, with variables on (time, y, x) (str)
+    :param observations: Gridded observations, an xarray dataset or the address of a netCDF file with variables
+                         on (time, y, x) of the same grid as the output, or point observations, a pandas dataframe
+                         indexed by ("time", "y", "x"), where y and x are the grid indices of each observation.
+                         y and x are taken as 0 if not in the index, so a single point run can be scored against
+                         observations indexed by time. Missing observations (NaN) are ignored.
+    :param obs_variable_keys: Keys of the variables in the observations used to assess model (str or list of str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file used to assess model
+                                    (str or list of str)
+    :param time_period: Period to compare the data over (pandas datetime) (optional)
+    :param obs_variable_weights: Weights to apply to the variables in the observation data (list of float) (optional)
+    :param memory_budget: Memory allowed for the chunks being compared, in bytes (int) (optional)
+    :param cell_rmse_out_address: Address of a netCDF file to save the error of each grid cell in (str) (optional)
+    :param return_variable_rmse: If True, also returns the RMSE of each variable (bool) (optional)
+    :param return_cell_rmse: If True, also returns the error of each grid cell (bool) (optional)
+    :param verbose: If True, prints progress (bool) (optional)
+    :return: weighted mean RMSE (float), the RMSE of each variable (list of float) if return_variable_rmse and an
+             xarray dataset of the error and number of matched values of each grid cell if return_cell_rmse
+    """
+
+    import numpy as np
+    import pandas as pd
+    from xarray import open_dataset
+
+    if type(obs_variable_keys) is str:
+        obs_variable_keys = [obs_variable_keys]
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+
+    point_observations = isinstance(observations, pd.DataFrame)
+
+    opened_observations = None
+    if isinstance(observations, str):
+        observations = opened_observations = open_dataset(observations)
+
+    try:
+        with open_dataset(output_address) as dataset:
+            for jules_key in jules_out_variable_keys:
+                if dataset[jules_key].dims != ("time", "y", "x"):
+                    exception(f"ERROR: {jules_key} is on {dataset[jules_key].dims}, "
+                              + "only variables on (time, y, x) can be scored.")
+                    return None
+
+            n_y = dataset.sizes["y"]
+            n_x = dataset.sizes["x"]
+
+            # Match the observation times to the output times
+            model_times = pd.to_datetime(dataset["time"].values)
+            if point_observations:
+                index = observations.index
+                obs_times = pd.to_datetime(index.get_level_values("time" if "time" in index.names else 0))
+            else:
+                obs_times = pd.to_datetime(observations["time"].values)
+
+            model_positions = model_times.get_indexer(obs_times)
+            matched = model_positions >= 0
+            if time_period is not None:
+                matched &= (obs_times >= pd.to_datetime(time_period[0])) & (obs_times <= pd.to_datetime(time_period[1]))
+
+            if not matched.any():
+                exception(f"ERROR: Observation and JULES output ({output_address}) times don't match.")
+                return None
+
+            # Order the matched observations by output time, so the output is read forwards
+            obs_positions = np.flatnonzero(matched)
+            obs_positions = obs_positions[np.argsort(model_positions[obs_positions], kind="stable")]
+            model_positions = model_positions[obs_positions]
+
+            if point_observations:
+                obs_y = (index.get_level_values("y").to_numpy(dtype=int)[obs_positions]
+                         if "y" in index.names else np.zeros(len(obs_positions), dtype=int))
+                obs_x = (index.get_level_values("x").to_numpy(dtype=int)[obs_positions]
+                         if "x" in index.names else np.zeros(len(obs_positions), dtype=int))
+                obs_values = [observations[obs_key].to_numpy(dtype=float)[obs_positions]
+                              for obs_key in obs_variable_keys]
+
+                # Output times with at least one observation
+                chunk_times = np.unique(model_positions)
+            else:
+                obs_variables = [observations[obs_key].transpose("time", "y", "x") for obs_key in obs_variable_keys]
+                chunk_times = model_positions
+
+            # Size the chunks to fit the memory budget, at least one row of one time step at a time
+            n_values = max(memory_budget // BYTES_PER_VALUE, 1)
+            n_rows = min(n_y, max(n_values // n_x, 1))
+            n_steps = max(n_values // (n_rows * n_x), 1)
+
+            if verbose:
+                print(f"Scoring {output_address} in chunks of {n_steps} time steps by {n_rows} rows...")
+
+            # Sums of the squared errors and numbers of matched values of each variable in each grid cell
+            squared_errors = np.zeros((len(obs_variable_keys), n_y, n_x))
+            counts = np.zeros((len(obs_variable_keys), n_y, n_x), dtype=np.int64)
+
+            for row_start in range(0, n_y, n_rows):
+                rows = slice(row_start, min(row_start + n_rows, n_y))
+
+                for step_start in range(0, len(chunk_times), n_steps):
+                    steps = slice(step_start, step_start + n_steps)
+
+                    if point_observations:
+                        times = chunk_times[steps]
+                        first = np.searchsorted(model_positions, times[0], side="left")
+                        last = np.searchsorted(model_positions, times[-1], side="right")
+                        in_chunk = first + np.flatnonzero((obs_y[first:last] >= rows.start)
+                                                          & (obs_y[first:last] < rows.stop))
+                        if len(in_chunk) == 0:
+                            continue
+
+                        time_index = np.searchsorted(times, model_positions[in_chunk])
+                        cell_y = obs_y[in_chunk]
+                        cell_x = obs_x[in_chunk]
+
+                    for i, jules_key in enumerate(jules_out_variable_keys):
+                        if point_observations:
+                            model = dataset[jules_key].isel(time=times, y=rows).to_numpy().astype(float)
+                            errors = obs_values[i][in_chunk] - model[time_index, cell_y - rows.start, cell_x]
+                            valid = np.isfinite(errors)
+                            np.add.at(squared_errors[i], (cell_y[valid], cell_x[valid]), errors[valid] ** 2)
+                            np.add.at(counts[i], (cell_y[valid], cell_x[valid]), 1)
+                        else:
+                            model = dataset[jules_key].isel(time=chunk_times[steps], y=rows).to_numpy().astype(float)
+                            obs = obs_variables[i].isel(time=obs_positions[steps], y=rows).to_numpy().astype(float)
+                            errors = obs - model
+                            valid = np.isfinite(errors)
+                            errors[~valid] = 0
+                            squared_errors[i, rows] += (errors * errors).sum(axis=0)
+                            counts[i, rows] += valid.sum(axis=0)
+
+            # Keep the coordinates of the grid cells with their errors
+            cell_coords = {name: dataset[name].to_numpy() for name in ("latitude", "longitude")
+                           if name in dataset.variables and dataset[name].dims == ("y", "x")}
+    finally:
+        if opened_observations is not None:
+            opened_observations.close()
+
+    if obs_variable_weights is None:
+        obs_variable_weights = [1] * len(obs_variable_keys)
+
+    # Normalise the weights
+    total_weight = sum(obs_variable_weights)
+    obs_variable_weights = [w / total_weight for w in obs_variable_weights]
+
+    # Calculate the RMSE of each variable over every matched cell and time
+    rmse_values = []
+    mean_rmse = 0
+    for i in range(len(obs_variable_keys)):
+        n_matched = counts[i].sum()
+        rmse_values.append(float(squared_errors[i].sum() / n_matched) if n_matched > 0 else float("nan"))
+        mean_rmse += rmse_values[i] * obs_variable_weights[i]
+
+    cell_rmse = None
+    if return_cell_rmse or cell_rmse_out_address is not None:
+        cell_rmse = make_cell_rmse(obs_variable_keys, squared_errors, counts, cell_coords)
+
+        if cell_rmse_out_address is not None:
+            if verbose:
+                print(f"Saving grid cell RMSE values to {cell_rmse_out_address}...")
+            cell_rmse.to_netcdf(cell_rmse_out_address)
+
+    result = (mean_rmse,)
+    if return_variable_rmse:
+        result += (rmse_values,)
+    if return_cell_rmse:
+        result += (cell_rmse,)
+
+    return result if len(result) > 1 else mean_rmse
+
+def make_cell_rmse(obs_variable_keys, squared_errors, counts, cell_coords):
+    """
+    Makes a dataset of the error of each variable in each grid cell
+    :param obs_variable_keys: Keys of the variables in the observations (list of str)
+    :param squared_errors: Sum of the squared errors of each variable in each cell (numpy array on (variable, y, x))
+    :param counts: Number of matched values of each variable in each cell (numpy array on (variable, y, x))
+    :param cell_coords: latitude and longitude of the cells (dict of numpy arrays on (y, x))
+    :return: xarray dataset with <key> (RMSE) and <key>_count on (y, x) for each variable
+    """
+
+    import numpy as np
+    from xarray import Dataset
+
+    data_variables = {}
+    for i, obs_key in enumerate(obs_variable_keys):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            data_variables[obs_key] = (("y", "x"), np.where(counts[i] > 0, squared_errors[i] / counts[i], np.nan))
+        data_variables[obs_key + "_count"] = (("y", "x"), counts[i])
+
+    return Dataset(data_variables, coords={name: (("y", "x"), values) for name, values in cell_coords.items()})
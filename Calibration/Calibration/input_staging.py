@@ -0,0 +1,186 @@
+"""
+Code to stage the driving and ancillary files of a campaign to fast node-local storage
+"""
+import os
+import re
+import glob
+import shutil
+import hashlib
+import tempfile
+import threading
+
+# JULES file name template fields, e.g. met_%vv_%y4%m2.nc
+TEMPLATE_FIELD = re.compile(r"%(vv|y4|y2|m2|m1|mc|d2|d1)")
+
+# Quoted strings in a namelist line
+QUOTED_STRING = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+
+_staging_lock = threading.Lock()
+
+
+def default_staging_folder():
+    """
+    Gets the node-local folder inputs are staged to by default, under $TMPDIR or the system temporary folder
+    :return: folder address (str)
+    """
+
+    return os.path.join(os.environ.get("TMPDIR", tempfile.gettempdir()), "jules_staging") + "/"
+
+def stage_inputs(master_namelist_address, staging_folder = None, prewarm_only = False, verbose = True):
+    """
+    Stages every file the master namelists refer to (driving data, ancillaries, initial conditions, ...) once
+    to node-local storage, and makes a copy of the master namelists pointing at the staged files.
+    Templated driving file names are staged with every file matching the template. Files are staged to a
+    folder named after a hash of their source folder, so every campaign, run and worker on the node shares
+    one copy of each file, and a file is copied again if its size or modification time changes. Staging is
+    safe to run from several processes at once.
+    With prewarm_only, the files are only read ahead into the page cache and the master namelists are used
+    as they are.
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param staging_folder: Node-local folder to stage the files to, see default_staging_folder (str) (optional)
+    :param prewarm_only: If True, reads the files into the page cache instead of copying them (bool) (optional)
+    :param verbose: If True, prints the files staged (bool) (optional)
+    :return: address of the namelist folder to use as the master namelist folder (str)
+    """
+
+    if not master_namelist_address.endswith("/"):
+        master_namelist_address += "/"
+    if staging_folder is None:
+        staging_folder = default_staging_folder()
+    if not staging_folder.endswith("/"):
+        staging_folder += "/"
+
+    namelist_files = sorted(file for file in os.listdir(master_namelist_address) if file.endswith(".nml"))
+
+    # Stage the referenced files and rewrite the namelists to use them
+    namelists = {}
+    n_staged = 0
+    staged_bytes = 0
+    for file in namelist_files:
+        lines = []
+        with open(master_namelist_address + file, "r") as namelist:
+            for line in namelist:
+                for address in QUOTED_STRING.findall(line):
+                    address = address[0] or address[1]
+                    sources = input_files(master_namelist_address, address)
+                    if len(sources) == 0:
+                        continue
+
+                    if prewarm_only:
+                        for source in sources:
+                            staged_bytes += prewarm(source)
+                        n_staged += len(sources)
+                        continue
+
+                    staged_folders = set()
+                    for source in sources:
+                        staged_address, size = stage_file(source, staging_folder)
+                        staged_folders.add(os.path.dirname(staged_address))
+                        staged_bytes += size
+                    n_staged += len(sources)
+
+                    # Matches of a template share a folder, so the template still works
+                    if len(staged_folders) == 1:
+                        line = line.replace(address, staged_folders.pop() + "/" + os.path.basename(address))
+                lines.append(line)
+        namelists[file] = "".join(lines)
+
+    if verbose:
+        print(f"{'Pre-warmed' if prewarm_only else 'Staged'} {n_staged} input files ({staged_bytes} bytes)"
+              + ("" if prewarm_only else f" in {staging_folder}"))
+
+    if prewarm_only:
+        return master_namelist_address
+
+    # The staged namelists are shared by every campaign with the same inputs
+    key = hashlib.sha256()
+    for file in namelist_files:
+        key.update(file.encode())
+        key.update(namelists[file].encode())
+    staged_namelist_folder = staging_folder + "namelists_" + key.hexdigest()[:16] + "/"
+
+    with _staging_lock:
+        if not os.path.isdir(staged_namelist_folder):
+            partial_folder = staged_namelist_folder[:-1] + f".partial_{os.getpid()}_{threading.get_ident()}/"
+            os.makedirs(partial_folder, exist_ok=True)
+            for file in namelist_files:
+                with open(partial_folder + file, "w") as namelist:
+                    namelist.write(namelists[file])
+            try:
+                os.rename(partial_folder, staged_namelist_folder)
+            except OSError:
+                # Another process staged the same namelists first
+                shutil.rmtree(partial_folder, ignore_errors=True)
+
+    return staged_namelist_folder
+
+def input_files(namelist_folder, address):
+    """
+    Finds the input files a quoted namelist value refers to
+    :param namelist_folder: Folder of the namelist, which relative addresses are relative to (str)
+    :param address: The quoted value (str)
+    :return: addresses of the files, more than one for a template (list of str)
+    """
+
+    if address.strip() == "":
+        return []
+
+    full_address = os.path.join(namelist_folder, address)
+
+    if TEMPLATE_FIELD.search(address) is None:
+        return [full_address] if os.path.isfile(full_address) else []
+
+    # Templates are only staged if the template is in the file name, not the folder
+    if TEMPLATE_FIELD.search(os.path.dirname(address)) is not None:
+        print(f"Can't stage {address}, the template fields must be in the file name.")
+        return []
+
+    pattern = glob.escape(os.path.dirname(full_address)) + "/" + TEMPLATE_FIELD.sub("*", glob.escape(os.path.basename(address)))
+    return sorted(file for file in glob.glob(pattern) if os.path.isfile(file))
+
+def stage_file(source, staging_folder):
+    """
+    Copies a file to the staging folder, unless the same version of it is already there
+    :param source: Address of the file (str)
+    :param staging_folder: Node-local staging folder (str)
+    :return: address of the staged file (str), size of the file in bytes (int)
+    """
+
+    status = os.stat(source)
+    source_folder = os.path.dirname(os.path.abspath(source))
+    key = hashlib.sha256(source_folder.encode()).hexdigest()[:16]
+
+    # Files from one folder are staged to one folder, so templates still match
+    staged_folder = staging_folder + key + "/"
+    staged_address = staged_folder + os.path.basename(source)
+    os.makedirs(staged_folder, exist_ok=True)
+
+    # Copy again if the source has changed since it was staged
+    if os.path.isfile(staged_address):
+        staged_status = os.stat(staged_address)
+        if staged_status.st_size == status.st_size and staged_status.st_mtime_ns == status.st_mtime_ns:
+            return staged_address, status.st_size
+
+    # Copy to a temporary name first so a partly copied file is never used
+    partial_address = staged_address + f".partial_{os.getpid()}_{threading.get_ident()}"
+    shutil.copy2(source, partial_address)
+    os.replace(partial_address, staged_address)
+
+    return staged_address, status.st_size
+
+def prewarm(source):
+    """
+    Reads a file ahead into the page cache
+    :param source: Address of the file (str)
+    :return: size of the file in bytes (int)
+    """
+
+    size = os.path.getsize(source)
+    with open(source, "rb") as file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while file.read(1 << 24):
+                pass
+
+    return size
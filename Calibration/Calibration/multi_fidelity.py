@@ -0,0 +1,473 @@
+"""
+Code to optimise namelist variables by scoring candidates on short simulations and only running the best in full
+"""
+import os
+import math
+import time
+import threading
+from queue import Queue
+from datetime import datetime, timedelta
+from logging import exception
+
+from Calibration.Calibration.setup_calibration_files import setup_tmp_folders, setup_worker_folders
+from Calibration.Calibration.parameter_set_generators import latin_hypercube_parameter_sets
+from Calibration.Calibration.optimise_variable import read_JULES_output, compare_to_obs
+from Calibration.Calibration.gridded_scoring import score_gridded_output, DEFAULT_MEMORY_BUDGET
+from Calibration.Namelist_management.Edit_variable import edit_variable
+from Calibration.Namelist_management.Read import read_variable
+from Calibration.Run_JULES.Run_JULES import run_JULES
+from Calibration.general.file_management import make_folder, delete_folder
+from Calibration.general.parallel import run_in_parallel
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.telemetry import CampaignMonitor
+from Calibration.general.tracing import span
+
+# Format of the dates in the JULES time namelists
+JULES_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def optimise_multi_fidelity(jules_executable_address,
+                            master_namelist_address,
+                            variable_names,
+                            variable_namelists,
+                            variable_namelist_files,
+                            observation_data,
+                            observational_variable_keys,
+                            jules_out_variable_keys,
+                            run_id_prefix,
+                            variable_bounds,
+                            variable_formats = None,
+                            schedule = "successive_halving",
+                            n_candidates = 27,
+                            min_fraction = 1 / 9,
+                            reduction_factor = 3,
+                            low_fidelity_output_period = None,
+                            low_fidelity_spinup_cycles = None,
+                            obs_variable_weights = None,
+                            output_folder = None,
+                            tmp_folder = None,
+                            overwrite_tmp_files = False,
+                            overwrite_output_files = False,
+                            append_to_run_info = False,
+                            n_workers = 1,
+                            gridded_output = False,
+                            memory_budget = DEFAULT_MEMORY_BUDGET,
+                            seed = None,
+                            monitor = None,
+                            verbose = False):
+    """
+    Optimises namelist variables over a pool of candidates drawn from a Latin hypercube, scoring them first on
+    shortened simulations. The candidates are run from main_run_start for a fraction of the configured period
+    (by rewriting main_run_end in timesteps.nml), and only the best 1 / reduction_factor of them are promoted to
+    a run reduction_factor times longer, until the last few are run over the full period (successive halving).
+    With the "hyperband" schedule, several rounds of successive halving are run, from many candidates starting
+    on short runs to a few candidates run in full only. The best candidate is chosen from full length runs only.
+    Runs can also be made cheaper with coarser output or fewer spin up cycles below full fidelity.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param variable_names: Name of the variable to optimise (str) or list of variables to optimise (list of str)
+    :param variable_namelists: Namelist containing each variable (str or list of str)
+    :param variable_namelist_files: Namelist file containing each variable (str or list of str)
+    :param observation_data: Observations to compare to, as for optimise_variable
+    :param observational_variable_keys: Keys of the variables in the observation data used to assess model
+                                        (str or list of str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file used to assess model
+                                    (str or list of str)
+    :param run_id_prefix: Prefix to add to the run ids (str)
+    :param variable_bounds: Lower and upper bound of each variable (list of tuples)
+    :param variable_formats: Format string used to write each value, e.g. "5*{}" (list of str) (optional)
+    :param schedule: "successive_halving" or "hyperband" (str) (optional)
+    :param n_candidates: Number of candidates in the pool, for successive halving (int) (optional)
+    :param min_fraction: Shortest fraction of the simulation period candidates are run for (float) (optional)
+    :param reduction_factor: Factor by which the number of candidates falls, and the run length grows,
+                             from one rung to the next (int) (optional)
+    :param low_fidelity_output_period: output_period to use below full fidelity (int) (optional)
+    :param low_fidelity_spinup_cycles: max_spinup_cycles to use below full fidelity (int) (optional)
+    :param obs_variable_weights: Weights to apply to each compared variable (list of float) (optional)
+    :param output_folder: Address to save the run records in (str) (optional)
+    :param tmp_folder: Temporary folder to use (str) (optional)
+    :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+    :param overwrite_output_files: If True, overwrites an existing output folder (bool) (optional)
+    :param append_to_run_info: If True, appends to existing run records (bool) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param gridded_output: If True, the output is scored a chunk at a time, see score_gridded_output (bool) (optional)
+    :param memory_budget: Memory allowed for the chunks of a gridded output being scored, in bytes (int) (optional)
+    :param seed: Random seed used to draw the candidates (int) (optional)
+    :param monitor: Monitor to report the progress of the optimisation to (CampaignMonitor) (optional)
+    :param verbose: If True, prints progress (bool) (optional)
+    :return: pandas dataframe of the candidates run over the full period, with their variable values, score and
+             run id, best first
+    """
+
+    import pandas as pd
+
+    # -- Setup ---------------------------------------------------------------------------------
+
+    # Manage the case where the user only wants to optimise one variable
+    if type(variable_names) is str:
+        variable_names = [variable_names]
+        variable_namelists = [variable_namelists]
+        variable_namelist_files = [variable_namelist_files]
+        variable_bounds = [variable_bounds] if type(variable_bounds[0]) not in (list, tuple) else variable_bounds
+
+    if type(observational_variable_keys) is str:
+        observational_variable_keys = [observational_variable_keys]
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+
+    if variable_formats is None:
+        variable_formats = ["{}"] * len(variable_names)
+
+    if schedule not in ("successive_halving", "hyperband"):
+        exception(f"ERROR: Unknown schedule ({schedule}).\n")
+        return None
+
+    # Run lengths of the rungs, as fractions of the full period, shortest first
+    n_rungs = 1 + int(math.floor(math.log(1 / min_fraction, reduction_factor) + 1e-9))
+    fractions = [reduction_factor ** (rung - n_rungs + 1) for rung in range(n_rungs)]
+
+    # Rounds of successive halving, as (number of candidates, run length fractions)
+    if schedule == "hyperband":
+        brackets = []
+        for n_skipped in range(n_rungs):
+            bracket_rungs = n_rungs - n_skipped
+            brackets.append((int(math.ceil(n_rungs / bracket_rungs * reduction_factor ** (bracket_rungs - 1))),
+                             fractions[n_skipped:]))
+    else:
+        brackets = [(n_candidates, fractions)]
+
+    # Set up a temporary folder for each worker
+    if tmp_folder is None:
+        tmp_folder = os.getcwd() + "/tmp/"
+    tmp_folder = setup_tmp_folders(master_namelist_address, tmp_folder, overwrite_tmp_files)
+    worker_folders = setup_worker_folders(master_namelist_address, tmp_folder, n_workers, overwrite_tmp_files)
+
+    free_workers = Queue()
+    for worker_folder in worker_folders:
+        free_workers.put(worker_folder)
+
+    profile_name = read_variable(tmp_folder + "namelist/output.nml",
+                                 "jules_output_profile",
+                                 "profile_name").strip("'").strip('"')
+
+    # Fidelity settings of the full runs, to put back between the shorter ones
+    simulation_period = read_simulation_period(tmp_folder + "namelist/timesteps.nml")
+    full_output_period = None
+    if low_fidelity_output_period is not None:
+        full_output_period = read_variable(tmp_folder + "namelist/output.nml", "jules_output_profile", "output_period")
+    full_spinup_cycles = None
+    if low_fidelity_spinup_cycles is not None:
+        full_spinup_cycles = read_variable(tmp_folder + "namelist/timesteps.nml", "jules_spinup", "max_spinup_cycles")
+
+    # Setup output folder and run records
+    results_store = None
+    if output_folder is not None:
+        output_folder = make_folder(output_folder, overwrite_existing=overwrite_output_files)
+
+        run_info_address = output_folder + run_id_prefix + "_run_info.sqlite"
+        if not append_to_run_info and os.path.isfile(run_info_address):
+            os.remove(run_info_address)
+
+        results_store = ResultsStore(run_info_address)
+
+    if monitor is None:
+        monitor = CampaignMonitor(run_id_prefix,
+                                  n_runs = sum(count_runs(n, len(bracket_fractions), reduction_factor)
+                                               for n, bracket_fractions in brackets),
+                                  n_workers = n_workers,
+                                  log_address = output_folder + run_id_prefix + "_telemetry.jsonl"
+                                                if output_folder is not None else None,
+                                  verbose = verbose)
+
+    observation_data = observation_data[observational_variable_keys]
+
+    run_counter = [0]
+    run_counter_lock = threading.Lock()
+
+    def evaluate(arguments):
+        bracket, rung, fraction, values = arguments
+
+        with run_counter_lock:
+            run_counter[0] += 1
+            run_index = run_counter[0]
+        current_run_id = f"{run_id_prefix}_b{bracket}r{rung}_{run_index}"
+
+        worker_folder = free_workers.get()
+        try:
+            with span("run", run_id = current_run_id, fidelity = fraction):
+                score = run_candidate(jules_executable_address,
+                                      worker_folder,
+                                      current_run_id,
+                                      profile_name,
+                                      variable_names,
+                                      variable_namelists,
+                                      variable_namelist_files,
+                                      [variable_formats[i].format(value) for i, value in enumerate(values)],
+                                      fraction,
+                                      simulation_period,
+                                      observation_data,
+                                      observational_variable_keys,
+                                      jules_out_variable_keys,
+                                      low_fidelity_output_period = low_fidelity_output_period,
+                                      full_output_period = full_output_period,
+                                      low_fidelity_spinup_cycles = low_fidelity_spinup_cycles,
+                                      full_spinup_cycles = full_spinup_cycles,
+                                      obs_variable_weights = obs_variable_weights,
+                                      gridded_output = gridded_output,
+                                      memory_budget = memory_budget,
+                                      results_store = results_store,
+                                      monitor = monitor,
+                                      sweep_index = run_index,
+                                      verbose = verbose)
+        finally:
+            free_workers.put(worker_folder)
+
+        return values, score, current_run_id
+
+    # -- Optimisation --------------------------------------------------------------------------
+    full_runs = []
+    for bracket, (n_bracket_candidates, bracket_fractions) in enumerate(brackets):
+
+        # Draw the candidate pool of the bracket
+        candidates = [[float(value) for value in values]
+                      for values in latin_hypercube_parameter_sets(variable_bounds,
+                                                                   n_samples = n_bracket_candidates,
+                                                                   batch_size = n_bracket_candidates,
+                                                                   seed = None if seed is None else seed + bracket)]
+
+        for rung, fraction in enumerate(bracket_fractions):
+            print(f"Bracket {bracket}, rung {rung}: running {len(candidates)} candidates "
+                  + f"for {fraction:.3g} of the simulation period")
+
+            results = list(run_in_parallel(evaluate,
+                                           [(bracket, rung, fraction, values) for values in candidates],
+                                           n_workers = n_workers))
+
+            # Failed runs go to the back
+            results.sort(key=lambda result: result[1] if not math.isnan(result[1]) else math.inf)
+
+            if fraction >= 1:
+                full_runs.extend(results)
+                break
+
+            # Promote the best candidates to longer runs
+            n_promoted = max(len(candidates) // reduction_factor, 1)
+            candidates = [values for values, score, _ in results[:n_promoted]]
+
+    # -- Clean up ------------------------------------------------------------------------------
+    monitor.close()
+
+    if results_store is not None:
+        results_store.export_csv(output_folder + run_id_prefix + "_run_info.csv")
+        results_store.close()
+
+    delete_folder(tmp_folder)
+
+    # Only full length runs are used for the result
+    full_runs.sort(key=lambda result: result[1] if not math.isnan(result[1]) else math.inf)
+    full_results = pd.DataFrame([values for values, _, _ in full_runs], columns=variable_names)
+    full_results["score"] = [score for _, score, _ in full_runs]
+    full_results["run_id"] = [run_id for _, _, run_id in full_runs]
+
+    if len(full_runs) > 0:
+        print(f"Best full length run {full_runs[0][2]}: score {full_runs[0][1]}, "
+              + ", ".join(f"{name} = {value}" for name, value in zip(variable_names, full_runs[0][0])))
+
+    return full_results
+
+def count_runs(n_candidates, n_rungs, reduction_factor):
+    """
+    Counts the runs made by one round of successive halving
+    :param n_candidates: Number of candidates in the first rung (int)
+    :param n_rungs: Number of rungs (int)
+    :param reduction_factor: Factor by which the number of candidates falls each rung (int)
+    :return: number of runs (int)
+    """
+
+    n_runs = 0
+    for _ in range(n_rungs):
+        n_runs += n_candidates
+        n_candidates = max(n_candidates // reduction_factor, 1)
+
+    return n_runs
+
+def read_simulation_period(timesteps_file):
+    """
+    Reads the main run period and timestep length from a timesteps namelist file
+    :param timesteps_file: Address of timesteps.nml (str)
+    :return: main run start (datetime), main run end (datetime), timestep length in seconds (float)
+    """
+
+    start = read_variable(timesteps_file, "jules_time", "main_run_start").strip().strip(",").strip("'").strip('"')
+    end = read_variable(timesteps_file, "jules_time", "main_run_end").strip().strip(",").strip("'").strip('"')
+    timestep_len = read_variable(timesteps_file, "jules_time", "timestep_len").strip().strip(",")
+
+    return datetime.strptime(start, JULES_DATE_FORMAT), datetime.strptime(end, JULES_DATE_FORMAT), float(timestep_len)
+
+def set_fidelity(worker_folder,
+                 fraction,
+                 simulation_period,
+                 low_fidelity_output_period = None,
+                 full_output_period = None,
+                 low_fidelity_spinup_cycles = None,
+                 full_spinup_cycles = None):
+    """
+    Sets the run length, output period and spin up of a worker's namelists for a fidelity
+    :param worker_folder: temporary folder of the worker (str)
+    :param fraction: Fraction of the simulation period to run, 1 for a full run (float)
+    :param simulation_period: main run start, main run end and timestep length from read_simulation_period (tuple)
+    :param low_fidelity_output_period: output_period to use below full fidelity (int) (optional)
+    :param full_output_period: output_period of the full runs (str) (optional)
+    :param low_fidelity_spinup_cycles: max_spinup_cycles to use below full fidelity (int) (optional)
+    :param full_spinup_cycles: max_spinup_cycles of the full runs (str) (optional)
+    """
+
+    start, end, timestep_len = simulation_period
+    full_fidelity = fraction >= 1
+
+    # Shorten the run to a whole number of timesteps
+    n_timesteps = max(int((end - start).total_seconds() * min(fraction, 1) // timestep_len), 1)
+    run_end = start + timedelta(seconds=n_timesteps * timestep_len) if not full_fidelity else end
+
+    edit_variable(worker_folder + "namelist/timesteps.nml",
+                  "jules_time",
+                  "main_run_end",
+                  "'" + run_end.strftime(JULES_DATE_FORMAT) + "'")
+
+    if low_fidelity_output_period is not None:
+        edit_variable(worker_folder + "namelist/output.nml",
+                      "jules_output_profile",
+                      "output_period",
+                      full_output_period if full_fidelity else str(low_fidelity_output_period))
+
+    if low_fidelity_spinup_cycles is not None:
+        edit_variable(worker_folder + "namelist/timesteps.nml",
+                      "jules_spinup",
+                      "max_spinup_cycles",
+                      full_spinup_cycles if full_fidelity else str(low_fidelity_spinup_cycles))
+
+def run_candidate(jules_executable_address,
+                  worker_folder,
+                  current_run_id,
+                  profile_name,
+                  variable_names,
+                  variable_namelists,
+                  variable_namelist_files,
+                  variable_values,
+                  fraction,
+                  simulation_period,
+                  observation_data,
+                  observational_variable_keys,
+                  jules_out_variable_keys,
+                  low_fidelity_output_period = None,
+                  full_output_period = None,
+                  low_fidelity_spinup_cycles = None,
+                  full_spinup_cycles = None,
+                  obs_variable_weights = None,
+                  gridded_output = False,
+                  memory_budget = DEFAULT_MEMORY_BUDGET,
+                  results_store = None,
+                  monitor = None,
+                  sweep_index = None,
+                  verbose = False):
+    """
+    Runs JULES for one candidate at one fidelity and scores it against the observations
+    :param worker_folder: temporary folder of the worker running JULES (str)
+    :param current_run_id: run id to use for this run (str)
+    :param variable_values: Values to set the variables to (list of str)
+    :param fraction: Fraction of the simulation period to run (float)
+    :return: score of the run (float), NaN if JULES failed or the run doesn't overlap the observations
+    """
+
+    import numpy as np
+
+    set_fidelity(worker_folder,
+                 fraction,
+                 simulation_period,
+                 low_fidelity_output_period = low_fidelity_output_period,
+                 full_output_period = full_output_period,
+                 low_fidelity_spinup_cycles = low_fidelity_spinup_cycles,
+                 full_spinup_cycles = full_spinup_cycles)
+
+    edit_variable([worker_folder + "namelist/" + file for file in variable_namelist_files],
+                  variable_namelists,
+                  variable_names,
+                  variable_values)
+    edit_variable(worker_folder + "namelist/output.nml",
+                  "jules_output",
+                  "run_id",
+                  "'" + current_run_id + "'")
+
+    if monitor is not None:
+        monitor.run_started(current_run_id, sweep_index = sweep_index, worker = worker_folder)
+    start_time = time.time()
+
+    returncode = run_JULES(jules_executable_address,
+                           worker_folder + "namelist/",
+                           terminal_output_address = worker_folder + "output/" + current_run_id + "." + profile_name + ".out")
+    end_time = time.time()
+
+    # Move the outputs aside so the output folder is free for the next run
+    staging_folder = worker_folder + "output_" + current_run_id + "/"
+    os.rename(worker_folder + "output/", staging_folder)
+    os.mkdir(worker_folder + "output/")
+
+    output_address = staging_folder + current_run_id + "." + profile_name + ".nc"
+
+    # A crashed run can leave a truncated output, so isn't scored
+    if returncode != 0:
+        print(f"JULES exited with code {returncode} for run_id {current_run_id}.")
+        status = "failed"
+    else:
+        status = "complete" if os.path.exists(output_address) else "failed"
+
+    score = float("nan")
+    rmse_values = None
+    if status == "complete":
+        if gridded_output:
+            result = score_gridded_output(output_address,
+                                          observation_data,
+                                          observational_variable_keys,
+                                          jules_out_variable_keys,
+                                          obs_variable_weights = obs_variable_weights,
+                                          memory_budget = memory_budget,
+                                          return_variable_rmse = True,
+                                          verbose = verbose)
+            if result is not None:
+                score, rmse_values = result
+        else:
+            JULES_data = read_JULES_output(output_address, jules_out_variable_keys)
+
+            # Short runs may end before the first observation
+            if len(JULES_data.index.intersection(observation_data.index)) > 0:
+                score, rmse_values = compare_to_obs(observation_data,
+                                                    JULES_data,
+                                                    observational_variable_keys,
+                                                    jules_out_variable_keys,
+                                                    obs_variable_weights = obs_variable_weights,
+                                                    return_variable_rmse = True,
+                                                    verbose = verbose)
+
+    delete_folder(staging_folder)
+
+    if results_store is not None:
+        results_store.add_run(current_run_id,
+                              dict(zip(variable_names, variable_values)),
+                              campaign = "_".join(current_run_id.split("_")[:-1]),
+                              sweep_index = sweep_index,
+                              start_time = start_time,
+                              end_time = end_time,
+                              status = status,
+                              score = score if not np.isnan(score) else None,
+                              scores = dict(zip(observational_variable_keys, rmse_values))
+                                       if rmse_values is not None and len(rmse_values) > 1 else None)
+
+    if monitor is not None:
+        monitor.run_finished(current_run_id,
+                             start_time,
+                             end_time,
+                             status = status,
+                             score = score if not np.isnan(score) else None,
+                             sweep_index = sweep_index)
+
+    return score
@@ -0,0 +1,381 @@
+"""
+Code to calibrate shared namelist variables jointly against observations from several sites
+"""
+import os
+import time
+import threading
+from logging import exception
+from concurrent.futures import ThreadPoolExecutor
+
+from Calibration.Calibration.setup_calibration_files import setup_tmp_folders
+from Calibration.Calibration.optimise_variable import calc_rmse_for_given_values
+from Calibration.general.file_management import make_folder, delete_folder
+from Calibration.Namelist_management.Read import read_variable
+from Calibration.Namelist_management.Outpur_nml_management import is_in_output
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.pipeline import PostProcessingPipeline
+from Calibration.general.telemetry import CampaignMonitor
+from Calibration.general.tracing import traced
+from Calibration.Calibration.gridded_scoring import DEFAULT_MEMORY_BUDGET
+
+
+def optimise_multi_site(jules_executable_address,
+                        sites,
+                        variable_names,
+                        variable_namelists,
+                        variable_namelist_files,
+                        observational_variable_keys,
+                        jules_out_variable_keys,
+                        run_id_prefix,
+                        max_iter = 100,
+                        variable_initial_values = None,
+                        variable_bounds = None,
+                        obs_variable_weights = None,
+                        output_folder = None,
+                        overwrite_tmp_files = False,
+                        overwrite_output_files = False,
+                        append_to_run_info = False,
+                        save_rmse = False,
+                        save_run_time = False,
+                        minimize_method = "Nelder-Mead",
+                        n_workers = None,
+                        output_cache = None,
+                        post_processing_threads = 1,
+                        monitor = None,
+                        gridded_output = False,
+                        memory_budget = DEFAULT_MEMORY_BUDGET,
+                        verbose = False):
+    """
+    Optimises namelist variables shared by several sites. Each candidate set of values is run at every site
+    at the same time, each site in its own temporary folder, and the per-site errors are combined using the
+    site weights. Sites are started longest first, so the slowest site doesn't set the time of each evaluation.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param sites: The sites to calibrate against (list of dict), each with the keys
+                  "name": name of the site, used in its run ids (str)
+                  "master_namelist_address": master namelist folder of the site (str)
+                  "observation_data": pandas dataframe of the site's observations, or with gridded_output
+                                      any observations score_gridded_output takes, e.g. a netCDF address
+                  "weight": weight of the site's error (float) (optional, defaults to 1)
+                  "tmp_folder": temporary folder of the site (str) (optional)
+    :param variable_names: Name of the variable to optimise (str) or list of variables to optimise (list of str)
+    :param variable_namelists: Namelist containing each variable (str or list of str)
+    :param variable_namelist_files: Namelist file containing each variable (str or list of str)
+    :param observational_variable_keys: Keys of the variables in the observation data used to assess model
+                                        (str or list of str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output files used to assess model
+                                    (str or list of str)
+    :param run_id_prefix: Prefix to add to the run ids (str)
+    :param max_iter: Maximum number of iterations of the minimiser (int) (optional)
+    :param variable_initial_values: Initial values of the variables, read from the first site's
+                                    namelists if not given (list of float) (optional)
+    :param variable_bounds: Limits of the variables (list of tuples) (optional)
+    :param obs_variable_weights: Weights to apply to each compared variable (list of float) (optional)
+    :param output_folder: Address to save the run records in (str) (optional)
+    :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+    :param overwrite_output_files: If True, overwrites an existing output folder (bool) (optional)
+    :param append_to_run_info: If True, appends to existing run records (bool) (optional)
+    :param save_rmse: If True, records the error of each run (bool) (optional)
+    :param save_run_time: If True, records the run time of each run (bool) (optional)
+    :param minimize_method: scipy minimize method (str) (optional)
+    :param n_workers: Number of sites to run at the same time, defaults to every site (int) (optional)
+    :param output_cache: Cache shared between campaigns, used to reuse the output of any identical earlier run
+                         instead of running JULES again (OutputCache) (optional)
+    :param post_processing_threads: Number of background threads caching, clearing and recording finished runs
+                                    (int) (optional)
+    :param monitor: Monitor to report the progress of the optimisation to (CampaignMonitor) (optional)
+    :param gridded_output: If True, the site outputs are gridded or multi-point and are scored a chunk at a time,
+                           see score_gridded_output (bool) (optional)
+    :param memory_budget: Memory allowed for the chunks of a gridded output being scored, in bytes (int) (optional)
+    :param verbose: If True, prints progress (bool) (optional)
+    :return: scipy optimisation result
+    """
+
+    from scipy.optimize import minimize
+
+    # -- Setup ---------------------------------------------------------------------------------
+
+    # Manage the case where the user only wants to optimise one variable
+    if type(variable_names) is str:
+        variable_names = [variable_names]
+        variable_namelists = [variable_namelists]
+        variable_namelist_files = [variable_namelist_files]
+
+    if type(observational_variable_keys) is str:
+        observational_variable_keys = [observational_variable_keys]
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+
+    if len(observational_variable_keys) != len(jules_out_variable_keys):
+        exception("ERROR: obs_variable_keys and jules_out_variable_keys must be the same length.")
+        return None
+
+    if len(sites) == 0:
+        exception("ERROR: No sites to calibrate against.")
+        return None
+
+    if n_workers is None:
+        n_workers = len(sites)
+
+    # Set up a temporary folder for each site
+    site_states = [setup_site(site,
+                              variable_namelist_files,
+                              observational_variable_keys,
+                              jules_out_variable_keys,
+                              run_id_prefix,
+                              overwrite_tmp_files)
+                   for site in sites]
+
+    # Read the initial values of the variables from the first site if not provided
+    if variable_initial_values is None:
+        variable_initial_values = []
+        for i, name in enumerate(variable_names):
+            value = read_variable(site_states[0]["variable_namelist_files"][i], variable_namelists[i], name)
+            if '*' in value:
+                variable_initial_values.append(float(value.split('*')[1]))
+            else:
+                variable_initial_values.append(float(value.split(",")[0]))
+
+    # Setup output folder and run records
+    results_store = None
+    if output_folder is not None:
+        output_folder = make_folder(output_folder, overwrite_existing=overwrite_output_files)
+
+        run_info_address = output_folder + run_id_prefix + "_run_info.sqlite"
+        if not append_to_run_info and os.path.isfile(run_info_address):
+            os.remove(run_info_address)
+
+        results_store = ResultsStore(run_info_address)
+
+    if monitor is None:
+        monitor = CampaignMonitor(run_id_prefix,
+                                  n_workers = n_workers,
+                                  log_address = output_folder + run_id_prefix + "_telemetry.jsonl"
+                                                if output_folder is not None else None,
+                                  verbose = verbose)
+
+    pipeline = None
+    if post_processing_threads > 0:
+        pipeline = PostProcessingPipeline(n_threads = post_processing_threads,
+                                          max_pending = 2 * max(post_processing_threads, len(sites)))
+
+    # -- Optimisation --------------------------------------------------------------------------
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        result = minimize(calc_multi_site_rmse,
+                          x0 = variable_initial_values,
+                          args = (site_states,
+                                  variable_names,
+                                  variable_namelists,
+                                  jules_executable_address,
+                                  observational_variable_keys,
+                                  jules_out_variable_keys,
+                                  executor,
+                                  [run_id_prefix + "_0"],
+                                  results_store,
+                                  save_rmse,
+                                  save_run_time,
+                                  obs_variable_weights,
+                                  verbose,
+                                  output_cache,
+                                  pipeline,
+                                  monitor,
+                                  gridded_output,
+                                  memory_budget),
+                          bounds = variable_bounds,
+                          method = minimize_method,
+                          options = {"maxiter": max_iter})
+
+    # -- Clean up ------------------------------------------------------------------------------
+    monitor.close()
+
+    if pipeline is not None:
+        pipeline.close()
+
+    if results_store is not None:
+        results_store.export_csv(output_folder + run_id_prefix + "_run_info.csv")
+        results_store.close()
+
+    for site_state in site_states:
+        delete_folder(site_state["tmp_folder"])
+
+    return result
+
+def setup_site(site,
+               variable_namelist_files,
+               observational_variable_keys,
+               jules_out_variable_keys,
+               run_id_prefix,
+               overwrite_tmp_files = False):
+    """
+    Sets up the temporary folder of a site and collects what is needed to run it
+    :param site: The site (dict), see optimise_multi_site
+    :param variable_namelist_files: Namelist files containing the variables (list of str)
+    :param observational_variable_keys: Keys of the variables in the observation data (list of str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file (list of str)
+    :param run_id_prefix: Prefix to add to the run ids (str)
+    :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+    :return: state of the site (dict)
+    """
+
+    import pandas as pd
+
+    # Gridded observations given as an xarray dataset or netCDF address are used as they are
+    observation_data = site["observation_data"]
+    if isinstance(observation_data, pd.DataFrame):
+        observation_data = observation_data[observational_variable_keys]
+
+    tmp_folder = site.get("tmp_folder")
+    if tmp_folder is None:
+        tmp_folder = os.getcwd() + f"/tmp_{site['name']}/"
+
+    tmp_folder = setup_tmp_folders(site["master_namelist_address"], tmp_folder, overwrite_tmp_files)
+
+    # Get the output profile name
+    profile_name = read_variable(tmp_folder + "namelist/output.nml",
+                                 "jules_output_profile",
+                                 "profile_name").strip("'").strip('"')
+
+    if not is_in_output(jules_out_variable_keys, tmp_folder + "namelist/output.nml"):
+        exception(f"ERROR: One or more of jules_out_variable_keys ({jules_out_variable_keys}) "
+                  + f"are not in the output namelist of site {site['name']}.")
+
+    return {"name": site["name"],
+            "weight": site.get("weight", 1),
+            "tmp_folder": tmp_folder,
+            "profile_name": profile_name,
+            "observation_data": observation_data,
+            "variable_namelist_files": [tmp_folder + "namelist/" + file for file in variable_namelist_files],
+            "run_id": [f"{run_id_prefix}_{site['name']}_0"],
+            "evaluation_time": None,
+            "lock": threading.Lock()}
+
+@traced("multi_site_run")
+def calc_multi_site_rmse(variable_values,
+                         site_states,
+                         variable_names,
+                         variable_namelists,
+                         jules_executable_address,
+                         observational_variable_keys,
+                         jules_out_variable_keys,
+                         executor,
+                         current_run_id,
+                         results_store = None,
+                         save_rmse = False,
+                         save_run_time = False,
+                         obs_variable_weights = None,
+                         verbose = False,
+                         output_cache = None,
+                         pipeline = None,
+                         monitor = None,
+                         gridded_output = False,
+                         memory_budget = DEFAULT_MEMORY_BUDGET):
+    """
+    Function used in minimisation to calculate the weighted error over every site for a set of variable values
+    :param variable_values: Values of the variables (list of float)
+    :param site_states: State of each site from setup_site (list of dict)
+    :param executor: Thread pool running the sites (ThreadPoolExecutor)
+    :param current_run_id: Run id of the last evaluation, updated in place (list of one str)
+    :return: weighted mean error over the sites (float)
+    """
+
+    current_run_id[0] = "_".join(current_run_id[0].split("_")[:-1]) + "_" + str(int(current_run_id[0].split("_")[-1]) + 1)
+    start_time = time.time()
+
+    # Start the sites that took longest last time first, sites not yet timed go first of all
+    ordered_sites = sorted(site_states,
+                           key=lambda site_state: -site_state["evaluation_time"]
+                                                  if site_state["evaluation_time"] is not None else -float("inf"))
+
+    futures = {site_state["name"]: executor.submit(run_site,
+                                                   site_state,
+                                                   variable_values,
+                                                   variable_names,
+                                                   variable_namelists,
+                                                   jules_executable_address,
+                                                   observational_variable_keys,
+                                                   jules_out_variable_keys,
+                                                   results_store,
+                                                   save_rmse,
+                                                   save_run_time,
+                                                   obs_variable_weights,
+                                                   verbose,
+                                                   output_cache,
+                                                   pipeline,
+                                                   monitor,
+                                                   gridded_output,
+                                                   memory_budget)
+               for site_state in ordered_sites}
+
+    # Combine the site errors using the site weights
+    site_rmse = {name: future.result() for name, future in futures.items()}
+    total_weight = sum(site_state["weight"] for site_state in site_states)
+    rmse = sum(site_rmse[site_state["name"]] * site_state["weight"] for site_state in site_states) / total_weight
+
+    if verbose:
+        print(f"{current_run_id[0]}: {rmse} ({site_rmse})")
+
+    # Record the evaluation with the error of each site
+    if results_store is not None:
+        results_store.add_run(current_run_id[0],
+                              dict(zip(variable_names, variable_values)),
+                              campaign = "_".join(current_run_id[0].split("_")[:-1]),
+                              sweep_index = int(current_run_id[0].split("_")[-1]),
+                              start_time = start_time,
+                              end_time = time.time() if save_run_time else None,
+                              score = rmse,
+                              scores = site_rmse)
+
+    return rmse
+
+def run_site(site_state,
+             variable_values,
+             variable_names,
+             variable_namelists,
+             jules_executable_address,
+             observational_variable_keys,
+             jules_out_variable_keys,
+             results_store = None,
+             save_rmse = False,
+             save_run_time = False,
+             obs_variable_weights = None,
+             verbose = False,
+             output_cache = None,
+             pipeline = None,
+             monitor = None,
+             gridded_output = False,
+             memory_budget = DEFAULT_MEMORY_BUDGET):
+    """
+    Runs JULES at one site for a set of variable values and compares it to the site's observations
+    :param site_state: State of the site from setup_site (dict)
+    :return: error at the site (float)
+    """
+
+    # A site's temporary folder can only be used by one run at a time
+    with site_state["lock"]:
+        start_time = time.time()
+
+        rmse = calc_rmse_for_given_values(variable_values,
+                                          variable_names,
+                                          variable_namelists,
+                                          site_state["variable_namelist_files"],
+                                          site_state["tmp_folder"],
+                                          jules_executable_address,
+                                          None,
+                                          site_state["run_id"],
+                                          site_state["profile_name"],
+                                          site_state["observation_data"],
+                                          observational_variable_keys,
+                                          jules_out_variable_keys,
+                                          results_store = results_store,
+                                          save_rmse = save_rmse,
+                                          save_run_time = save_run_time,
+                                          obs_variable_weights = obs_variable_weights,
+                                          verbose = verbose,
+                                          output_cache = output_cache,
+                                          pipeline = pipeline,
+                                          monitor = monitor,
+                                          gridded_output = gridded_output,
+                                          memory_budget = memory_budget)
+
+        site_state["evaluation_time"] = time.time() - start_time
+
+    return rmse
@@ -1,22 +1,22 @@
 """
 Code to optimise a variable in a namelist file using observational data
 """
-import pandas as pd
-
 from Calibration.Calibration.setup_calibration_files import setup_tmp_folders
 from Calibration.general.file_management import make_folder, delete_folder
 from Calibration.Namelist_management.Read import read_variable
 from Calibration.Namelist_management.Outpur_nml_management import is_in_output
 from Calibration.Namelist_management.Edit_variable import edit_variable
 from Calibration.Run_JULES.Run_JULES import run_JULES
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.pipeline import PostProcessingPipeline
+from Calibration.general.tracing import traced
+from Calibration.general.telemetry import CampaignMonitor
+from Calibration.Calibration.gridded_scoring import score_gridded_output, DEFAULT_MEMORY_BUDGET
+from Calibration.Calibration.input_staging import stage_inputs
 
-from xarray import open_dataset
-from pandas import merge
 from logging import exception
-from sklearn.metrics import mean_squared_error
-from scipy.optimize import minimize
 import os
-from datetime import datetime
+import time
 
 
 def optimise_variable(jules_executable_address,
@@ -41,6 +41,14 @@ def optimise_variable(jules_executable_address,
                       save_rmse = False,
                       save_run_time = False,
                       minimize_method = "Nelder-Mead",
+                      output_cache = None,
+                      post_processing_threads = 1,
+                      sandbox_pool = None,
+                      staging_folder = None,
+                      monitor = None,
+                      gridded_output = False,
+                      memory_budget = DEFAULT_MEMORY_BUDGET,
+                      failure_score = float("inf"),
                       verbose = False):
 
     """
@@ -63,6 +71,20 @@ def optimise_variable(jules_executable_address,
     :param keep_dump_files: If True, keeps the dump files (bool) (optional)
     :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
     :param append_to_run_info: If True, appends the run info to the run_info file (bool) (optional)
+    :param output_cache: Cache shared between campaigns, used to reuse the output of any identical earlier run
+                         instead of running JULES again (OutputCache) (optional)
+    :param post_processing_threads: Number of background threads caching, clearing and recording finished runs
+                                    while the next run goes, or 0 to do this between runs (int) (optional)
+    :param sandbox_pool: Pool to take a ready-made temporary folder from instead of setting up tmp_folder
+                         (SandboxPool) (optional)
+    :param staging_folder: If given, the driving and ancillary files are staged to this node-local folder once
+                           and the runs read them from there, see stage_inputs (str) (optional)
+    :param monitor: Monitor to report the progress of the optimisation to, by default progress is written to
+                    <output_folder><run_id_prefix>_telemetry.jsonl (CampaignMonitor) (optional)
+    :param gridded_output: If True, the output is gridded or multi-point and is scored a chunk at a time
+                           against gridded or point observations, see score_gridded_output (bool) (optional)
+    :param memory_budget: Memory allowed for the chunks of a gridded output being scored, in bytes (int) (optional)
+    :param failure_score: Score given to the minimiser for runs that can't be scored (float) (optional)
     :return:
     """
 
@@ -91,11 +113,21 @@ def optimise_variable(jules_executable_address,
     if len(observational_variable_keys) != len(jules_out_variable_keys):
         exception("ERROR: obs_variable_keys and jules_out_variable_keys must be the same length.")
 
+    # Read the driving and ancillary files from node-local copies,
+    # taking the sandboxes from a pool set up from the staged namelists
+    if staging_folder is not None:
+        master_namelist_address = stage_inputs(master_namelist_address, staging_folder)
+        if sandbox_pool is not None:
+            sandbox_pool = sandbox_pool.for_master(master_namelist_address)
+
     # Set up the temporary folders
     print("Setting up temp folder")
-    tmp_folder = setup_tmp_folders(master_namelist_address,
-                                   tmp_folder,
-                                   overwrite_tmp_files)
+    if sandbox_pool is not None:
+        tmp_folder = sandbox_pool.checkout()
+    else:
+        tmp_folder = setup_tmp_folders(master_namelist_address,
+                                       tmp_folder,
+                                       overwrite_tmp_files)
 
     # Create list of the full file addresses for the variable namelist files
     variable_namelist_files_full = [tmp_folder + "namelist/" + file for file in variable_namelist_files]
@@ -129,24 +161,14 @@ def optimise_variable(jules_executable_address,
     if output_folder is not None:
         output_folder = make_folder(output_folder, overwrite_existing=overwrite_output_files)
 
-    # Create the run_info.csv file
-    run_info_address = output_folder + run_id_prefix + "_run_info.csv"
-    if not append_to_run_info:
-        if(os.path.isfile(run_info_address)):
+    # Open the run records
+    results_store = None
+    if output_folder is not None:
+        run_info_address = output_folder + run_id_prefix + "_run_info.sqlite"
+        if not append_to_run_info and os.path.isfile(run_info_address):
             os.remove(run_info_address)
 
-        with open(run_info_address, "w") as run_info:
-            run_info.write("run_id, run_date, " + ", ".join(variable_names))
-
-            if save_rmse:
-                if len(observational_variable_keys) > 1:
-                    for key in observational_variable_keys:
-                        run_info.write(", " + key)
-                run_info.write(", rmse")
-            if save_run_time:
-                run_info.write(", run_time")
-
-            run_info.write("\n")
+        results_store = ResultsStore(run_info_address)
 
 
     # Get the output profile name
@@ -180,7 +202,22 @@ def optimise_variable(jules_executable_address,
     # Read in observation data and reduce to the required variables
     observation_data = observation_data[observational_variable_keys]
 
+    # Report the progress of the optimisation
+    if monitor is None:
+        monitor = CampaignMonitor(run_id_prefix,
+                                  log_address = output_folder + run_id_prefix + "_telemetry.jsonl"
+                                                if output_folder is not None else None,
+                                  verbose = verbose)
+
+    # Clean up finished runs in the background while the next run goes
+    pipeline = None
+    if post_processing_threads > 0:
+        pipeline = PostProcessingPipeline(n_threads = post_processing_threads,
+                                          max_pending = 2 * post_processing_threads)
+
     # -- Optimisation --------------------------------------------------------------------------
+    from scipy.optimize import minimize
+
     if verbose:
         print("Optimising variables...")
     current_run_id = run_id_prefix + "_0"
@@ -197,11 +234,17 @@ def optimise_variable(jules_executable_address,
                      observation_data,
                      observational_variable_keys,
                      jules_out_variable_keys,
-                     run_info_address,
+                     results_store,
                      save_rmse,
                      save_run_time,
                      obs_variable_weights,
-                     verbose),
+                     verbose,
+                     output_cache,
+                     pipeline,
+                     monitor,
+                     gridded_output,
+                     memory_budget,
+                     failure_score),
              bounds = variable_bounds,
              method = minimize_method,
              options= {"max_iter": max_iter}
@@ -209,10 +252,25 @@ def optimise_variable(jules_executable_address,
 
     if verbose:
         print("Optimisation complete.")
+    monitor.close()
+
     # -- Clean up ------------------------------------------------------------------------------
-    # Remove the temporary folders
-    delete_folder(tmp_folder)
+    # Wait for the last runs to be cleaned up
+    if pipeline is not None:
+        pipeline.close()
+
+    # Write the run records, keeping a csv copy for easy reading
+    if results_store is not None:
+        results_store.export_csv(output_folder + run_id_prefix + "_run_info.csv")
+        results_store.close()
+
+    # Return the temporary folder to the pool, or remove it
+    if sandbox_pool is not None:
+        sandbox_pool.checkin(tmp_folder)
+    else:
+        delete_folder(tmp_folder)
 
+@traced("run")
 def calc_rmse_for_given_values(variable_values,
                                variable_names,
                                variable_namelists,
@@ -225,14 +283,25 @@ def calc_rmse_for_given_values(variable_values,
                                observational_data,
                                observational_variable_keys,
                                jules_out_variable_keys,
-                               run_info_out_address,
+                               results_store = None,
                                save_rmse = False,
                                save_run_time = False,
                                obs_variable_weights = None,
-                               verbose = False):
+                               verbose = False,
+                               output_cache = None,
+                               pipeline = None,
+                               monitor = None,
+                               gridded_output = False,
+                               memory_budget = DEFAULT_MEMORY_BUDGET,
+                               failure_score = float("inf")):
     """
     Function used in minimisation to calculate the RMSE for a given set of variable values
     :param variable_values:
+    :param pipeline: Pipeline to clean up the run in once it is scored (PostProcessingPipeline) (optional)
+    :param monitor: Monitor to report the start, end and score of the run to (CampaignMonitor) (optional)
+    :param gridded_output: If True, scores the output a chunk at a time with score_gridded_output (bool) (optional)
+    :param memory_budget: Memory allowed for the chunks of a gridded output being scored, in bytes (int) (optional)
+    :param failure_score: Score returned for runs that can't be scored (float) (optional)
     :return:
     """
 
@@ -241,12 +310,6 @@ def calc_rmse_for_given_values(variable_values,
     if verbose:
         print(f"Setup {current_run_id[0]}...")
 
-    # Setup rmse output if needed
-    if save_rmse:
-        rmse_out_address = run_info_out_address
-    else:
-        rmse_out_address = None
-
     # Set the variable values in the namelist files
     # TODO: fix this hard coded 5
     variable_values_string = [f"5*{val}" for val in variable_values]
@@ -255,15 +318,6 @@ def calc_rmse_for_given_values(variable_values,
                   variable_names,
                   variable_values_string)
 
-    # Write the run info to the run_info.csv file
-    if output_folder is not None:
-        with open(run_info_out_address, "a") as run_info:
-            run_info.write(current_run_id[0] + "." + profile_name + ".nc,"
-                           + f"{datetime.now():%Y-%m-%d %H:%M},"
-                           + ",".join([str(val) for val in variable_values]))
-
-            run_info.close()
-
     # Update the run id
 
     edit_variable(tmp_folder + "namelist/output.nml",
@@ -272,52 +326,176 @@ def calc_rmse_for_given_values(variable_values,
                   "'" + current_run_id[0] + "'")
 
     # Run JULES
-    if verbose:
+    if verbose and monitor is None:
         print(f"Running {current_run_id[0]}...")
-    run_time = datetime.now()
-    run_JULES(jules_executable_address,
-              tmp_folder + "namelist/",
-              terminal_output_address = tmp_folder + "output/" + current_run_id[0] + "." + profile_name + ".out")
-    run_time = datetime.now() - run_time
+    if monitor is not None:
+        monitor.run_started(current_run_id[0], sweep_index = int(current_run_id[0].split("_")[-1]))
+    start_time = time.time()
+    cache_key = None
+    returncode = 0
+    if output_cache is not None:
+        cache_key = output_cache.key(tmp_folder + "namelist/", jules_executable_address)
+
+    # Reuse the output of an identical earlier run if there is one
+    if cache_key is not None and output_cache.fetch(cache_key, tmp_folder + "output/", current_run_id[0]):
+        if verbose:
+            print(f"Reusing cached output for {current_run_id[0]}...")
+
+        # Already in the cache
+        cache_key = None
+    else:
+        returncode = run_JULES(jules_executable_address,
+                               tmp_folder + "namelist/",
+                               terminal_output_address = tmp_folder + "output/" + current_run_id[0] + "." + profile_name + ".out")
+    end_time = time.time()
+
+    # Move the outputs aside so the output folder is free for the next run
+    staging_folder = tmp_folder + "output_" + current_run_id[0] + "/"
+    os.rename(tmp_folder + "output/", staging_folder)
+    os.mkdir(tmp_folder + "output/")
 
     # calculate RMSE
     if verbose:
         print(f"Cacluate RMSE for {current_run_id[0]}...")
-    JULES_data = open_dataset(tmp_folder + "output/" + current_run_id[0] + "." + profile_name + ".nc")
-    JULES_data = JULES_data[['time'] + jules_out_variable_keys]
-    JULES_data = JULES_data.squeeze(dim=["x", "y"], drop=True)
-    JULES_data = JULES_data.to_pandas()
-    JULES_data.index = pd.to_datetime(JULES_data.index)
-
-    rmse = compare_to_obs(observational_data,
-                          JULES_data,
-                          observational_variable_keys,
-                          jules_out_variable_keys,
-                          obs_variable_weights = obs_variable_weights,
-                          rmse_out_address = rmse_out_address,
-                          verbose = verbose)
+    output_address = staging_folder + current_run_id[0] + "." + profile_name + ".nc"
+    status = "complete"
+    rmse_values = None
+
+    # A crashed run can leave a truncated output, so isn't scored
+    if returncode != 0 or not os.path.exists(output_address):
+        print(f"JULES run for run_id {current_run_id[0]} failed (exit code {returncode}).")
+        status = "failed"
+    elif gridded_output:
+        result = score_gridded_output(output_address,
+                                      observational_data,
+                                      observational_variable_keys,
+                                      jules_out_variable_keys,
+                                      obs_variable_weights = obs_variable_weights,
+                                      memory_budget = memory_budget,
+                                      return_variable_rmse = True,
+                                      verbose = verbose)
+        if result is not None:
+            rmse, rmse_values = result
+        else:
+            print(f"JULES output for run_id {current_run_id[0]} could not be scored.")
+            status = "failed"
+    else:
+        JULES_data = read_JULES_output(output_address, jules_out_variable_keys)
+
+        rmse, rmse_values = compare_to_obs(observational_data,
+                                           JULES_data,
+                                           observational_variable_keys,
+                                           jules_out_variable_keys,
+                                           obs_variable_weights = obs_variable_weights,
+                                           return_variable_rmse = True,
+                                           verbose = verbose)
+
+    # Failed runs get a score the minimiser moves away from, and aren't cached
+    if status == "failed":
+        rmse = failure_score
+        cache_key = None
+
+    if monitor is not None:
+        monitor.run_finished(current_run_id[0],
+                             start_time,
+                             end_time,
+                             status = status,
+                             score = rmse if status == "complete" else None,
+                             sweep_index = int(current_run_id[0].split("_")[-1]))
 
     if verbose:
         print(f"Cleening up {current_run_id[0]}...")
-    # Save run time
-    if save_run_time and output_folder is not None:
-        with open(run_info_out_address, "a") as run_info:
-            run_info.write(f",{run_time.total_seconds()}")
-            run_info.close()
-
-    # End run entry in run_info.csv
-    if output_folder is not None:
-        with open(run_info_out_address, "a") as run_info:
-            run_info.write("\n")
-            run_info.close()
 
-    # clean tmp_output
-    for file in os.listdir(tmp_folder + "output/"):
-        os.remove(tmp_folder + "output/" + file)
+    # Cache, clear and record the run, in the background if there is a pipeline.
+    # The RMSE itself is needed by the minimiser before the next run, so is always calculated here.
+    scores = None
+    if save_rmse and rmse_values is not None and len(observational_variable_keys) > 1:
+        scores = dict(zip(observational_variable_keys, rmse_values))
+
+    clean_up_arguments = (staging_folder,
+                          current_run_id[0],
+                          dict(zip(variable_names, variable_values)),
+                          start_time,
+                          end_time if save_run_time else None,
+                          rmse if save_rmse and status == "complete" else None,
+                          scores,
+                          results_store,
+                          output_cache,
+                          cache_key,
+                          status)
+    if pipeline is not None:
+        pipeline.submit(clean_up_run, *clean_up_arguments)
+    else:
+        clean_up_run(*clean_up_arguments)
 
     return rmse
 
+@traced()
+def clean_up_run(staging_folder,
+                 current_run_id,
+                 parameters,
+                 start_time,
+                 end_time = None,
+                 score = None,
+                 scores = None,
+                 results_store = None,
+                 output_cache = None,
+                 cache_key = None,
+                 status = "complete"):
+    """
+    Caches and deletes the outputs of a scored optimisation run, then records the run
+    :param staging_folder: Folder the run's outputs were moved to when JULES finished (str)
+    :param current_run_id: run id of the run (str)
+    :param parameters: Variable names and values used for the run (dict)
+    :param start_time: Time the run started, in seconds since the epoch (float)
+    :param end_time: Time JULES finished, in seconds since the epoch (float) (optional)
+    :param score: RMSE of the run (float) (optional)
+    :param scores: RMSE of each variable (dict of float) (optional)
+    :param results_store: Results store to record the run in (ResultsStore) (optional)
+    :param output_cache: Cache to add the outputs to (OutputCache) (optional)
+    :param cache_key: Cache key of the run, or None if it shouldn't be cached (str) (optional)
+    :param status: Status of the run, "complete" or "failed" (str) (optional)
+    """
+
+    if output_cache is not None and cache_key is not None:
+        output_cache.store(cache_key, staging_folder, current_run_id)
+
+    delete_folder(staging_folder)
+
+    if results_store is not None:
+        results_store.add_run(current_run_id,
+                              parameters,
+                              campaign = "_".join(current_run_id.split("_")[:-1]),
+                              sweep_index = int(current_run_id.split("_")[-1]),
+                              start_time = start_time,
+                              end_time = end_time,
+                              status = status,
+                              score = score,
+                              scores = scores)
+
 
+@traced()
+def read_JULES_output(output_address, jules_out_variable_keys):
+    """
+    Reads the JULES output variables from a single point run into a pandas dataframe
+    :param output_address: Address of the JULES output file (str)
+    :param jules_out_variable_keys: Keys of the variables to read from the JULES output file (list of str)
+    :return: pandas dataframe of the JULES output indexed by time
+    """
+
+    import pandas as pd
+    from xarray import open_dataset
+
+    with open_dataset(output_address) as dataset:
+        JULES_data = dataset[['time'] + jules_out_variable_keys]
+        JULES_data = JULES_data.squeeze(dim=["x", "y"], drop=True)
+        JULES_data = JULES_data.to_pandas()
+    JULES_data.index = pd.to_datetime(JULES_data.index)
+
+    return JULES_data
+
+
+@traced()
 def compare_to_obs(obs_data,
                    JULES_output,
                    obs_variable_keys,
@@ -325,6 +503,7 @@ def compare_to_obs(obs_data,
                    time_period = None,
                    obs_variable_weights = None,
                    rmse_out_address = None,
+                   return_variable_rmse = False,
                    verbose = False):
     """
     Compares the JULES output to the observational data
@@ -337,9 +516,13 @@ def compare_to_obs(obs_data,
     :param time_period: Period to compare the data over (pandas datetime) (optional)
     :param obs_variable_weights: Weights to apply to the variables in the observation data (list of float) (optional)
     :param rmse_out_address: Address to save the RMSE outputs (str) (optional)
-    :return:
+    :param return_variable_rmse: If True, also returns the RMSE of each variable (bool) (optional)
+    :return: weighted mean RMSE (float), and the RMSE of each variable (list of float) if return_variable_rmse
     """
 
+    import numpy as np
+    from pandas import merge
+
     # Merge the dataframes on the time index
     merged_data = merge(obs_data, JULES_output, how = 'inner', left_index=True, right_index=True)
 
@@ -369,8 +552,8 @@ def compare_to_obs(obs_data,
         jules_key = jules_out_variable_keys[i]
 
         # Calculate the rmse
-        rmse_values.append(mean_squared_error(merged_data[obs_key],
-                                              merged_data[jules_key]))
+        errors = merged_data[obs_key].to_numpy(dtype=float) - merged_data[jules_key].to_numpy(dtype=float)
+        rmse_values.append(float(np.mean(errors * errors)))
 
         mean_rmse += rmse_values[i] * obs_variable_weights[i]
 
@@ -385,4 +568,7 @@ def compare_to_obs(obs_data,
             file.write(f", {mean_rmse}")
             file.close()
 
+    if return_variable_rmse:
+        return mean_rmse, rmse_values
+
     return mean_rmse
\ No newline at end of file
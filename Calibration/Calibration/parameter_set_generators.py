@@ -0,0 +1,86 @@
+"""
+Generators of parameter sets that can be passed to iterate_variables and iterate_soil_variable.
+Each generator yields one set of variable values (list of str) at a time, so a sweep can start
+before the whole design has been built.
+"""
+import csv
+import itertools
+
+
+def grid_parameter_sets(variable_values):
+    """
+    Lazily generates every combination of the given values of each variable
+    :param variable_values: values to try for each variable (list of lists of str)
+    :return: generator of parameter sets (list of str)
+    """
+
+    for values in itertools.product(*variable_values):
+        yield list(values)
+
+def latin_hypercube_parameter_sets(variable_bounds,
+                                   n_samples = None,
+                                   batch_size = 100,
+                                   variable_formats = None,
+                                   seed = None):
+    """
+    Generates parameter sets from a stream of Latin hypercube designs.
+    Each batch of batch_size parameter sets is its own Latin hypercube, so the stream can be open-ended.
+    :param variable_bounds: lower and upper bound of each variable (list of tuples)
+    :param n_samples: total number of parameter sets, or None for an endless stream (int) (optional)
+    :param batch_size: number of parameter sets in each Latin hypercube (int) (optional)
+    :param variable_formats: format string used to write each value, e.g. "5*{}" (list of str) (optional)
+    :param seed: random seed (int) (optional)
+    :return: generator of parameter sets (list of str)
+    """
+
+    import numpy as np
+
+    bounds = np.array(variable_bounds, dtype=float)
+    n_variables = len(bounds)
+
+    if variable_formats is None:
+        variable_formats = ["{}"] * n_variables
+
+    rng = np.random.default_rng(seed)
+
+    n_generated = 0
+    while n_samples is None or n_generated < n_samples:
+
+        # The last batch may be smaller
+        current_batch_size = batch_size
+        if n_samples is not None:
+            current_batch_size = min(batch_size, n_samples - n_generated)
+
+        # One sample in each of current_batch_size strata for every variable
+        strata = np.array([rng.permutation(current_batch_size) for _ in range(n_variables)]).T
+        unit_samples = (strata + rng.random((current_batch_size, n_variables))) / current_batch_size
+        samples = bounds[:, 0] + unit_samples * (bounds[:, 1] - bounds[:, 0])
+
+        for sample in samples:
+            yield [variable_formats[j].format(value) for j, value in enumerate(sample)]
+
+        n_generated += current_batch_size
+
+def read_parameter_sets(csv_address, columns = None):
+    """
+    Reads parameter sets one row at a time from a csv file with a header row
+    :param csv_address: address of the csv file (str)
+    :param columns: names of the columns to use, in order (list of str) (optional)
+                    Defaults to every column.
+    :return: generator of parameter sets (list of str)
+    """
+
+    with open(csv_address, "r", newline="") as file:
+        reader = csv.reader(file)
+        header = [name.strip() for name in next(reader)]
+
+        if columns is None:
+            column_indices = list(range(len(header)))
+        else:
+            column_indices = [header.index(column) for column in columns]
+
+        for row in reader:
+            # Skip empty lines
+            if len(row) == 0:
+                continue
+            yield [row[i].strip() for i in column_indices]
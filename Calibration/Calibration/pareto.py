@@ -0,0 +1,316 @@
+"""
+Code to calibrate namelist variables against several observed variables at once, finding the Pareto front
+"""
+from Calibration.Calibration.evaluator import JULESEvaluator
+from Calibration.Calibration.parameter_set_generators import latin_hypercube_parameter_sets
+
+
+def optimise_pareto(jules_executable_address,
+                    master_namelist_address,
+                    variable_names,
+                    variable_namelists,
+                    variable_namelist_files,
+                    observation_data,
+                    observational_variable_keys,
+                    jules_out_variable_keys,
+                    run_id_prefix,
+                    variable_bounds,
+                    variable_formats = None,
+                    population_size = 24,
+                    n_generations = 10,
+                    crossover_probability = 0.9,
+                    crossover_eta = 15,
+                    mutation_probability = None,
+                    mutation_eta = 20,
+                    output_folder = None,
+                    tmp_folder = None,
+                    overwrite_tmp_files = False,
+                    overwrite_output_files = False,
+                    append_to_run_info = False,
+                    n_workers = 1,
+                    output_cache = None,
+                    staging_folder = None,
+                    seed = None,
+                    monitor = None,
+                    verbose = False):
+    """
+    Calibrates namelist variables with NSGA-II, treating the RMSE of each observed variable as a separate
+    objective instead of combining them with fixed weights. The first population is drawn from a Latin
+    hypercube over the bounds. Each generation, children are bred by tournament selection, simulated binary
+    crossover and polynomial mutation and run in parallel, and the next population is chosen from parents and
+    children by non-domination rank, then crowding distance. Every run is recorded with the RMSE of each
+    variable, so any weighting can be chosen afterwards with best_for_weights without running JULES again.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param variable_names: Name of the variable to calibrate (str) or list of variables to calibrate (list of str)
+    :param variable_namelists: Namelist containing each variable (str or list of str)
+    :param variable_namelist_files: Namelist file containing each variable (str or list of str)
+    :param observation_data: pandas dataframe of the observations indexed by time
+    :param observational_variable_keys: Keys of the variables in the observation data, one objective each
+                                        (list of str)
+    :param jules_out_variable_keys: Keys of the matching variables in the JULES output file (list of str)
+    :param run_id_prefix: Prefix to add to the run ids (str)
+    :param variable_bounds: Lower and upper bound of each variable (list of tuples)
+    :param variable_formats: Format string used to write each value, e.g. "5*{}" (list of str) (optional)
+    :param population_size: Number of members in each generation (int) (optional)
+    :param n_generations: Number of generations of children bred after the first population (int) (optional)
+    :param crossover_probability: Probability that two parents are crossed (float) (optional)
+    :param crossover_eta: Distribution index of the crossover, larger keeps children nearer their parents
+                          (float) (optional)
+    :param mutation_probability: Probability of mutating each variable, defaults to 1 / number of variables
+                                 (float) (optional)
+    :param mutation_eta: Distribution index of the mutation, larger makes smaller mutations (float) (optional)
+    :param output_folder: Address to save the run records and Pareto front in (str) (optional)
+    :param tmp_folder: Temporary folder to use (str) (optional)
+    :param overwrite_tmp_files: If True, overwrites existing temporary files (bool) (optional)
+    :param overwrite_output_files: If True, overwrites an existing output folder (bool) (optional)
+    :param append_to_run_info: If True, appends to existing run records (bool) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param output_cache: Cache used to reuse the output of any identical earlier run (OutputCache) (optional)
+    :param staging_folder: Node-local folder to stage the driving and ancillary files to (str) (optional)
+    :param seed: Random seed (int) (optional)
+    :param monitor: Monitor to report the progress of the runs to (CampaignMonitor) (optional)
+    :param verbose: If True, prints progress (bool) (optional)
+    :return: pandas dataframe of the Pareto front over every run, with the variable values, RMSE of each
+             observed variable and run id of each member
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    # -- Setup ---------------------------------------------------------------------------------
+
+    # Manage the case where the user only wants to calibrate one variable
+    if type(variable_names) is str:
+        variable_names = [variable_names]
+        variable_namelists = [variable_namelists]
+        variable_namelist_files = [variable_namelist_files]
+        variable_bounds = [variable_bounds] if type(variable_bounds[0]) not in (list, tuple) else variable_bounds
+
+    if type(observational_variable_keys) is str:
+        observational_variable_keys = [observational_variable_keys]
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+
+    bounds = np.array(variable_bounds, dtype=float)
+    if mutation_probability is None:
+        mutation_probability = 1 / len(variable_names)
+    rng = np.random.default_rng(seed)
+
+    evaluator = JULESEvaluator(jules_executable_address,
+                               master_namelist_address,
+                               variable_names,
+                               variable_namelists,
+                               variable_namelist_files,
+                               observation_data,
+                               observational_variable_keys,
+                               jules_out_variable_keys,
+                               run_id_prefix,
+                               variable_formats = variable_formats,
+                               output_folder = output_folder,
+                               tmp_folder = tmp_folder,
+                               overwrite_tmp_files = overwrite_tmp_files,
+                               overwrite_output_files = overwrite_output_files,
+                               append_to_run_info = append_to_run_info,
+                               n_workers = n_workers,
+                               output_cache = output_cache,
+                               staging_folder = staging_folder,
+                               monitor = monitor,
+                               verbose = verbose)
+
+    # Every member run, for the final front
+    all_values = []
+    all_objectives = []
+    all_run_ids = []
+
+    def run_members(members):
+        objectives, run_ids = evaluator.evaluate_objectives_batch(members)
+        all_values.extend(members)
+        all_objectives.extend(objectives)
+        all_run_ids.extend(run_ids)
+        return objectives
+
+    # First population from a Latin hypercube over the bounds
+    population = np.array([[float(value) for value in values]
+                           for values in latin_hypercube_parameter_sets(variable_bounds,
+                                                                        n_samples = population_size,
+                                                                        batch_size = population_size,
+                                                                        seed = seed)])
+    print(f"Generation 0: running {len(population)} members")
+    objectives = run_members(population)
+    ranks, crowding = rank_population(objectives)
+
+    # -- Generations ---------------------------------------------------------------------------
+    for generation in range(1, n_generations + 1):
+        children = breed(population, ranks, crowding, bounds, rng,
+                         crossover_probability = crossover_probability,
+                         crossover_eta = crossover_eta,
+                         mutation_probability = mutation_probability,
+                         mutation_eta = mutation_eta)
+
+        print(f"Generation {generation}: running {len(children)} children")
+        children_objectives = run_members(children)
+
+        # Keep the best of the parents and children
+        population = np.concatenate([population, children])
+        objectives = np.concatenate([objectives, children_objectives])
+        ranks, crowding = rank_population(objectives)
+        survivors = np.lexsort((-crowding, ranks))[:population_size]
+        population, objectives = population[survivors], objectives[survivors]
+        ranks, crowding = rank_population(objectives)
+
+        evaluator.monitor.emit("generation",
+                               generation = generation,
+                               front_size = int(np.sum(ranks == 0)),
+                               best = dict(zip(observational_variable_keys, np.min(objectives, axis=0).tolist())))
+
+    evaluator.close()
+
+    # -- Pareto front --------------------------------------------------------------------------
+    runs = pd.DataFrame(np.array(all_values), columns=variable_names)
+    for i, key in enumerate(observational_variable_keys):
+        runs[key] = np.array(all_objectives)[:, i]
+    runs["run_id"] = all_run_ids
+
+    front = runs[non_dominated(np.array(all_objectives))].sort_values(observational_variable_keys[0])
+    front = front.reset_index(drop=True)
+
+    if evaluator.output_folder is not None:
+        runs.to_csv(evaluator.output_folder + run_id_prefix + "_members.csv", index=False)
+        front.to_csv(evaluator.output_folder + run_id_prefix + "_pareto_front.csv", index=False)
+
+    print(f"Pareto front of {len(front)} runs out of {len(runs)}.")
+
+    return front
+
+def best_for_weights(runs, observational_variable_keys, obs_variable_weights):
+    """
+    Picks the run with the lowest weighted mean RMSE for a weighting of the observed variables, from the
+    Pareto front or all the member runs of optimise_pareto, without running JULES again
+    :param runs: Runs with a column of RMSE for each observed variable (pandas dataframe)
+    :param observational_variable_keys: Keys of the observed variables (list of str)
+    :param obs_variable_weights: Weight of each observed variable (list of float)
+    :return: the best run (pandas series)
+    """
+
+    import numpy as np
+
+    weights = np.asarray(obs_variable_weights, dtype=float)
+    weights = weights / weights.sum()
+    scores = runs[observational_variable_keys].to_numpy(dtype=float) @ weights
+
+    return runs.iloc[int(np.argmin(scores))]
+
+def dominates(objectives_a, objectives_b):
+    """
+    Checks if one point is no worse than another in every objective and better in at least one
+    :return: True if a dominates b, False otherwise
+    """
+
+    import numpy as np
+
+    return bool(np.all(objectives_a <= objectives_b) and np.any(objectives_a < objectives_b))
+
+def non_dominated(objectives):
+    """
+    Finds the points not dominated by any other
+    :param objectives: Objectives of each point, to be minimised (numpy array, n_points by n_objectives)
+    :return: mask of the non-dominated points (numpy array of bool)
+    """
+
+    import numpy as np
+
+    # Point i is dominated if some point is no worse in every objective and better in one
+    no_worse = np.all(objectives[:, None, :] <= objectives[None, :, :], axis=2)
+    better = np.any(objectives[:, None, :] < objectives[None, :, :], axis=2)
+
+    return ~np.any(no_worse & better, axis=0)
+
+def rank_population(objectives):
+    """
+    Sorts a population into non-dominated fronts and works out the crowding distance of each member in its front
+    :param objectives: Objectives of each member, to be minimised (numpy array, n_members by n_objectives)
+    :return: front of each member, 0 being the Pareto front (numpy array of int), crowding distance of each
+             member (numpy array)
+    """
+
+    import numpy as np
+
+    n_members, n_objectives = objectives.shape
+    ranks = np.full(n_members, -1)
+    crowding = np.zeros(n_members)
+
+    remaining = np.arange(n_members)
+    rank = 0
+    while len(remaining) > 0:
+        front = remaining[non_dominated(objectives[remaining])]
+        ranks[front] = rank
+
+        # Crowding distance: the size of the box around each member touching its neighbours in the front
+        for objective in range(n_objectives):
+            values = objectives[front, objective]
+            order = np.argsort(values, kind="stable")
+            crowding[front[order[0]]] = np.inf
+            crowding[front[order[-1]]] = np.inf
+            value_range = values[order[-1]] - values[order[0]]
+            if len(front) > 2 and np.isfinite(value_range) and value_range > 0:
+                crowding[front[order[1:-1]]] += (values[order[2:]] - values[order[:-2]]) / value_range
+
+        remaining = remaining[ranks[remaining] < 0]
+        rank += 1
+
+    return ranks, crowding
+
+def breed(population, ranks, crowding, bounds, rng, crossover_probability = 0.9, crossover_eta = 15,
+          mutation_probability = None, mutation_eta = 20):
+    """
+    Breeds a generation of children from a population by binary tournament, simulated binary crossover and
+    polynomial mutation
+    :param population: Variable values of each member (numpy array, n_members by n_variables)
+    :param ranks: Front of each member (numpy array of int)
+    :param crowding: Crowding distance of each member (numpy array)
+    :param bounds: Lower and upper bound of each variable (numpy array, n_variables by 2)
+    :param rng: Random number generator (numpy Generator)
+    :return: variable values of each child (numpy array, n_members by n_variables)
+    """
+
+    import numpy as np
+
+    n_members, n_variables = population.shape
+    if mutation_probability is None:
+        mutation_probability = 1 / n_variables
+    lower, upper = bounds[:, 0], bounds[:, 1]
+
+    def tournament():
+        a, b = rng.integers(n_members, size=2)
+        if ranks[a] != ranks[b]:
+            return a if ranks[a] < ranks[b] else b
+        return a if crowding[a] >= crowding[b] else b
+
+    children = []
+    while len(children) < n_members:
+        parent_a, parent_b = population[tournament()].copy(), population[tournament()].copy()
+
+        # Simulated binary crossover
+        if rng.random() < crossover_probability:
+            u = rng.random(n_variables)
+            beta = np.where(u <= 0.5,
+                            (2 * u) ** (1 / (crossover_eta + 1)),
+                            (1 / (2 * (1 - u))) ** (1 / (crossover_eta + 1)))
+            swap = rng.random(n_variables) < 0.5
+            child_a = 0.5 * ((1 + beta) * parent_a + (1 - beta) * parent_b)
+            child_b = 0.5 * ((1 - beta) * parent_a + (1 + beta) * parent_b)
+            parent_a = np.where(swap, child_b, child_a)
+            parent_b = np.where(swap, child_a, child_b)
+
+        for child in (parent_a, parent_b):
+            # Polynomial mutation
+            mutate = rng.random(n_variables) < mutation_probability
+            u = rng.random(n_variables)
+            delta = np.where(u < 0.5,
+                             (2 * u) ** (1 / (mutation_eta + 1)) - 1,
+                             1 - (2 * (1 - u)) ** (1 / (mutation_eta + 1)))
+            child = np.where(mutate, child + delta * (upper - lower), child)
+            children.append(np.clip(child, lower, upper))
+
+    return np.array(children[:n_members])
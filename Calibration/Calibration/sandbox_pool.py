@@ -0,0 +1,216 @@
+"""
+Pool of ready-made temporary folders (sandboxes) that are reused between calibration runs and campaigns
+"""
+import os
+import hashlib
+import threading
+
+from Calibration.Calibration.setup_calibration_files import setup_tmp_folders
+from Calibration.Namelist_management.Duplicate import duplicate_file
+from Calibration.Namelist_management.Edit_variable import edit_variable
+from Calibration.general.cleanup import cleanup_service, OWNER_FILE
+
+# Folders kept in every sandbox, anything else is removed when a sandbox is reset
+SANDBOX_FOLDERS = ("namelist", "output", OWNER_FILE)
+
+
+class SandboxPool:
+    """
+    Keeps a number of sandboxes set up from one master namelist folder so campaigns don't have to build
+    and delete their own temporary folders. A sandbox is checked out, used like a temporary folder made by
+    setup_tmp_folders, and checked back in. Checking in resets the sandbox to the master state by restoring
+    only the namelist files whose contents have changed and clearing its outputs.
+    """
+
+    def __init__(self,
+                 master_namelist_address,
+                 pool_folder = None,
+                 max_idle_sandboxes = 4):
+        """
+        Creates the sandbox pool. Sandboxes are only set up when first checked out.
+        :param master_namelist_address: Address of the master namelist folder (str)
+        :param pool_folder: Folder to keep the sandboxes in (str) (optional)
+        :param max_idle_sandboxes: Number of checked in sandboxes to keep ready for reuse (int) (optional)
+        """
+
+        if not master_namelist_address.endswith("/"):
+            master_namelist_address += "/"
+
+        if pool_folder is None:
+            pool_folder = os.getcwd() + "/sandbox_pool/"
+        if not pool_folder.endswith("/"):
+            pool_folder += "/"
+
+        self.master_namelist_address = master_namelist_address
+        self.pool_folder = pool_folder
+        self.max_idle_sandboxes = max_idle_sandboxes
+
+        os.makedirs(pool_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._idle_sandboxes = []
+        self._n_created = 0
+
+        # Hashes of each namelist file in each sandbox and the master after it was last restored, keyed by sandbox
+        self._file_states = {}
+
+    def checkout(self):
+        """
+        Takes a sandbox from the pool, setting up a new one if none are free
+        :return: sandbox folder address (str)
+        """
+
+        with self._lock:
+            if len(self._idle_sandboxes) > 0:
+                return self._idle_sandboxes.pop()
+
+            # Find an unused sandbox name
+            while True:
+                sandbox = self.pool_folder + f"sandbox_{self._n_created}/"
+                self._n_created += 1
+                if not os.path.exists(sandbox):
+                    break
+
+        setup_tmp_folders(self.master_namelist_address, sandbox)
+
+        with self._lock:
+            self._file_states[sandbox] = {}
+        self._reset(sandbox)
+
+        return sandbox
+
+    def checkin(self, sandbox):
+        """
+        Resets a sandbox to the master state and returns it to the pool
+        :param sandbox: sandbox folder address from checkout (str)
+        """
+
+        with self._lock:
+            keep = len(self._idle_sandboxes) < self.max_idle_sandboxes
+            if not keep:
+                self._file_states.pop(sandbox, None)
+
+        if not keep:
+            cleanup_service().discard(sandbox)
+            return
+
+        self._reset(sandbox)
+
+        with self._lock:
+            self._idle_sandboxes.append(sandbox)
+
+    def _reset(self, sandbox):
+        """
+        Restores the namelist files of a sandbox that differ from the master and removes its outputs
+        :param sandbox: sandbox folder address (str)
+        """
+
+        file_states = self._file_states[sandbox]
+        sandbox_namelist = sandbox + "namelist/"
+
+        master_files = [file for file in os.listdir(self.master_namelist_address) if file.endswith(".nml")]
+
+        # Restore the namelist files that have changed in the sandbox or the master since they were last copied
+        for file in master_files:
+            state = (file_state(self.master_namelist_address + file), file_state(sandbox_namelist + file))
+            if file_states.get(file) == state:
+                continue
+
+            duplicate_file(self.master_namelist_address + file, sandbox_namelist, overwrite=True)
+            if file == "output.nml":
+                edit_variable(sandbox_namelist + "output.nml",
+                              "jules_output",
+                              "output_dir",
+                              "'" + sandbox + "output/" + "'")
+
+            file_states[file] = (file_state(self.master_namelist_address + file), file_state(sandbox_namelist + file))
+
+        # Remove namelist files that aren't in the master
+        for file in os.listdir(sandbox_namelist):
+            if file not in master_files:
+                remove(sandbox_namelist + file)
+                file_states.pop(file, None)
+
+        # Remove outputs and any other files added to the sandbox, e.g. copies of the soil ancillary file
+        for name in os.listdir(sandbox):
+            if name not in SANDBOX_FOLDERS:
+                remove(sandbox + name)
+        for name in os.listdir(sandbox + "output/"):
+            remove(sandbox + "output/" + name)
+
+    def for_master(self, master_namelist_address):
+        """
+        Gets the pool to take sandboxes from for another master namelist folder, e.g. the staged copy of this
+        pool's master made by stage_inputs. The pool shares this pool's folder.
+        :param master_namelist_address: Address of the master namelist folder (str)
+        :return: sandbox pool (SandboxPool), this pool if it already uses the master
+        """
+
+        if os.path.abspath(master_namelist_address) == os.path.abspath(self.master_namelist_address):
+            return self
+
+        return get_sandbox_pool(master_namelist_address,
+                                pool_folder = self.pool_folder,
+                                max_idle_sandboxes = self.max_idle_sandboxes)
+
+    def close(self):
+        """
+        Deletes the idle sandboxes
+        """
+
+        with self._lock:
+            idle_sandboxes = self._idle_sandboxes
+            self._idle_sandboxes = []
+            for sandbox in idle_sandboxes:
+                self._file_states.pop(sandbox, None)
+
+        for sandbox in idle_sandboxes:
+            cleanup_service().discard(sandbox)
+
+_sandbox_pools = {}
+_sandbox_pools_lock = threading.Lock()
+
+def get_sandbox_pool(master_namelist_address, pool_folder = None, max_idle_sandboxes = 4):
+    """
+    Gets the sandbox pool shared by every campaign using a master namelist folder, creating it if needed
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param pool_folder: Folder to keep the sandboxes in, if the pool is created (str) (optional)
+    :param max_idle_sandboxes: Number of sandboxes to keep ready, if the pool is created (int) (optional)
+    :return: sandbox pool (SandboxPool)
+    """
+
+    key = os.path.abspath(master_namelist_address)
+
+    with _sandbox_pools_lock:
+        if key not in _sandbox_pools:
+            _sandbox_pools[key] = SandboxPool(master_namelist_address,
+                                              pool_folder = pool_folder,
+                                              max_idle_sandboxes = max_idle_sandboxes)
+
+        return _sandbox_pools[key]
+
+def file_state(file_address):
+    """
+    Hashes the contents of a file, used to tell if it has changed. The contents are used rather than the
+    modification time, as an edit of the same size can keep the same modification time on file systems with
+    coarse timestamps.
+    :param file_address: Address of the file (str)
+    :return: hash of the file contents (str), or None if the file doesn't exist
+    """
+
+    try:
+        with open(file_address, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def remove(address):
+    """
+    Removes a file, or moves a folder aside to be deleted in the background
+    :param address: Address of the file or folder (str)
+    """
+
+    if os.path.isdir(address) and not os.path.islink(address):
+        cleanup_service().discard(address)
+    else:
+        os.remove(address)
@@ -0,0 +1,327 @@
+"""
+Code to run a global sensitivity analysis (Morris or Sobol) over namelist and soil variables
+"""
+import numpy as np
+import pandas as pd
+from functools import partial
+from logging import exception
+from scipy.stats import qmc
+
+from Calibration.Calibration.Iterate_variable import iterate_soil_variable, make_run_id
+from Calibration.Calibration.setup_calibration_files import RUN_INFO_DATABASE
+from Calibration.general.results_store import ResultsStore
+from Calibration.Calibration.optimise_variable import read_JULES_output, compare_to_obs
+
+
+def sensitivity_analysis(jules_executable_address,
+                         master_namelist_address,
+                         output_folder,
+                         run_id_prefix,
+                         jules_out_variable_keys,
+                         variable_names = None,
+                         variable_namelists = None,
+                         variable_namelist_files = None,
+                         variable_bounds = None,
+                         variable_formats = None,
+                         soil_ancillary_address = None,
+                         soil_variable_names = None,
+                         soil_variable_bounds = None,
+                         method = "morris",
+                         n_samples = 10,
+                         n_levels = 4,
+                         observation_data = None,
+                         observational_variable_keys = None,
+                         obs_variable_weights = None,
+                         summary_statistic = "mean",
+                         seed = None,
+                         n_workers = 1,
+                         tmp_folder = None,
+                         overwrite_tmp_files = False,
+                         append_to_run_info = False,
+                         post_processing_threads = 1):
+    """
+    Runs a global sensitivity analysis of a JULES output score to a set of namelist and soil variables.
+    The number of JULES runs is n_samples * (n_parameters + 1) for the Morris method
+    and n_samples * (n_parameters + 2) for the Sobol method.
+    :param jules_executable_address: Address of the JULES executable (str)
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param output_folder: JULES output folder (str)
+    :param run_id_prefix: Prefix for all run ids (str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file used to score each run
+                                    (str or list of str)
+    :param variable_names: Namelist variables to vary (list of str) (optional)
+    :param variable_namelists: Namelists containing the variables (list of str) (optional)
+    :param variable_namelist_files: Namelist files containing the variables (list of str) (optional)
+    :param variable_bounds: Lower and upper bound of each namelist variable (list of tuples) (optional)
+    :param variable_formats: Format string used to write each namelist variable value, e.g. "5*{}"
+                             (list of str) (optional)
+    :param soil_ancillary_address: Soil ancillary file to use (str) (optional)
+    :param soil_variable_names: Soil variables to vary (list of str) (optional)
+    :param soil_variable_bounds: Lower and upper bound of each soil variable (list of tuples) (optional)
+    :param method: "morris" or "sobol" (str) (optional)
+    :param n_samples: Number of Morris trajectories or Sobol base samples (int) (optional)
+    :param n_levels: Number of grid levels used by the Morris method (int) (optional)
+    :param observation_data: pandas dataframe of observations to score the runs against (optional)
+    :param observational_variable_keys: Keys of the variables in the observation data (str or list of str) (optional)
+    :param obs_variable_weights: Weights to apply to each scored variable (list of float) (optional)
+    :param summary_statistic: Statistic used to score the runs when no observation data is given.
+                              Either the name of a pandas reduction (str) or a function taking the JULES
+                              output dataframe and returning a float (callable) (optional)
+    :param seed: Random seed used to build the samples (int) (optional)
+    :param n_workers: Number of JULES runs to execute at the same time (int) (optional)
+    :param tmp_folder: Temporary folder to use (str) (optional)
+    :param overwrite_tmp_files: If True, overwrites any existing tmp files (bool) (optional)
+    :param append_to_run_info: If True, appends to any existing run_info.csv file (bool) (optional)
+    :param post_processing_threads: Number of background threads scoring finished runs while the next runs go
+                                    (int) (optional)
+    :return: pandas dataframe of the sensitivity indices for each variable
+    """
+
+    # Manage the variable input options
+    if variable_names is None:
+        variable_names = []
+        variable_bounds = []
+    if soil_variable_names is None:
+        soil_variable_names = []
+        soil_variable_bounds = []
+    if variable_formats is None:
+        variable_formats = ["{}"] * len(variable_names)
+
+    if type(jules_out_variable_keys) is str:
+        jules_out_variable_keys = [jules_out_variable_keys]
+    if type(observational_variable_keys) is str:
+        observational_variable_keys = [observational_variable_keys]
+
+    n_variables = len(variable_names)
+    bounds = np.array(list(variable_bounds) + list(soil_variable_bounds), dtype=float)
+
+    if len(bounds) == 0:
+        exception("ERROR: No variables to run the sensitivity analysis over.\n")
+        return None
+
+    # Build the samples in the unit hypercube
+    if method == "morris":
+        unit_samples = morris_sample(len(bounds), n_samples, n_levels = n_levels, seed = seed)
+    elif method == "sobol":
+        unit_samples = saltelli_sample(len(bounds), n_samples, seed = seed)
+    else:
+        exception(f"ERROR: Unknown sensitivity analysis method ({method}).\n")
+        return None
+
+    samples = bounds[:, 0] + unit_samples * (bounds[:, 1] - bounds[:, 0])
+
+    # Convert the samples to the strings written to the namelists and soil file
+    variable_values = None
+    soil_variable_values = None
+    if n_variables > 0:
+        variable_values = [[variable_formats[j].format(sample[j]) for j in range(n_variables)]
+                           for sample in samples]
+    if len(soil_variable_names) > 0:
+        soil_variable_values = [[str(value) for value in sample[n_variables:]] for sample in samples]
+
+    # Run JULES for every sample, scoring each run as it finishes
+    iterate_soil_variable(jules_executable_address,
+                          master_namelist_address,
+                          soil_ancillary_address,
+                          variable_names if n_variables > 0 else None,
+                          variable_namelists,
+                          variable_namelist_files,
+                          variable_values,
+                          soil_variable_names if len(soil_variable_names) > 0 else None,
+                          soil_variable_values,
+                          output_folder,
+                          run_id_prefix,
+                          tmp_folder = tmp_folder,
+                          overwrite_tmp_files = overwrite_tmp_files,
+                          append_to_run_info = append_to_run_info,
+                          n_workers = n_workers,
+                          score_function = partial(score_output,
+                                                   jules_out_variable_keys = jules_out_variable_keys,
+                                                   observation_data = observation_data,
+                                                   observational_variable_keys = observational_variable_keys,
+                                                   obs_variable_weights = obs_variable_weights,
+                                                   summary_statistic = summary_statistic),
+                          post_processing_threads = post_processing_threads)
+
+    # Read the score of each run from the run records, failed runs have no score
+    run_ids = [make_run_id(run_id_prefix,
+                           i,
+                           list(variable_names) + list(soil_variable_names),
+                           (variable_values[i] if n_variables > 0 else [])
+                           + (soil_variable_values[i] if len(soil_variable_names) > 0 else []))
+               for i in range(len(samples))]
+
+    with ResultsStore(output_folder + RUN_INFO_DATABASE) as results_store:
+        run_scores = dict(results_store.query("SELECT run_id, score FROM runs WHERE campaign = ?", (run_id_prefix,)))
+
+    scores = np.array([np.nan if run_scores.get(run_id) is None else run_scores[run_id] for run_id in run_ids])
+
+    # Calculate the sensitivity indices
+    if method == "morris":
+        indices = morris_indices(unit_samples, scores)
+    else:
+        indices = sobol_indices(scores, len(bounds), n_samples)
+    if indices is None:
+        return None
+
+    return pd.DataFrame(indices, index = list(variable_names) + list(soil_variable_names))
+
+def score_output(output_file,
+                 jules_out_variable_keys,
+                 observation_data = None,
+                 observational_variable_keys = None,
+                 obs_variable_weights = None,
+                 summary_statistic = "mean"):
+    """
+    Reduces a JULES output file to a single score
+    :param output_file: Address of the JULES output file (str)
+    :param jules_out_variable_keys: Keys of the variables in the JULES output file to score (list of str)
+    :param observation_data: pandas dataframe of observations to compare to (optional)
+    :param observational_variable_keys: Keys of the variables in the observation data (list of str) (optional)
+    :param obs_variable_weights: Weights to apply to each scored variable (list of float) (optional)
+    :param summary_statistic: Name of a pandas reduction (str) or function of the output dataframe (callable)
+                              used when no observation data is given (optional)
+    :return: score (float)
+    """
+
+    JULES_data = read_JULES_output(output_file, jules_out_variable_keys)
+
+    # Score against the observations
+    if observation_data is not None:
+        return compare_to_obs(observation_data[observational_variable_keys],
+                              JULES_data,
+                              observational_variable_keys,
+                              jules_out_variable_keys,
+                              obs_variable_weights = obs_variable_weights)
+
+    # Score using a summary statistic of the output
+    if callable(summary_statistic):
+        return float(summary_statistic(JULES_data))
+
+    if obs_variable_weights is None:
+        obs_variable_weights = [1] * len(jules_out_variable_keys)
+
+    statistics = getattr(JULES_data[jules_out_variable_keys], summary_statistic)()
+    return float(sum(statistics[key] * obs_variable_weights[i] for i, key in enumerate(jules_out_variable_keys))
+                 / sum(obs_variable_weights))
+
+def morris_sample(n_parameters, n_trajectories, n_levels = 4, seed = None):
+    """
+    Builds Morris one-at-a-time trajectories in the unit hypercube.
+    Each trajectory has n_parameters + 1 points, each point differing from the last in one parameter.
+    :param n_parameters: Number of parameters (int)
+    :param n_trajectories: Number of trajectories (int)
+    :param n_levels: Number of grid levels for each parameter (int) (optional)
+    :param seed: Random seed (int) (optional)
+    :return: samples (numpy array of shape (n_trajectories * (n_parameters + 1), n_parameters))
+    """
+
+    rng = np.random.default_rng(seed)
+    delta = n_levels / (2 * (n_levels - 1))
+    levels = np.linspace(0, 1, n_levels)
+
+    trajectories = []
+    for _ in range(n_trajectories):
+        point = rng.choice(levels, size = n_parameters)
+        trajectory = [point.copy()]
+
+        # Move each parameter once, in a random order, staying inside the unit hypercube
+        for j in rng.permutation(n_parameters):
+            if point[j] + delta <= 1 + 1e-12:
+                point[j] += delta
+            else:
+                point[j] -= delta
+            trajectory.append(point.copy())
+
+        trajectories.append(np.array(trajectory))
+
+    return np.concatenate(trajectories)
+
+def morris_indices(samples, scores):
+    """
+    Calculates the Morris elementary effect statistics from a set of trajectories.
+    Trajectories with a failed run (a NaN score) are left out.
+    :param samples: samples built by morris_sample (numpy array)
+    :param scores: score of each sample (numpy array)
+    :return: dictionary of mu, mu_star and sigma for each parameter (dict of numpy arrays),
+             or None if every trajectory has a failed run
+    """
+
+    n_parameters = samples.shape[1]
+    samples = samples.reshape(-1, n_parameters + 1, n_parameters)
+    scores = scores.reshape(-1, n_parameters + 1)
+
+    # Leave out trajectories with failed runs
+    complete = ~np.isnan(scores).any(axis = 1)
+    if not complete.any():
+        exception("ERROR: Every Morris trajectory has a failed run, can't calculate the sensitivity indices.\n")
+        return None
+    if not complete.all():
+        print(f"Warning: leaving out {np.sum(~complete)} of {len(complete)} Morris trajectories with failed runs.")
+    samples = samples[complete]
+    scores = scores[complete]
+
+    elementary_effects = np.zeros((samples.shape[0], n_parameters))
+    for t in range(samples.shape[0]):
+        steps = np.diff(samples[t], axis = 0)
+        for step in range(n_parameters):
+            j = np.flatnonzero(steps[step])[0]
+            elementary_effects[t, j] = (scores[t, step + 1] - scores[t, step]) / steps[step, j]
+
+    return {"mu": elementary_effects.mean(axis = 0),
+            "mu_star": np.abs(elementary_effects).mean(axis = 0),
+            "sigma": elementary_effects.std(axis = 0, ddof = 1) if samples.shape[0] > 1
+                     else np.zeros(n_parameters)}
+
+def saltelli_sample(n_parameters, n_base, seed = None):
+    """
+    Builds the Saltelli sample needed to estimate first order and total Sobol indices.
+    The samples are ordered as the base matrices A and B followed by each A_B^(j) matrix.
+    :param n_parameters: Number of parameters (int)
+    :param n_base: Number of base samples, ideally a power of 2 (int)
+    :param seed: Random seed (int) (optional)
+    :return: samples (numpy array of shape (n_base * (n_parameters + 2), n_parameters))
+    """
+
+    base = qmc.Sobol(d = 2 * n_parameters, scramble = True, seed = seed).random(n_base)
+    A = base[:, :n_parameters]
+    B = base[:, n_parameters:]
+
+    samples = [A, B]
+    for j in range(n_parameters):
+        AB = A.copy()
+        AB[:, j] = B[:, j]
+        samples.append(AB)
+
+    return np.concatenate(samples)
+
+def sobol_indices(scores, n_parameters, n_base):
+    """
+    Calculates the first order and total Sobol indices from the scores of a Saltelli sample.
+    Base samples with a failed run (a NaN score) in any of the matrices are left out.
+    :param scores: score of each sample built by saltelli_sample (numpy array)
+    :param n_parameters: Number of parameters (int)
+    :param n_base: Number of base samples (int)
+    :return: dictionary of S1 and ST for each parameter (dict of numpy arrays),
+             or None if fewer than two base samples have no failed runs
+    """
+
+    scores = scores.reshape(n_parameters + 2, n_base)
+
+    # Leave out base samples with failed runs
+    complete = ~np.isnan(scores).any(axis = 0)
+    if np.sum(complete) < 2:
+        exception("ERROR: Fewer than two Sobol base samples without failed runs, "
+                  + "can't calculate the sensitivity indices.\n")
+        return None
+    if not complete.all():
+        print(f"Warning: leaving out {np.sum(~complete)} of {n_base} Sobol base samples with failed runs.")
+    scores = scores[:, complete]
+    f_A = scores[0]
+    f_B = scores[1]
+    f_AB = scores[2:]
+
+    variance = np.var(np.concatenate([f_A, f_B]))
+
+    return {"S1": np.mean(f_B * (f_AB - f_A), axis = 1) / variance,
+            "ST": 0.5 * np.mean((f_A - f_AB) ** 2, axis = 1) / variance}
@@ -6,8 +6,14 @@ import os
 from Calibration.general.file_management import make_folder
 from Calibration.Namelist_management.Duplicate import duplicate
 from Calibration.Namelist_management.Edit_variable import edit_variable
+from Calibration.general.results_store import ResultsStore
+from Calibration.general.cleanup import reclaim_orphaned_folders, mark_owner
 from logging import exception
 
+# Run records are kept in an SQLite results store in the output folder and exported to run_info.csv
+RUN_INFO_DATABASE = "run_info.sqlite"
+RUN_INFO_CSV = "run_info.csv"
+
 def setup_calibration_run_folders(master_namelist_address,
                                   output_folder,
                                   variable_names,
@@ -56,9 +62,13 @@ def setup_tmp_folders(master_namelist_address,
 
     print(f"Setting up temporary folders in {tmp_folder}")
 
+    # Delete any temporary folders left behind by crashed runs
+    reclaim_orphaned_folders(os.path.dirname(os.path.normpath(tmp_folder)))
+
     # Creat a temporary folder
     make_folder(tmp_folder,
                 overwrite_existing=overwrite_existing_folders)
+    mark_owner(tmp_folder)
 
     # Add a folder for the namelist files
     #tmp_namelist = make_folder(tmp_folder + ("namelist/"),
@@ -82,6 +92,29 @@ def setup_tmp_folders(master_namelist_address,
 
     return tmp_folder
 
+def setup_worker_folders(master_namelist_address,
+                         tmp_folder,
+                         n_workers = 1,
+                         overwrite_existing_folders = False):
+    """
+    Creates one temporary folder per parallel worker so several JULES runs can run at the same time.
+    The first worker uses tmp_folder itself, which must already have been set up by setup_tmp_folders.
+    :param master_namelist_address: Address of the master namelist folder (str)
+    :param tmp_folder: Address of the temporary folder (str)
+    :param n_workers: Number of parallel workers (int) (optional)
+    :param overwrite_existing_folders: If True, overwrites the existing folders (bool) (optional)
+    :return: temporary folder address for each worker (list of str)
+    """
+
+    worker_folders = [tmp_folder]
+
+    for worker in range(1, n_workers):
+        worker_folders.append(setup_tmp_folders(master_namelist_address,
+                                                tmp_folder + f"worker_{worker}/",
+                                                overwrite_existing_folders))
+
+    return worker_folders
+
 
 def setup_output_files(output_folder,
                        variable_names,
@@ -94,44 +127,43 @@ def setup_output_files(output_folder,
     :param output_folder: folder address for the output files (str)
     :param variable_names: names of the variables to store in the run metadata file (list of str)
     :param overwrite_existing_folders: If True, overwrites the existing folders (bool)
-    :param use_existing_run_info: If True, use existing run_info file (bool)
+    :param use_existing_run_info: If True, use existing run_info results store (bool)
+    :param setup_dump_file_folder: If True, creates a folder for the dump files (bool)
     :return: output_folder (str)
     """
 
-    # Create the output folder
-    output_folder = make_folder(output_folder,
-                                overwrite_existing=overwrite_existing_folders)
+    # Create the output folder, keeping an existing one if its run records are to be appended to
+    if use_existing_run_info and os.path.exists(output_folder):
+        print(f"Using existing output folder {output_folder}")
+    else:
+        output_folder = make_folder(output_folder,
+                                    overwrite_existing=overwrite_existing_folders)
 
     # Create the dump folder
-    if setup_dump_file_folder:
+    if setup_dump_file_folder and not os.path.exists(output_folder + "dump/"):
         make_folder(output_folder + "dump/",
                     overwrite_existing=overwrite_existing_folders)
 
     # -- Metadata file setup ---------------------------------------------------
-    # Does the file already exist?
-    if os.path.exists(output_folder + "run_info.csv"):
-        # Check if the user wants to append to the file
+    # Does the results store already exist?
+    if os.path.exists(output_folder + RUN_INFO_DATABASE):
+        # Check if the user wants to append to the store
         if use_existing_run_info:
-            # Check the file has the correct header
-            header = "run_id,run_date," + ",".join(variable_names) + "\n"
+            # Check the stored runs use the same variables
+            with ResultsStore(output_folder + RUN_INFO_DATABASE) as results_store:
+                stored_names = [row[0] for row in results_store.query("SELECT DISTINCT name FROM run_parameters")]
 
-            with open(output_folder + "run_info.csv", "r") as run_info:
-                if run_info.readline() != header:
-                    exception(f"ERROR: {output_folder}run_info.csv file already exists but has the wrong header.")
-                    return None
+            if len(stored_names) > 0 and set(stored_names) != set(variable_names):
+                exception(f"ERROR: {output_folder}{RUN_INFO_DATABASE} already exists but has different variables.")
+                return None
 
-            print(f"{output_folder}run_info.csv file already exists, appending data.")
+            print(f"{output_folder}{RUN_INFO_DATABASE} already exists, appending data.")
 
         else:
-            exception(f"ERROR: {output_folder}run_info.csv file already exists.\n"
+            exception(f"ERROR: {output_folder}{RUN_INFO_DATABASE} already exists.\n"
                       + "Please delete the file or set append_to_run_info = True.\n")
     else:
-        print(f"Creating {output_folder}run_info.csv file")
-        with (open(output_folder + "run_info.csv", "w") as run_info):
-            # write header
-            header = "run_id,run_date"
-            header += "," + ",".join(variable_names)
-            header += "\n"
-            run_info.write(header)
+        print(f"Creating {output_folder}{RUN_INFO_DATABASE}")
+        ResultsStore(output_folder + RUN_INFO_DATABASE).close()
 
     return output_folder
@@ -2,11 +2,13 @@ import os
 
 from Calibration.Namelist_management import Edit_variable as Edit_variable
 from Calibration.general.file_management import make_folder
+from Calibration.general.tracing import traced
 
 """
 Contains code used to duplicate the contents of a folder containing namelist files
 """
 
+@traced()
 def duplicate(namelist_folder, duplicate_address, overwrite=False, verbose=False):
     """
     Creates a coppy of the namelist files in the duplicate_address.
@@ -35,6 +37,7 @@ def duplicate(namelist_folder, duplicate_address, overwrite=False, verbose=False
 
     return True
 
+@traced()
 def duplicate_file(file_address, duplicate_address, overwrite=False, verbose=False):
     """
     Creates a copy of the file in the duplicate_address.
@@ -65,6 +68,7 @@ def duplicate_file(file_address, duplicate_address, overwrite=False, verbose=Fal
     return True
 
 
+@traced()
 def duplicate_soil_ancillary(soil_ancillary_file, duplicate_address, ancillary_namelist_file, overwrite=False):
     """
     Duplicates the soil ancillary files to the duplicate_address
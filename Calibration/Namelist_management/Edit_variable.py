@@ -1,8 +1,10 @@
 import Calibration.Namelist_management.Read as Read
+from Calibration.general.tracing import traced
 """
 Code to open a namelist file and edit a single input variable
 """
 
+@traced()
 def edit_variable(file_address, namelist, variable, value, verbose = False):
     """
     Edits the value of a variable in a namelist file
@@ -66,6 +68,7 @@ def edit_variable(file_address, namelist, variable, value, verbose = False):
 
     return True
 
+@traced()
 def edit_soil_variable(file_address, variables, new_values, ancillary_file, verbose = False):
     """
     Edits the value of a variable in a soil file
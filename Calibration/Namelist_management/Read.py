@@ -4,6 +4,7 @@ Code to read a namelist file or individual namelist or namelist variable
 
 from os.path import isfile
 from logging import exception
+from Calibration.general.tracing import traced
 
 def read_file(file_address):
     """
@@ -48,13 +49,14 @@ def read_namelist(file_address, namelist):
     for i, line in enumerate(lines[namelist_start_index+1:]):
         # Check if we have reached the namelist
         if "/" == line[0]:
-            namelist_end_index = namelist_start_index + i
+            namelist_end_index = namelist_start_index + 1 + i
             break
     else:
         namelist_end_index = len(lines)
 
     return lines[namelist_start_index:namelist_end_index]
 
+@traced()
 def read_variable(file_address, namelist, variable):
 
     """
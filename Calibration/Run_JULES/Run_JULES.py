@@ -1,30 +1,28 @@
-import os
 import subprocess
 
+from Calibration.general.tracing import traced
+
 """
 Code to run JULES from python
 """
 
+@traced("run_JULES")
 def run_JULES(jules_executable_address, namelist_folder_address, terminal_output_address=None):
     """
     Run JULES from python
+    NOTE: JULES is run with the namelist folder as its working directory rather than by changing the
+          working directory of python, so several JULES runs can be started from different threads.
     :param jules_executable_address: Address of JULES executable (str)
     :param namelist_folder_address: Address of the folder containing the namelists (str)
     :param terminal_output_address: Address of the file to write the terminal output to (str) (optional)
+    :return: JULES return code (int)
     """
 
-    # Get the current working directory
-    cwd = os.getcwd()
-
-    # cd to the namelist folder
-    os.chdir(namelist_folder_address)
-
     # Run JULES
     if(terminal_output_address is not None):
         with open(terminal_output_address, "w") as f:
-            subprocess.run(jules_executable_address, stdout=f)
+            process = subprocess.run(jules_executable_address, stdout=f, cwd=namelist_folder_address, shell=True)
     else:
-        os.system(jules_executable_address)
+        process = subprocess.run(jules_executable_address, cwd=namelist_folder_address, shell=True)
 
-    # cd back to the original directory
-    os.chdir(cwd)
+    return process.returncode
@@ -0,0 +1,410 @@
+"""
+Code to supervise JULES runs in parallel sweeps: retrying failed runs and racing a duplicate of late runs
+"""
+import os
+import time
+import signal
+import shutil
+import threading
+import subprocess
+
+from Calibration.Namelist_management.Edit_variable import edit_variable
+from Calibration.general.autotuner import resource_usage
+from Calibration.general.telemetry import percentile
+from Calibration.general.tracing import traced
+
+
+class RunOutcome:
+    """
+    The result of a supervised JULES run
+    """
+
+    def __init__(self, returncode, attempts, outcome, run_time, cpu_time = None, max_rss = None, io_bytes = None):
+        """
+        :param returncode: JULES return code of the copy used (int)
+        :param attempts: Number of times the run was started, not counting duplicates (int)
+        :param outcome: "ok", "retried", "duplicate" if a duplicate finished first, "timed_out" or "failed" (str)
+        :param run_time: Time taken over every attempt, in seconds (float)
+        :param cpu_time: CPU time used by every attempt and duplicate, in seconds (float) (optional)
+        :param max_rss: Largest peak resident memory of any attempt or duplicate, in bytes (int) (optional)
+        :param io_bytes: Bytes read and written to disk by every attempt and duplicate (int) (optional)
+        """
+
+        self.returncode = returncode
+        self.attempts = attempts
+        self.outcome = outcome
+        self.run_time = run_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+        self.io_bytes = io_bytes
+
+    @property
+    def succeeded(self):
+        """
+        :return: True if a copy of the run finished with an output (bool)
+        """
+
+        return self.outcome not in ("failed", "timed_out")
+
+class RunSupervisor:
+    """
+    Runs JULES in a sandbox (a folder with namelist/ and output/ folders, as made by setup_tmp_folders) and
+    deals with stragglers. Failed runs are retried up to max_retries times. Once min_run_times runs have
+    finished, a run is late when it has taken deadline_factor times the deadline_percentile of the run times
+    so far. A late run is duplicated in a spare sandbox, if there is one and fewer than n_workers JULES
+    processes are running, and whichever copy finishes first is used. iterate_soil_variable keeps a sandbox
+    spare for duplicates and sets n_workers to that of the sweep if it isn't given. With timeout_factor, runs taking that
+    many times the percentile are stopped and counted as failed.
+    One supervisor is shared by all the workers of a sweep, so the run times are pooled.
+    """
+
+    def __init__(self,
+                 n_workers = None,
+                 max_retries = 1,
+                 deadline_percentile = 90,
+                 deadline_factor = 2.0,
+                 min_run_times = 5,
+                 speculate = True,
+                 timeout_factor = None,
+                 poll_interval = 0.5):
+        """
+        Creates the supervisor
+        :param n_workers: Number of JULES processes allowed at once, duplicates only start below this. Defaults to
+                          the n_workers of the sweep using the supervisor, or no limit outside a sweep (int) (optional)
+        :param max_retries: Number of times to rerun a failed run (int) (optional)
+        :param deadline_percentile: Percentile of the finished run times used for the deadlines (float) (optional)
+        :param deadline_factor: Multiple of the percentile after which a run is late (float) (optional)
+        :param min_run_times: Number of finished runs needed before deadlines are set (int) (optional)
+        :param speculate: If True, late runs are duplicated on idle workers (bool) (optional)
+        :param timeout_factor: Multiple of the percentile after which a run is stopped, or None to never stop
+                               runs (float) (optional)
+        :param poll_interval: Seconds between checks on running processes (float) (optional)
+        """
+
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.deadline_percentile = deadline_percentile
+        self.deadline_factor = deadline_factor
+        self.min_run_times = min_run_times
+        self.speculate = speculate
+        self.timeout_factor = timeout_factor
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._run_times = []
+        self._n_running = 0
+
+    def _limit(self, factor):
+        """
+        Gets a run time limit from the run times so far
+        :param factor: Multiple of the percentile (float)
+        :return: limit in seconds (float), or None if there aren't enough run times yet
+        """
+
+        with self._lock:
+            if factor is None or len(self._run_times) < self.min_run_times:
+                return None
+            return factor * percentile(sorted(self._run_times), self.deadline_percentile)
+
+    def _start(self, jules_executable_address, sandbox, terminal_output_name):
+        """
+        Starts JULES in a sandbox
+        :return: JULES process (subprocess.Popen)
+        """
+
+        stdout = None
+        if terminal_output_name is not None:
+            stdout = open(sandbox + "output/" + terminal_output_name, "w")
+
+        try:
+            # JULES gets its own process group so it can be stopped along with the shell running it
+            process = subprocess.Popen(jules_executable_address,
+                                       stdout=stdout,
+                                       cwd=sandbox + "namelist/",
+                                       shell=True,
+                                       start_new_session=True)
+        finally:
+            if stdout is not None:
+                stdout.close()
+
+        with self._lock:
+            self._n_running += 1
+
+        return process
+
+    def _finished(self, process):
+        """
+        Records that a process has ended
+        """
+
+        with self._lock:
+            self._n_running -= 1
+
+    def _poll(self, process, usages):
+        """
+        Checks if a JULES process has ended without waiting for it. Ended processes are reaped with wait4 to
+        get the resources they used.
+        :param process: JULES process (subprocess.Popen)
+        :param usages: Resources used by each ended process, from resource_usage, added to (list of dict)
+        :return: True if the process has ended (bool)
+        """
+
+        if process.returncode is None:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid == 0:
+                return False
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usages.append(resource_usage(usage))
+
+        return True
+
+    def _stop(self, process, usages):
+        """
+        Stops a JULES process and waits for it to end
+        """
+
+        if not self._poll(process, usages):
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usages.append(resource_usage(usage))
+        self._finished(process)
+
+    @traced("run_JULES")
+    def run(self,
+            jules_executable_address,
+            sandbox,
+            output_check,
+            run_id = None,
+            get_spare_sandbox = None,
+            return_spare_sandbox = None,
+            terminal_output_name = None,
+            monitor = None):
+        """
+        Runs JULES in a sandbox, retrying if it fails and duplicating it if it is late.
+        The outputs of the copy used end up in the sandbox's output folder.
+        :param jules_executable_address: Address of the JULES executable (str)
+        :param sandbox: Folder with the namelist and output folders of the run (str)
+        :param output_check: Function given an output folder, returning True if the run's output is there (callable)
+        :param run_id: JULES run id, used in messages (str) (optional)
+        :param get_spare_sandbox: Function returning an unused sandbox of the same sweep without waiting,
+                                  or None if there isn't one (callable) (optional)
+        :param return_spare_sandbox: Function given back a sandbox from get_spare_sandbox once it is finished
+                                     with (callable) (optional)
+        :param terminal_output_name: Name of a file in the output folder to write the terminal output to
+                                     (str) (optional)
+        :param monitor: Monitor to report retries and duplicates to (CampaignMonitor) (optional)
+        :return: outcome of the run (RunOutcome)
+        """
+
+        start_time = time.time()
+        outcome = "ok"
+        returncode = None
+
+        # Resources used by every process started for the run
+        usages = []
+
+        attempt = 0
+        while attempt <= self.max_retries:
+            attempt += 1
+
+            if attempt > 1:
+                print(f"-- Retrying run_id {run_id}, attempt {attempt} --")
+                if monitor is not None:
+                    monitor.emit("run_retry", run_id = run_id, attempt = attempt)
+                clear_folder(sandbox + "output/")
+                outcome = "retried"
+
+            returncode, winner, timed_out = self._run_attempt(jules_executable_address,
+                                                              sandbox,
+                                                              output_check,
+                                                              run_id,
+                                                              get_spare_sandbox,
+                                                              return_spare_sandbox,
+                                                              terminal_output_name,
+                                                              monitor,
+                                                              usages)
+
+            if winner is not None:
+                if winner == "duplicate":
+                    outcome = "duplicate"
+                return RunOutcome(returncode, attempt, outcome, time.time() - start_time, **total_usage(usages))
+
+            if timed_out:
+                outcome = "timed_out"
+
+        if outcome != "timed_out":
+            outcome = "failed"
+
+        return RunOutcome(returncode, attempt, outcome, time.time() - start_time, **total_usage(usages))
+
+    def _run_attempt(self,
+                     jules_executable_address,
+                     sandbox,
+                     output_check,
+                     run_id,
+                     get_spare_sandbox,
+                     return_spare_sandbox,
+                     terminal_output_name,
+                     monitor,
+                     usages):
+        """
+        Runs one attempt of a run, with a duplicate if it is late. The resources used by each process are added
+        to usages.
+        :return: JULES return code (int), "primary" or "duplicate" for the copy that succeeded or None if both
+                 failed (str), and whether the attempt was stopped for taking too long (bool)
+        """
+
+        attempt_start = time.time()
+        deadline = self._limit(self.deadline_factor) if self.speculate and get_spare_sandbox is not None else None
+        timeout = self._limit(self.timeout_factor)
+
+        primary = self._start(jules_executable_address, sandbox, terminal_output_name)
+        duplicate = None
+        spare_sandbox = None
+        spare_namelists = None
+        returncode = None
+
+        try:
+            while primary is not None or duplicate is not None:
+
+                # Use the first copy to finish with an output
+                if primary is not None and self._poll(primary, usages):
+                    self._finished(primary)
+                    returncode = primary.returncode
+                    primary = None
+                    if returncode == 0 and output_check(sandbox + "output/"):
+                        self._record_run_time(time.time() - attempt_start)
+                        return returncode, "primary", False
+
+                if duplicate is not None and self._poll(duplicate, usages):
+                    self._finished(duplicate)
+                    returncode = duplicate.returncode
+                    duplicate = None
+                    if returncode == 0 and output_check(spare_sandbox + "output/"):
+                        if primary is not None:
+                            self._stop(primary, usages)
+                            primary = None
+
+                        print(f"-- Using the duplicate of run_id {run_id} --")
+                        move_outputs(spare_sandbox + "output/", sandbox + "output/")
+                        self._record_run_time(time.time() - attempt_start)
+                        return returncode, "duplicate", False
+
+                elapsed = time.time() - attempt_start
+
+                # Stop runs going on far longer than usual
+                if timeout is not None and elapsed > timeout:
+                    print(f"-- Stopping run_id {run_id} after {elapsed:.0f} s --")
+                    if monitor is not None:
+                        monitor.emit("run_timeout", run_id = run_id, elapsed = elapsed)
+                    return returncode, None, True
+
+                # Duplicate a late run if a worker is idle
+                if (primary is not None and spare_sandbox is None and deadline is not None and elapsed > deadline
+                        and (self.n_workers is None or self._n_running < self.n_workers)):
+                    spare_sandbox = get_spare_sandbox()
+                    if spare_sandbox is not None:
+                        print(f"-- run_id {run_id} is late, starting a duplicate --")
+                        if monitor is not None:
+                            monitor.emit("run_duplicate", run_id = run_id, elapsed = elapsed, deadline = deadline)
+                        spare_namelists = copy_run(sandbox, spare_sandbox)
+                        duplicate = self._start(jules_executable_address, spare_sandbox, terminal_output_name)
+
+                time.sleep(self.poll_interval)
+
+            return returncode, None, False
+
+        finally:
+            for process in (primary, duplicate):
+                if process is not None:
+                    self._stop(process, usages)
+
+            # Put the spare sandbox back as it was
+            if spare_sandbox is not None:
+                restore_namelists(spare_sandbox, spare_namelists)
+                clear_folder(spare_sandbox + "output/")
+                return_spare_sandbox(spare_sandbox)
+
+    def _record_run_time(self, run_time):
+        with self._lock:
+            self._run_times.append(run_time)
+
+def total_usage(usages):
+    """
+    Adds up the resources used by the processes of a run
+    :param usages: Resources used by each process, from resource_usage (list of dict)
+    :return: cpu_time, max_rss and io_bytes of the run, or None for each if no process has ended (dict)
+    """
+
+    if len(usages) == 0:
+        return {"cpu_time": None, "max_rss": None, "io_bytes": None}
+
+    return {"cpu_time": sum(usage["cpu_time"] for usage in usages),
+            "max_rss": max(usage["max_rss"] for usage in usages),
+            "io_bytes": sum(usage["io_bytes"] for usage in usages)}
+
+def copy_run(sandbox, spare_sandbox):
+    """
+    Copies the namelists of a run to a spare sandbox, writing the outputs to the spare sandbox
+    :param sandbox: Folder of the run (str)
+    :param spare_sandbox: Folder of the spare sandbox (str)
+    :return: original contents of the spare sandbox's namelist files, keyed by file name (dict of bytes)
+    """
+
+    spare_namelists = {}
+    for file in os.listdir(spare_sandbox + "namelist/"):
+        with open(spare_sandbox + "namelist/" + file, "rb") as namelist_file:
+            spare_namelists[file] = namelist_file.read()
+
+    for file in os.listdir(sandbox + "namelist/"):
+        shutil.copyfile(sandbox + "namelist/" + file, spare_sandbox + "namelist/" + file)
+
+    edit_variable(spare_sandbox + "namelist/output.nml",
+                  "jules_output",
+                  "output_dir",
+                  "'" + spare_sandbox + "output/" + "'")
+    clear_folder(spare_sandbox + "output/")
+
+    return spare_namelists
+
+def restore_namelists(sandbox, namelists):
+    """
+    Puts back the namelist files of a sandbox saved by copy_run
+    :param sandbox: Folder of the sandbox (str)
+    :param namelists: contents of the namelist files, keyed by file name (dict of bytes)
+    """
+
+    for file in os.listdir(sandbox + "namelist/"):
+        if file not in namelists:
+            os.remove(sandbox + "namelist/" + file)
+
+    for file, contents in namelists.items():
+        with open(sandbox + "namelist/" + file, "wb") as namelist_file:
+            namelist_file.write(contents)
+
+def move_outputs(source_folder, destination_folder):
+    """
+    Replaces the contents of a folder with the files from another
+    :param source_folder: Folder to move the files from (str)
+    :param destination_folder: Folder to move the files to (str)
+    """
+
+    clear_folder(destination_folder)
+    for file in os.listdir(source_folder):
+        os.replace(source_folder + file, destination_folder + file)
+
+def clear_folder(folder):
+    """
+    Removes everything in a folder
+    :param folder: Address of the folder (str)
+    """
+
+    for name in os.listdir(folder):
+        if os.path.isdir(folder + name) and not os.path.islink(folder + name):
+            shutil.rmtree(folder + name)
+        else:
+            os.remove(folder + name)
@@ -0,0 +1,295 @@
+"""
+Adjusts the number of JULES runs going at once to get the most runs per hour from a node.
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from Calibration.general.tracing import traced
+
+
+class ConcurrencyAutotuner:
+    """
+    Limits the number of JULES processes running at once and tunes the limit from measurements of the runs.
+    Each run's CPU time, peak resident memory (RSS) and disk I/O are measured when it ends, by run or by the
+    RunSupervisor running it. The limit is doubled while throughput (runs finished per second) keeps improving,
+    then the best limit is found by searching the gaps either side of it, up to the nearest limits tried below
+    and above it. The limit never goes above what the memory cap allows for the largest run seen so far, or
+    above what the core cap allows for the CPU each run uses, and is lowered straight away if runs grow beyond
+    them.
+    """
+
+    def __init__(self,
+                 initial_concurrency = 1,
+                 max_concurrency = None,
+                 memory_limit = None,
+                 core_limit = None,
+                 runs_per_step = None,
+                 tolerance = 0.05,
+                 monitor = None,
+                 verbose = True):
+        """
+        Creates the autotuner
+        :param initial_concurrency: Number of runs allowed at once to start with (int) (optional)
+        :param max_concurrency: Most runs ever allowed at once, defaults to the number of cores (int) (optional)
+        :param memory_limit: Memory the runs can use between them, in bytes, defaults to 90% of the
+                             physical memory (int) (optional)
+        :param core_limit: Cores the runs can use between them, defaults to the number of cores (float) (optional)
+        :param runs_per_step: Number of runs measured at each limit before changing it, defaults to twice
+                              the limit (int) (optional)
+        :param tolerance: Relative change in throughput counted as better or worse (float) (optional)
+        :param monitor: Monitor to report changes of the limit to (CampaignMonitor) (optional)
+        :param verbose: If True, prints changes of the limit (bool) (optional)
+        """
+
+        n_cores = os.cpu_count() or 1
+
+        if memory_limit is None:
+            try:
+                memory_limit = 0.9 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+            except (ValueError, OSError, AttributeError):
+                memory_limit = None
+
+        self.max_concurrency = max_concurrency if max_concurrency is not None else n_cores
+        self.memory_limit = memory_limit
+        self.core_limit = core_limit if core_limit is not None else n_cores
+        self.runs_per_step = runs_per_step
+        self.tolerance = tolerance
+        self.monitor = monitor
+        self.verbose = verbose
+
+        self.concurrency = max(min(initial_concurrency, self.max_concurrency), 1)
+        self.settled = False
+
+        # Throughput measured at each limit tried (runs per second)
+        self.throughput = {}
+        self.best_concurrency = None
+
+        self.n_runs = 0
+        self.max_rss = 0
+        self.cpu_per_run = None
+        self.io_bytes_per_second = None
+
+        self._condition = threading.Condition()
+        self._n_running = 0
+
+        self._step_start_time = None
+        self._step_runs = 0
+        self._warmup_runs = 0
+        self._total_cpu_time = 0.0
+        self._total_run_time = 0.0
+        self._total_io_bytes = 0
+
+    @contextmanager
+    def slot(self):
+        """
+        Waits until a run is allowed to start, and holds its place while it goes
+        """
+
+        with self._condition:
+            while self._n_running >= self.concurrency:
+                self._condition.wait()
+            self._n_running += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._n_running -= 1
+                self._condition.notify_all()
+
+    def set_max_concurrency(self, max_concurrency):
+        """
+        Lowers the most runs ever allowed at once, e.g. to the number of workers a sweep has
+        :param max_concurrency: most runs allowed at once (int)
+        """
+
+        with self._condition:
+            self.max_concurrency = min(self.max_concurrency, max_concurrency)
+            self.concurrency = min(self.concurrency, self.max_concurrency)
+
+    @traced("run_JULES")
+    def run(self, jules_executable_address, namelist_folder_address, terminal_output_address = None):
+        """
+        Runs JULES once a run is allowed to start, measuring the resources it uses
+        :param jules_executable_address: Address of JULES executable (str)
+        :param namelist_folder_address: Address of the folder containing the namelists (str)
+        :param terminal_output_address: Address of the file to write the terminal output to (str) (optional)
+        :return: JULES return code (int)
+        """
+
+        with self.slot():
+            stdout = open(terminal_output_address, "w") if terminal_output_address is not None else None
+            try:
+                start_time = time.time()
+                process = subprocess.Popen(jules_executable_address, stdout=stdout, cwd=namelist_folder_address,
+                                           shell=True)
+
+                # Wait for JULES with wait4 to get the resources it used
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                run_time = time.time() - start_time
+            finally:
+                if stdout is not None:
+                    stdout.close()
+
+        self.record(run_time, **resource_usage(usage))
+
+        return process.returncode
+
+    def record(self, run_time, cpu_time = None, max_rss = None, io_bytes = None):
+        """
+        Records a finished run and adjusts the limit if a step is complete
+        :param run_time: Wall clock time of the run, in seconds (float)
+        :param cpu_time: CPU time used by the run, in seconds (float) (optional)
+        :param max_rss: Peak resident memory of the run, in bytes (int) (optional)
+        :param io_bytes: Bytes read and written to disk by the run (int) (optional)
+        """
+
+        with self._condition:
+            now = time.time()
+            self.n_runs += 1
+
+            self._total_run_time += run_time
+            if cpu_time is not None:
+                self._total_cpu_time += cpu_time
+                self.cpu_per_run = self._total_cpu_time / self._total_run_time if self._total_run_time > 0 else None
+            if io_bytes is not None:
+                self._total_io_bytes += io_bytes
+                self.io_bytes_per_second = self._total_io_bytes / self._total_run_time if self._total_run_time > 0 else None
+            if max_rss is not None:
+                self.max_rss = max(self.max_rss, max_rss)
+
+            # Keep within the caps, whatever the throughput
+            cap = self._cap()
+            if self.concurrency > cap:
+                self._change(cap, "memory or core cap")
+                self.settled = False
+                return
+
+            if self.settled:
+                return
+
+            # Runs started at the previous limit are not counted
+            if self._warmup_runs > 0:
+                self._warmup_runs -= 1
+                if self._warmup_runs == 0:
+                    self._step_start_time = now
+                return
+            if self._step_start_time is None:
+                self._step_start_time = now
+                return
+
+            self._step_runs += 1
+            runs_per_step = self.runs_per_step if self.runs_per_step is not None else 2 * self.concurrency
+            if self._step_runs < runs_per_step:
+                return
+
+            self.throughput[self.concurrency] = self._step_runs / max(now - self._step_start_time, 1e-9)
+            self._adjust(cap)
+
+    def _cap(self):
+        """
+        Finds the most runs the memory and core caps allow at once
+        :return: limit (int)
+        """
+
+        cap = self.max_concurrency
+        if self.memory_limit is not None and self.max_rss > 0:
+            cap = min(cap, int(self.memory_limit // self.max_rss))
+        if self.cpu_per_run is not None and self.cpu_per_run > 0:
+            cap = min(cap, int(self.core_limit / self.cpu_per_run + 1e-9))
+
+        return max(cap, 1)
+
+    def _adjust(self, cap):
+        """
+        Picks the next limit to try from the throughput measured so far
+        :param cap: most runs the caps allow at once (int)
+        """
+
+        current = self.concurrency
+        best = self.best_concurrency
+
+        if best is None or self.throughput[current] > self.throughput[best] * (1 + self.tolerance):
+            self.best_concurrency = best = current
+
+        # Nearest limits tried either side of the best, which were both worse. With nothing tried below the
+        # best, the gap below it reaches down to one run at a time
+        lower = max((concurrency for concurrency in self.throughput if concurrency < best), default=0)
+        upper = min((concurrency for concurrency in self.throughput if concurrency > best), default=None)
+
+        if upper is None and best < cap:
+            # Double the limit while throughput improves
+            self._change(min(2 * best, cap), "exploring")
+            return
+
+        # Search the gaps either side of the best limit, next to the better of its neighbours first
+        candidates = []
+        if upper is not None:
+            candidates.append(((best + upper) // 2, self.throughput[upper]))
+        if best > 1:
+            candidates.append(((lower + best) // 2, self.throughput.get(lower, 0.0)))
+        candidates = [(concurrency, throughput) for concurrency, throughput in candidates
+                      if concurrency not in self.throughput and 1 <= concurrency <= cap]
+
+        if len(candidates) == 0:
+            self._change(min(best, cap), "settled")
+            self.settled = True
+            return
+
+        self._change(max(candidates, key=lambda candidate: candidate[1])[0], "exploring")
+
+    def _change(self, concurrency, reason):
+        """
+        Sets the limit and starts a new measuring step
+        """
+
+        if concurrency != self.concurrency or reason == "settled":
+            if self.verbose:
+                print(f"-- Running {concurrency} JULES runs at once ({reason}) --")
+            if self.monitor is not None:
+                self.monitor.emit("concurrency", concurrency = concurrency, reason = reason,
+                                  throughput = self.throughput.get(self.concurrency))
+
+        # Runs already going at the old limit finish before measuring starts
+        self._warmup_runs = self._n_running
+        self._step_start_time = None
+        self._step_runs = 0
+
+        self.concurrency = concurrency
+        self._condition.notify_all()
+
+    def report(self):
+        """
+        Summarises the tuning
+        :return: limit settled on, throughput at each limit tried, largest run memory, cores used per run
+                 and disk I/O per run second (dict)
+        """
+
+        with self._condition:
+            return {"concurrency": self.concurrency,
+                    "settled": self.settled,
+                    "runs_per_hour": {concurrency: 3600 * throughput
+                                      for concurrency, throughput in sorted(self.throughput.items())},
+                    "max_rss": self.max_rss,
+                    "cpu_per_run": self.cpu_per_run,
+                    "io_bytes_per_second": self.io_bytes_per_second,
+                    "memory_limit": self.memory_limit,
+                    "core_limit": self.core_limit}
+
+def resource_usage(usage):
+    """
+    Converts the resources used by a process, from os.wait4, to the measurements taken by
+    ConcurrencyAutotuner.record
+    :param usage: resource usage of the process (resource.struct_rusage)
+    :return: cpu_time in seconds, max_rss in bytes and io_bytes (dict)
+    """
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, blocks are 512 bytes
+    return {"cpu_time": usage.ru_utime + usage.ru_stime,
+            "max_rss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            "io_bytes": (usage.ru_inblock + usage.ru_oublock) * 512}
@@ -0,0 +1,202 @@
+"""
+Background deletion of temporary folders, so removing large trees doesn't hold up the calibration.
+"""
+import os
+import atexit
+import shutil
+import socket
+import threading
+from queue import Queue
+
+# Marker file written into each temporary folder naming the process using it
+OWNER_FILE = ".owner"
+
+# Added to the name of a folder when it is moved aside to be deleted
+TRASH_MARKER = ".trash_"
+
+
+class CleanupService:
+    """
+    Deletes folders on a background thread. A folder is renamed aside straight away, so its address
+    can be reused at once, and is then deleted file by file without blocking the caller.
+    """
+
+    def __init__(self):
+        """
+        Starts the background deletion thread
+        """
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._count = 0
+
+        self._thread = threading.Thread(target=self._delete_folders, daemon=True)
+        self._thread.start()
+
+    def discard(self, folder):
+        """
+        Moves a folder aside and queues it for deletion
+        :param folder: Address of the folder to delete (str)
+        :return: Address the folder was moved to (str)
+        """
+
+        folder = os.path.normpath(folder)
+
+        # Folders already moved aside only need deleting
+        if TRASH_MARKER in os.path.basename(folder):
+            self._queue.put(folder)
+            return folder
+
+        with self._lock:
+            self._count += 1
+            trash_folder = os.path.join(os.path.dirname(folder),
+                                        "." + os.path.basename(folder)
+                                        + f"{TRASH_MARKER}{socket.gethostname()}_{os.getpid()}_{self._count}")
+
+        os.rename(folder, trash_folder)
+        self._queue.put(trash_folder)
+
+        return trash_folder
+
+    def _delete_folders(self):
+        """
+        Deletes queued folders until the service is closed
+        """
+
+        while True:
+            folder = self._queue.get()
+            try:
+                if folder is None:
+                    return
+                shutil.rmtree(folder, ignore_errors=True)
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """
+        Waits for every queued folder to be deleted
+        """
+
+        self._queue.join()
+
+    def close(self):
+        """
+        Deletes any queued folders and stops the background thread
+        """
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+_cleanup_service = None
+_cleanup_service_lock = threading.Lock()
+
+def cleanup_service():
+    """
+    Gets the cleanup service shared by the whole process, starting it if needed.
+    Folders still queued when the process exits are deleted before it ends.
+    :return: cleanup service (CleanupService)
+    """
+
+    global _cleanup_service
+
+    with _cleanup_service_lock:
+        if _cleanup_service is None:
+            _cleanup_service = CleanupService()
+            atexit.register(_cleanup_service.close)
+
+    return _cleanup_service
+
+def mark_owner(folder):
+    """
+    Marks a temporary folder as in use by this process, so it can be recognised as orphaned if the process dies
+    :param folder: Address of the temporary folder (str)
+    """
+
+    with open(os.path.join(folder, OWNER_FILE), "w") as owner_file:
+        owner_file.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+def is_orphaned(folder):
+    """
+    Checks if a folder was left behind by a process on this machine that is no longer running.
+    Folders waiting for deletion are named after their process, other folders need an owner marker.
+    :param folder: Address of the folder (str)
+    :return: True if the folder is orphaned, False otherwise
+    """
+
+    name = os.path.basename(os.path.normpath(folder))
+
+    try:
+        if TRASH_MARKER in name:
+            host, pid, _ = name.split(TRASH_MARKER)[-1].rsplit("_", 2)
+        else:
+            with open(os.path.join(folder, OWNER_FILE), "r") as owner_file:
+                host, pid = owner_file.read().split()
+        pid = int(pid)
+    except (OSError, ValueError):
+        return False
+
+    if host != socket.gethostname() or pid == os.getpid():
+        return False
+
+    return not process_running(pid)
+
+def process_running(pid):
+    """
+    Checks if a process is running on this machine
+    :param pid: process id (int)
+    :return: True if the process is running, False otherwise
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+def folder_size(folder):
+    """
+    Calculates the total size of the files in a folder
+    :param folder: Address of the folder (str)
+    :return: size in bytes (int)
+    """
+
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+def reclaim_orphaned_folders(parent_folder):
+    """
+    Deletes, in the background, the temporary folders in a folder left behind by crashed calibration runs
+    :param parent_folder: Folder to look for orphaned temporary folders in (str)
+    :return: number of bytes reclaimed (int)
+    """
+
+    if not os.path.isdir(parent_folder):
+        return 0
+
+    orphaned_folders = [os.path.join(parent_folder, name) for name in os.listdir(parent_folder)
+                        if os.path.isdir(os.path.join(parent_folder, name))
+                        and is_orphaned(os.path.join(parent_folder, name))]
+
+    if len(orphaned_folders) == 0:
+        return 0
+
+    reclaimed_bytes = 0
+    for folder in orphaned_folders:
+        reclaimed_bytes += folder_size(folder)
+        cleanup_service().discard(folder)
+
+    print(f"Reclaiming {reclaimed_bytes} bytes from {len(orphaned_folders)} orphaned temporary folders "
+          + f"in {parent_folder}")
+
+    return reclaimed_bytes
@@ -0,0 +1,315 @@
+"""
+Compressed archive of JULES dump files, storing the content shared between dumps only once.
+"""
+import os
+import re
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+# Name of the index database in the archive folder
+INDEX_NAME = "index.sqlite"
+
+# JULES dump files are named <run_id>.dump.<time>.nc, e.g. run.dump.spin1.19790101.0.nc
+DUMP_NAME_PATTERN = re.compile(r"^(?P<run_id>.+)\.dump\.(?P<dump_time>.+)\.nc$")
+
+
+class DumpArchive:
+    """
+    Archive of JULES dump files split into fixed size chunks. Each chunk is stored once, zlib compressed,
+    under the SHA-256 hash of its content, so the many nearly identical spin-up dumps of a sweep only add the
+    chunks that differ. An SQLite index maps (run_id, dump time) to the file name, size, file hash and list
+    of chunks of each dump. The archive is safe to share between threads.
+    """
+
+    def __init__(self, archive_folder, chunk_size = 2**18, compression_level = 6):
+        """
+        Opens the dump archive, creating it if needed
+        :param archive_folder: Folder to keep the archive in (str)
+        :param chunk_size: Size of the chunks dumps are split into, in bytes (int) (optional)
+        :param compression_level: zlib compression level of the chunks (int) (optional)
+        """
+
+        if not archive_folder.endswith("/"):
+            archive_folder += "/"
+
+        self.archive_folder = archive_folder
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+
+        os.makedirs(archive_folder + "chunks/", exist_ok=True)
+
+        self._lock = threading.RLock()
+
+        self._connection = sqlite3.connect(archive_folder + INDEX_NAME, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS dumps (
+                    run_id TEXT,
+                    dump_time TEXT,
+                    file_name TEXT,
+                    size INTEGER,
+                    sha256 TEXT,
+                    chunks TEXT,
+                    PRIMARY KEY (run_id, dump_time)
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER,
+                    stored_size INTEGER,
+                    refs INTEGER
+                );
+            """)
+
+    def _chunk_address(self, chunk_hash):
+        return self.archive_folder + "chunks/" + chunk_hash[:2] + "/" + chunk_hash
+
+    def add(self, run_id, dump_address, dump_time = None):
+        """
+        Adds a dump file to the archive, replacing any dump already archived for the same run and time
+        :param run_id: JULES run id of the run the dump belongs to (str)
+        :param dump_address: Address of the dump file (str)
+        :param dump_time: Time of the dump, defaults to the part of the file name after ".dump." (str) (optional)
+        :return: dump time the file is archived under (str)
+        """
+
+        file_name = os.path.basename(dump_address)
+        if dump_time is None:
+            dump_time = dump_time_from_name(file_name)
+
+        file_hash = hashlib.sha256()
+        chunk_hashes = []
+        size = 0
+
+        try:
+            with open(dump_address, "rb") as dump_file:
+                while True:
+                    chunk = dump_file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    file_hash.update(chunk)
+                    size += len(chunk)
+                    chunk_hashes.append(self._store_chunk(chunk))
+        except BaseException:
+            # Let go of the chunks stored so far
+            with self._lock, self._connection:
+                self._release_chunks(chunk_hashes)
+            raise
+
+        with self._lock, self._connection:
+            self._remove(run_id, dump_time)
+            self._connection.execute("INSERT INTO dumps VALUES (?, ?, ?, ?, ?, ?)",
+                                     (run_id, dump_time, file_name, size, file_hash.hexdigest(),
+                                      ",".join(chunk_hashes)))
+
+        return dump_time
+
+    def _store_chunk(self, chunk):
+        """
+        Writes a chunk to the archive if an identical chunk isn't already there, and counts a new user of it
+        :param chunk: Content of the chunk (bytes)
+        :return: hash of the chunk (str)
+        """
+
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        if self._add_chunk_user(chunk_hash):
+            return chunk_hash
+
+        compressed = zlib.compress(chunk, self.compression_level)
+
+        with self._lock:
+            # Another thread may have stored the same chunk while this one was compressing
+            if self._add_chunk_user(chunk_hash):
+                return chunk_hash
+
+            chunk_address = self._chunk_address(chunk_hash)
+            os.makedirs(os.path.dirname(chunk_address), exist_ok=True)
+
+            # Write to a temporary file first so a chunk is never left half written
+            with open(chunk_address + ".tmp", "wb") as chunk_file:
+                chunk_file.write(compressed)
+            os.replace(chunk_address + ".tmp", chunk_address)
+
+            with self._connection:
+                self._connection.execute("INSERT INTO chunks VALUES (?, ?, ?, 1)",
+                                         (chunk_hash, len(chunk), len(compressed)))
+
+        return chunk_hash
+
+    def _add_chunk_user(self, chunk_hash):
+        """
+        Counts a new user of a chunk if it is already in the archive
+        :return: True if the chunk is in the archive, False otherwise
+        """
+
+        with self._lock, self._connection:
+            return self._connection.execute("UPDATE chunks SET refs = refs + 1 WHERE sha256 = ?",
+                                            (chunk_hash,)).rowcount > 0
+
+    def _release_chunks(self, chunk_hashes):
+        """
+        Counts one fewer user of each chunk and deletes the chunks no dump uses, inside a transaction
+        """
+
+        self._connection.executemany("UPDATE chunks SET refs = refs - 1 WHERE sha256 = ?",
+                                     [(chunk_hash,) for chunk_hash in chunk_hashes])
+
+        for chunk_hash in set(chunk_hashes):
+            row = self._connection.execute("SELECT refs FROM chunks WHERE sha256 = ?", (chunk_hash,)).fetchone()
+            if row is not None and row[0] <= 0:
+                self._connection.execute("DELETE FROM chunks WHERE sha256 = ?", (chunk_hash,))
+                if os.path.exists(self._chunk_address(chunk_hash)):
+                    os.remove(self._chunk_address(chunk_hash))
+
+    def add_folder(self, run_id, folder, delete_dumps = True):
+        """
+        Adds every dump file in a folder to the archive
+        :param run_id: JULES run id of the run the dumps belong to (str)
+        :param folder: Folder containing the dump files (str)
+        :param delete_dumps: If True, deletes the dump files once archived (bool) (optional)
+        :return: dump times archived (list of str)
+        """
+
+        if not folder.endswith("/"):
+            folder += "/"
+
+        dump_times = []
+        for file in sorted(os.listdir(folder)):
+            if 'dump' in file:
+                dump_times.append(self.add(run_id, folder + file))
+                if delete_dumps:
+                    os.remove(folder + file)
+
+        return dump_times
+
+    def restore(self, run_id, dump_time, destination):
+        """
+        Writes an archived dump back out exactly as it was added
+        :param run_id: JULES run id of the run the dump belongs to (str)
+        :param dump_time: Time of the dump (str)
+        :param destination: Folder to write the dump to under its original name, or address of the file (str)
+        :return: address of the restored dump (str), or None if the dump isn't in the archive
+        """
+
+        with self._lock:
+            row = self._connection.execute("SELECT file_name, size, sha256, chunks FROM dumps "
+                                           "WHERE run_id = ? AND dump_time = ?", (run_id, dump_time)).fetchone()
+        if row is None:
+            print(f"No dump archived for run_id {run_id} at {dump_time}.")
+            return None
+        file_name, size, sha256, chunks = row
+
+        if destination.endswith("/") or os.path.isdir(destination):
+            os.makedirs(destination, exist_ok=True)
+            destination = os.path.join(destination, file_name)
+
+        file_hash = hashlib.sha256()
+        with open(destination + ".tmp", "wb") as dump_file:
+            for chunk_hash in chunks.split(",") if chunks else []:
+                with open(self._chunk_address(chunk_hash), "rb") as chunk_file:
+                    chunk = zlib.decompress(chunk_file.read())
+                file_hash.update(chunk)
+                dump_file.write(chunk)
+
+        if file_hash.hexdigest() != sha256 or os.path.getsize(destination + ".tmp") != size:
+            os.remove(destination + ".tmp")
+            raise IOError(f"Archived dump for run_id {run_id} at {dump_time} is corrupt")
+        os.replace(destination + ".tmp", destination)
+
+        return destination
+
+    def restore_run(self, run_id, destination_folder):
+        """
+        Writes every archived dump of a run to a folder
+        :param run_id: JULES run id (str)
+        :param destination_folder: Folder to write the dumps to (str)
+        :return: addresses of the restored dumps (list of str)
+        """
+
+        if not destination_folder.endswith("/"):
+            destination_folder += "/"
+
+        return [self.restore(run_id, dump_time, destination_folder) for _, dump_time, _, _ in self.entries(run_id)]
+
+    def entries(self, run_id = None):
+        """
+        Lists the archived dumps
+        :param run_id: Only list the dumps of this run (str) (optional)
+        :return: run id, dump time, file name and size of each dump (list of tuples)
+        """
+
+        with self._lock:
+            if run_id is None:
+                return self._connection.execute("SELECT run_id, dump_time, file_name, size FROM dumps "
+                                                "ORDER BY run_id, dump_time").fetchall()
+            return self._connection.execute("SELECT run_id, dump_time, file_name, size FROM dumps "
+                                            "WHERE run_id = ? ORDER BY dump_time", (run_id,)).fetchall()
+
+    def remove(self, run_id, dump_time = None):
+        """
+        Removes dumps from the archive, deleting chunks no other dump uses
+        :param run_id: JULES run id (str)
+        :param dump_time: Time of the dump, or None to remove every dump of the run (str) (optional)
+        """
+
+        with self._lock, self._connection:
+            if dump_time is not None:
+                self._remove(run_id, dump_time)
+            else:
+                for _, dump_time, _, _ in self.entries(run_id):
+                    self._remove(run_id, dump_time)
+
+    def _remove(self, run_id, dump_time):
+        """
+        Removes one dump from the index and drops the chunks it was the last user of, inside a transaction
+        """
+
+        row = self._connection.execute("SELECT chunks FROM dumps WHERE run_id = ? AND dump_time = ?",
+                                       (run_id, dump_time)).fetchone()
+        if row is None:
+            return
+
+        self._connection.execute("DELETE FROM dumps WHERE run_id = ? AND dump_time = ?", (run_id, dump_time))
+        self._release_chunks(row[0].split(",") if row[0] else [])
+
+    def usage(self):
+        """
+        Summarises the space used by the archive
+        :return: number of dumps, total size of the dumps, size of the unique chunks and size of the
+                 compressed chunks on disk, in bytes (dict)
+        """
+
+        with self._lock:
+            n_dumps, dump_bytes = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                                                           "FROM dumps").fetchone()
+            unique_bytes, stored_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0), "
+                                                                  "COALESCE(SUM(stored_size), 0) "
+                                                                  "FROM chunks").fetchone()
+
+        return {"n_dumps": n_dumps,
+                "dump_bytes": dump_bytes,
+                "unique_bytes": unique_bytes,
+                "stored_bytes": stored_bytes}
+
+    def close(self):
+        """
+        Closes the index database
+        """
+
+        with self._lock:
+            self._connection.close()
+
+def dump_time_from_name(file_name):
+    """
+    Gets the dump time from the name of a JULES dump file
+    :param file_name: Name of the dump file, e.g. run.dump.spin1.19790101.0.nc (str)
+    :return: dump time, e.g. spin1.19790101.0, or the file name if it doesn't follow the JULES pattern (str)
+    """
+
+    match = DUMP_NAME_PATTERN.match(file_name)
+    if match is None:
+        return file_name
+
+    return match.group("dump_time")
@@ -0,0 +1,141 @@
+"""
+Cheap statistical emulator of JULES run scores, used to predict runs that haven't been made.
+"""
+
+
+class GaussianProcessEmulator:
+    """
+    Gaussian process regression with a squared exponential kernel with one length scale per input.
+    Inputs are scaled to the unit cube and outputs standardised before fitting. The length scales and noise
+    level are chosen by maximising the marginal likelihood. Predictions come with a standard deviation.
+    """
+
+    def __init__(self, length_scale_bounds = (1e-2, 1e2), noise_bounds = (1e-8, 1e-1), n_restarts = 2, seed = None):
+        """
+        Creates the emulator
+        :param length_scale_bounds: Limits of the length scales, in scaled input units (tuple) (optional)
+        :param noise_bounds: Limits of the noise variance, relative to the output variance (tuple) (optional)
+        :param n_restarts: Number of extra random starting points for the hyperparameter search (int) (optional)
+        :param seed: Random seed for the starting points (int) (optional)
+        """
+
+        self.length_scale_bounds = length_scale_bounds
+        self.noise_bounds = noise_bounds
+        self.n_restarts = n_restarts
+        self.seed = seed
+
+        self.length_scales = None
+        self.noise = None
+
+    def fit(self, inputs, outputs, input_bounds = None):
+        """
+        Fits the emulator to the completed runs
+        :param inputs: Inputs of each run (array like, n_runs by n_inputs)
+        :param outputs: Output of each run (array like, n_runs)
+        :param input_bounds: Lower and upper value of each input used to scale the inputs, defaults to the
+                             range of the inputs given (array like, n_inputs by 2) (optional)
+        :return: the emulator (GaussianProcessEmulator)
+        """
+
+        import numpy as np
+        from scipy.optimize import minimize
+
+        inputs = np.asarray(inputs, dtype=float)
+        outputs = np.asarray(outputs, dtype=float)
+
+        if input_bounds is None:
+            input_bounds = np.stack([inputs.min(axis=0), inputs.max(axis=0)], axis=1)
+        input_bounds = np.asarray(input_bounds, dtype=float)
+        self._input_offset = input_bounds[:, 0]
+        self._input_scale = np.where(input_bounds[:, 1] > input_bounds[:, 0], input_bounds[:, 1] - input_bounds[:, 0], 1.0)
+
+        self._output_mean = outputs.mean()
+        self._output_scale = outputs.std() if outputs.std() > 0 else 1.0
+
+        self._inputs = self._scale(inputs)
+        self._outputs = (outputs - self._output_mean) / self._output_scale
+
+        # Search for the hyperparameters in log space
+        n_inputs = inputs.shape[1]
+        bounds = [tuple(np.log(self.length_scale_bounds))] * n_inputs + [tuple(np.log(self.noise_bounds))]
+
+        rng = np.random.default_rng(self.seed)
+        starts = [np.append(np.full(n_inputs, np.log(0.5)), np.log(1e-4))]
+        for _ in range(self.n_restarts):
+            starts.append(np.array([rng.uniform(low, high) for low, high in bounds]))
+
+        best = None
+        for start in starts:
+            result = minimize(self._negative_log_likelihood, start, method="L-BFGS-B", bounds=bounds)
+            if best is None or result.fun < best.fun:
+                best = result
+
+        self.length_scales = np.exp(best.x[:-1])
+        self.noise = np.exp(best.x[-1])
+        self._factor, self._weights = self._solve(self.length_scales, self.noise)
+
+        return self
+
+    def predict(self, inputs, batch_size = 10000):
+        """
+        Predicts the output of runs, a batch at a time to limit the memory used
+        :param inputs: Inputs of each run (array like, n_runs by n_inputs)
+        :param batch_size: Number of runs to predict at once (int) (optional)
+        :return: predicted mean (numpy array), standard deviation (numpy array)
+        """
+
+        import numpy as np
+        from scipy.linalg import solve_triangular
+
+        inputs = self._scale(np.asarray(inputs, dtype=float))
+
+        mean = np.empty(len(inputs))
+        std = np.empty(len(inputs))
+        for start in range(0, len(inputs), batch_size):
+            batch = slice(start, start + batch_size)
+            cross_covariance = self._kernel(inputs[batch], self._inputs, self.length_scales)
+            mean[batch] = cross_covariance @ self._weights
+            projection = solve_triangular(self._factor, cross_covariance.T, lower=True)
+            std[batch] = np.sqrt(np.maximum(1 - (projection * projection).sum(axis=0), 0))
+
+        return mean * self._output_scale + self._output_mean, std * self._output_scale
+
+    def _scale(self, inputs):
+        return (inputs - self._input_offset) / self._input_scale
+
+    @staticmethod
+    def _kernel(inputs_a, inputs_b, length_scales):
+        import numpy as np
+
+        scaled_a = inputs_a / length_scales
+        scaled_b = inputs_b / length_scales
+        squared_distances = ((scaled_a * scaled_a).sum(axis=1)[:, None] + (scaled_b * scaled_b).sum(axis=1)[None, :]
+                             - 2 * scaled_a @ scaled_b.T)
+
+        return np.exp(-0.5 * np.maximum(squared_distances, 0))
+
+    def _solve(self, length_scales, noise):
+        """
+        Factorises the covariance of the training runs
+        :return: lower Cholesky factor of the covariance (numpy array), covariance inverse times outputs (numpy array)
+        """
+
+        import numpy as np
+        from scipy.linalg import cholesky, cho_solve
+
+        covariance = self._kernel(self._inputs, self._inputs, length_scales)
+        covariance[np.diag_indices_from(covariance)] += noise + 1e-10
+
+        factor = cholesky(covariance, lower=True)
+        return factor, cho_solve((factor, True), self._outputs)
+
+    def _negative_log_likelihood(self, log_parameters):
+        import numpy as np
+        from scipy.linalg import LinAlgError
+
+        try:
+            factor, weights = self._solve(np.exp(log_parameters[:-1]), np.exp(log_parameters[-1]))
+        except LinAlgError:
+            return np.inf
+
+        return 0.5 * self._outputs @ weights + np.log(np.diag(factor)).sum()
@@ -0,0 +1,163 @@
+"""
+Code to collect the outputs of a sweep into a single compressed NetCDF4 ensemble file.
+"""
+import os
+import threading
+
+from Calibration.general.results_store import to_float
+
+
+class EnsembleArchive:
+    """
+    Single NetCDF4 file holding the output of every run in a sweep.
+    Each JULES output variable that changes between runs gets a leading "run" dimension, and the run id and
+    parameter values of each member are stored as coordinates along "run". Members are appended one at a time
+    as their runs finish, and the data is chunked along "run" so a variable can be read for all members at once.
+    """
+
+    def __init__(self,
+                 archive_address,
+                 parameter_names,
+                 run_chunk_size = 16,
+                 compression_level = 4):
+        """
+        Opens the ensemble archive, creating it when the first member is appended if it doesn't exist
+        :param archive_address: Address of the ensemble NetCDF4 file (str)
+        :param parameter_names: Names of the parameters stored for each member (list of str)
+        :param run_chunk_size: Number of members in each chunk of the archive (int) (optional)
+        :param compression_level: zlib compression level (int) (optional)
+        """
+
+        self.archive_address = archive_address
+        self.parameter_names = list(parameter_names)
+        self.run_chunk_size = run_chunk_size
+        self.compression_level = compression_level
+
+        self._lock = threading.Lock()
+
+    def append(self, run_id, parameters, member_address, delete_member = True):
+        """
+        Appends the output of one run to the archive
+        :param run_id: JULES run id (str)
+        :param parameters: Parameter values of the run (dict of str)
+        :param member_address: Address of the run's JULES output file (str)
+        :param delete_member: If True, deletes the run's output file once archived (bool) (optional)
+        :return: position of the member along the run dimension (int)
+        """
+
+        import numpy as np
+        import netCDF4
+
+        with self._lock:
+            with netCDF4.Dataset(member_address, "r") as member:
+
+                if not os.path.exists(self.archive_address):
+                    self._create(member)
+
+                with netCDF4.Dataset(self.archive_address, "a") as archive:
+                    run = len(archive.dimensions["run"])
+
+                    # Coordinates of the member
+                    archive.variables["run_id"][run] = run_id
+                    for name in self.parameter_names:
+                        value = parameters.get(name)
+                        archive.variables[name + "_value"][run] = str(value)
+                        numeric_value = to_float(value)
+                        archive.variables[name][run] = np.nan if numeric_value is None else numeric_value
+
+                    # Output of the member
+                    for name, variable in member.variables.items():
+                        if is_member_variable(name, variable):
+                            archive.variables[name][run, ...] = variable[...]
+
+        if delete_member:
+            os.remove(member_address)
+
+        return run
+
+    def _create(self, template):
+        """
+        Creates the archive using the dimensions and variables of a JULES output file
+        :param template: First member to be archived (netCDF4.Dataset)
+        """
+
+        import numpy as np
+        import netCDF4
+
+        with netCDF4.Dataset(self.archive_address, "w", format="NETCDF4") as archive:
+            archive.setncatts({name: template.getncattr(name) for name in template.ncattrs()})
+
+            archive.createDimension("run", None)
+            for name, dimension in template.dimensions.items():
+                archive.createDimension(name, len(dimension))
+
+            # Member coordinates
+            archive.createVariable("run_id", str, ("run",))
+            for name in self.parameter_names:
+                archive.createVariable(name, "f8", ("run",), fill_value=np.nan)
+                archive.createVariable(name + "_value", str, ("run",))
+            coordinates = " ".join(["run_id"] + self.parameter_names + [name + "_value" for name in self.parameter_names])
+
+            for name, variable in template.variables.items():
+                attributes = {key: variable.getncattr(key) for key in variable.ncattrs() if key != "_FillValue"}
+                fill_value = variable.getncattr("_FillValue") if "_FillValue" in variable.ncattrs() else None
+
+                if is_member_variable(name, variable):
+                    # Store a copy of the variable for every member
+                    new_variable = archive.createVariable(name,
+                                                          variable.dtype,
+                                                          ("run",) + variable.dimensions,
+                                                          zlib=True,
+                                                          complevel=self.compression_level,
+                                                          chunksizes=(self.run_chunk_size,) + variable.shape,
+                                                          fill_value=fill_value)
+                    attributes["coordinates"] = (attributes.get("coordinates", "") + " " + coordinates).strip()
+                else:
+                    # Variables that are the same for every member are only stored once
+                    new_variable = archive.createVariable(name,
+                                                          variable.dtype,
+                                                          variable.dimensions,
+                                                          fill_value=fill_value)
+                    new_variable[...] = variable[...]
+
+                new_variable.setncatts(attributes)
+
+    def run_ids(self):
+        """
+        Gets the run ids of the archived members
+        :return: run ids (list of str)
+        """
+
+        import netCDF4
+
+        if not os.path.exists(self.archive_address):
+            return []
+
+        with self._lock:
+            with netCDF4.Dataset(self.archive_address, "r") as archive:
+                return list(archive.variables["run_id"][:])
+
+    def read(self, variable_name):
+        """
+        Reads a variable for every archived member
+        :param variable_name: Name of the variable (str)
+        :return: values with the run dimension first (numpy array)
+        """
+
+        import netCDF4
+
+        with self._lock:
+            with netCDF4.Dataset(self.archive_address, "r") as archive:
+                return archive.variables[variable_name][...]
+
+def is_member_variable(name, variable):
+    """
+    Checks if a JULES output variable changes between runs and so is stored for each member
+    :param name: Name of the variable (str)
+    :param variable: The variable (netCDF4.Variable)
+    :return: True if the variable is stored for each member, False otherwise
+    """
+
+    # Dimension coordinates (e.g. time) and variables without a time dimension (e.g. latitude)
+    # are the same for every run
+    return name not in variable.dimensions and "time" in variable.dimensions
@@ -2,8 +2,11 @@
 General file management code.
 """
 import os
+import logging
 from logging import exception
+from Calibration.general.cleanup import cleanup_service
 
+logger = logging.getLogger(__name__)
 
 def make_folder(new_folder,
                 overwrite_existing=False):
@@ -15,17 +18,12 @@ def make_folder(new_folder,
     :return: new_folder address (str)
     """
 
-    print(f"{new_folder} exists: {os.path.exists(new_folder)}")
+    logger.debug(f"{new_folder} exists: {os.path.exists(new_folder)}")
 
     if(os.path.exists(new_folder)):
         if overwrite_existing:
-            # Walk through the directory and delete all files
-            for root, dirs, files in os.walk(new_folder, topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
-            os.rmdir(new_folder)
+            # Move the existing folder aside and delete it in the background
+            cleanup_service().discard(new_folder)
         else:
             exception(f"ERROR: {new_folder} folder already exists.\n"
                       + "Please delete the folder or set overwrite_tmp_files = True.\n")
@@ -35,20 +33,18 @@ def make_folder(new_folder,
 
     return new_folder
 
-def delete_folder(folder):
+def delete_folder(folder, background = True):
     """
     Deletes a folder and all its contents
     :param folder: Address of the folder to delete (str)
+    :param background: If True, moves the folder aside at once and deletes it in the background (bool) (optional)
     """
 
-    # Walk through the directory
-    for root, dirs, files in os.walk(folder, topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
+    # Move the folder aside and delete it in the background
+    cleanup_service().discard(folder)
 
-    # Delete the folder
-    os.rmdir(folder)
+    # Wait for the folder to be deleted
+    if not background:
+        cleanup_service().wait()
 
     return True
\ No newline at end of file
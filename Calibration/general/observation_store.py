@@ -0,0 +1,198 @@
+"""
+Cache of observation csv files in a columnar format that can be memory mapped, so large site files are
+only parsed once.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+# Name of the file describing a cached observation file
+MANIFEST_NAME = "columns.json"
+
+
+class ObservationStore:
+    """
+    Cache of observation csv files keyed by a hash of the file contents and the options used to read it.
+    The first time a file is loaded it is parsed with pandas, sorted by time and written as one .npy file
+    per numeric column plus the times. Later loads memory map only the columns asked for and read only the
+    rows in the time period asked for, found by binary search on the times.
+    """
+
+    def __init__(self, cache_folder):
+        """
+        Opens the observation store, creating the cache folder if needed
+        :param cache_folder: Folder to keep the cached observations in (str)
+        """
+
+        if not cache_folder.endswith("/"):
+            cache_folder += "/"
+
+        self.cache_folder = cache_folder
+        os.makedirs(cache_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # Hashes of source files, keyed by (address, size, modification time)
+        self._file_hashes = {}
+
+    def key(self, csv_address, index_column = 0, time_format = None, **read_csv_arguments):
+        """
+        Calculates the cache key of an observation file and the options used to read it
+        :param csv_address: Address of the csv file (str)
+        :param index_column: Column holding the times (int or str) (optional)
+        :param time_format: strftime format of the times, if pandas can't work them out (str) (optional)
+        :param read_csv_arguments: Other arguments of pandas.read_csv, e.g. na_values (optional)
+        :return: cache key (str)
+        """
+
+        status = os.stat(csv_address)
+        file_id = (os.path.abspath(csv_address), status.st_size, status.st_mtime_ns)
+
+        if file_id not in self._file_hashes:
+            file_hash = hashlib.sha256()
+            with open(csv_address, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    file_hash.update(block)
+            self._file_hashes[file_id] = file_hash.hexdigest()
+
+        key = hashlib.sha256(self._file_hashes[file_id].encode())
+        key.update(json.dumps([index_column, time_format, read_csv_arguments], sort_keys=True, default=str).encode())
+
+        return key.hexdigest()
+
+    def entry_folder(self, key):
+        """
+        Gets the folder holding a cached observation file
+        :param key: cache key (str)
+        :return: folder address (str)
+        """
+
+        return self.cache_folder + key[:2] + "/" + key + "/"
+
+    def ingest(self, csv_address, index_column = 0, time_format = None, **read_csv_arguments):
+        """
+        Parses an observation csv file into the cache, unless it is already there
+        :param csv_address: Address of the csv file (str)
+        :param index_column: Column holding the times (int or str) (optional)
+        :param time_format: strftime format of the times, if pandas can't work them out (str) (optional)
+        :param read_csv_arguments: Other arguments of pandas.read_csv, e.g. na_values (optional)
+        :return: folder of the cached observations (str)
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        entry_folder = self.entry_folder(self.key(csv_address, index_column, time_format, **read_csv_arguments))
+
+        with self._lock:
+            if os.path.isdir(entry_folder):
+                return entry_folder
+
+            print(f"Caching observations from {csv_address}...")
+            data = pd.read_csv(csv_address, index_col=index_column, **read_csv_arguments)
+            if time_format is not None:
+                data.index = pd.to_datetime(data.index.astype(str), format=time_format)
+            else:
+                data.index = pd.to_datetime(data.index)
+            data = data.sort_index(kind="stable")
+
+            # Build the entry in a separate folder so a partly written entry is never used
+            partial_folder = entry_folder[:-1] + f".partial_{threading.get_ident()}/"
+            os.makedirs(partial_folder, exist_ok=True)
+
+            np.save(partial_folder + "time.npy", data.index.to_numpy(dtype="datetime64[ns]"))
+
+            columns = []
+            for position, column in enumerate(data.columns):
+                if not pd.api.types.is_numeric_dtype(data[column]):
+                    print(f"Column {column} of {csv_address} isn't numeric, so isn't cached.")
+                    continue
+                file_name = f"column_{position}.npy"
+                np.save(partial_folder + file_name, data[column].to_numpy(dtype=float))
+                columns.append({"name": str(column), "file": file_name})
+
+            with open(partial_folder + MANIFEST_NAME, "w") as manifest:
+                json.dump({"source": os.path.abspath(csv_address),
+                           "index_name": data.index.name,
+                           "n_rows": len(data),
+                           "columns": columns},
+                          manifest,
+                          indent=1)
+
+            os.rename(partial_folder, entry_folder)
+
+        return entry_folder
+
+    def arrays(self, csv_address, columns = None, time_period = None, index_column = 0, time_format = None,
+               **read_csv_arguments):
+        """
+        Gets observation columns as memory mapped arrays, ingesting the file first if needed
+        :param csv_address: Address of the csv file (str)
+        :param columns: Columns to read, defaults to every numeric column (list of str) (optional)
+        :param time_period: First and last time to read, either can be None (tuple) (optional)
+        :param index_column: Column holding the times (int or str) (optional)
+        :param time_format: strftime format of the times, if pandas can't work them out (str) (optional)
+        :param read_csv_arguments: Other arguments of pandas.read_csv, e.g. na_values (optional)
+        :return: times (numpy datetime64 array), values of each column keyed by name (dict of numpy arrays)
+        """
+
+        import numpy as np
+
+        entry_folder = self.ingest(csv_address, index_column, time_format, **read_csv_arguments)
+
+        with open(entry_folder + MANIFEST_NAME, "r") as manifest:
+            column_files = {column["name"]: column["file"] for column in json.load(manifest)["columns"]}
+
+        if columns is None:
+            columns = list(column_files)
+        elif type(columns) is str:
+            columns = [columns]
+
+        missing_columns = [column for column in columns if column not in column_files]
+        if len(missing_columns) > 0:
+            raise KeyError(f"Columns {missing_columns} are not numeric columns of {csv_address}")
+
+        # Find the rows in the time period from the sorted times
+        times = np.load(entry_folder + "time.npy", mmap_mode="r")
+        start, end = 0, len(times)
+        if time_period is not None:
+            if time_period[0] is not None:
+                start = np.searchsorted(times, np.datetime64(time_period[0], "ns"), side="left")
+            if time_period[1] is not None:
+                end = np.searchsorted(times, np.datetime64(time_period[1], "ns"), side="right")
+
+        return times[start:end], {column: np.load(entry_folder + column_files[column], mmap_mode="r")[start:end]
+                                  for column in columns}
+
+    def load(self, csv_address, columns = None, time_period = None, index_column = 0, time_format = None,
+             **read_csv_arguments):
+        """
+        Loads observations as a dataframe for optimise_variable and the other calibration functions,
+        ingesting the file first if needed
+        :param csv_address: Address of the csv file (str)
+        :param columns: Columns to read, defaults to every numeric column (list of str) (optional)
+        :param time_period: First and last time to read, either can be None (tuple) (optional)
+        :param index_column: Column holding the times (int or str) (optional)
+        :param time_format: strftime format of the times, if pandas can't work them out (str) (optional)
+        :param read_csv_arguments: Other arguments of pandas.read_csv, e.g. na_values (optional)
+        :return: pandas dataframe of the observations indexed by time
+        """
+
+        import pandas as pd
+
+        times, values = self.arrays(csv_address, columns, time_period, index_column, time_format,
+                                    **read_csv_arguments)
+
+        return pd.DataFrame(values, index=pd.DatetimeIndex(times), copy=False)
+
+    def clear(self):
+        """
+        Removes every cached observation file
+        """
+
+        with self._lock:
+            for prefix in os.listdir(self.cache_folder):
+                shutil.rmtree(self.cache_folder + prefix)
+            self._file_hashes = {}
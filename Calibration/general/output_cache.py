@@ -0,0 +1,228 @@
+"""
+Content addressed cache of JULES outputs, shared between sweeps and optimisations.
+"""
+import os
+import re
+import shutil
+import hashlib
+import threading
+
+# Namelist variables that only say where the output goes, so don't change the results
+IGNORED_NAMELIST_VARIABLES = ("run_id", "output_dir")
+
+# Placeholder for the run id in the names of cached output files
+RUN_ID_PLACEHOLDER = "{run_id}"
+
+
+class OutputCache:
+    """
+    Cache of JULES outputs keyed by a hash of everything that determines them: the fully edited namelists,
+    the contents of every file the namelists refer to (e.g. ancillary and soil files) and the JULES executable.
+    Cached outputs are hard linked into place, so a hit costs no copying, and the least recently used
+    outputs are removed when the cache grows past its size budget.
+    """
+
+    def __init__(self, cache_folder, max_size_bytes = None):
+        """
+        Opens the output cache, creating the cache folder if needed
+        :param cache_folder: Folder to keep the cached outputs in (str)
+        :param max_size_bytes: Size budget of the cache, or None for no limit (int) (optional)
+        """
+
+        if not cache_folder.endswith("/"):
+            cache_folder += "/"
+
+        self.cache_folder = cache_folder
+        self.max_size_bytes = max_size_bytes
+
+        os.makedirs(cache_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # Hashes of referenced files, keyed by (address, size, modification time)
+        self._file_hashes = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, namelist_folder, jules_executable_address):
+        """
+        Calculates the cache key of a JULES run from its namelists, the files they refer to and the executable
+        :param namelist_folder: Folder containing the run's namelists (str)
+        :param jules_executable_address: Address of the JULES executable (str)
+        :return: cache key (str)
+        """
+
+        key = hashlib.sha256()
+
+        # The executable may be a command found on the PATH. If it can't be found, use the command itself
+        executable = jules_executable_address.split(" ")[0]
+        if not os.path.isfile(executable):
+            executable = shutil.which(executable)
+        if executable is not None:
+            key.update(self.file_hash(executable).encode())
+        else:
+            key.update(jules_executable_address.encode())
+
+        for file in sorted(os.listdir(namelist_folder)):
+            if not file.endswith(".nml"):
+                continue
+
+            key.update(file.encode())
+            with open(os.path.join(namelist_folder, file), "r") as namelist:
+                for line in namelist:
+                    if line.strip().split("=")[0].strip() in IGNORED_NAMELIST_VARIABLES:
+                        continue
+
+                    # Replace the address of any file the namelist refers to with a hash of its contents,
+                    # so copies of the same file in different temporary folders give the same key
+                    for address in re.findall(r"'([^']*)'|\"([^\"]*)\"", line):
+                        address = address[0] or address[1]
+                        full_address = os.path.join(namelist_folder, address)
+                        if address != "" and os.path.isfile(full_address):
+                            line = line.replace(address, self.file_hash(full_address))
+
+                    key.update(line.encode())
+
+        return key.hexdigest()
+
+    def file_hash(self, file_address):
+        """
+        Hashes the contents of a file, reusing the hash if the file hasn't changed since it was last hashed
+        :param file_address: Address of the file (str)
+        :return: hash of the file contents (str)
+        """
+
+        status = os.stat(file_address)
+        file_id = (os.path.abspath(file_address), status.st_size, status.st_mtime_ns)
+
+        if file_id not in self._file_hashes:
+            file_hash = hashlib.sha256()
+            with open(file_address, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    file_hash.update(block)
+            self._file_hashes[file_id] = file_hash.hexdigest()
+
+        return self._file_hashes[file_id]
+
+    def entry_folder(self, key):
+        """
+        Gets the folder holding the cached outputs for a key
+        :param key: cache key (str)
+        :return: folder address (str)
+        """
+
+        return self.cache_folder + key[:2] + "/" + key + "/"
+
+    def fetch(self, key, output_folder, run_id):
+        """
+        Links the cached outputs for a key into a JULES output folder
+        :param key: cache key (str)
+        :param output_folder: JULES output folder to put the outputs in (str)
+        :param run_id: run id to name the outputs with (str)
+        :return: True if the outputs were in the cache, False otherwise
+        """
+
+        entry_folder = self.entry_folder(key)
+
+        with self._lock:
+            if not os.path.isdir(entry_folder):
+                self.misses += 1
+                return False
+
+            for file in os.listdir(entry_folder):
+                link_file(entry_folder + file, output_folder + file.replace(RUN_ID_PLACEHOLDER, run_id))
+
+            # Mark the entry as recently used
+            os.utime(entry_folder)
+            self.hits += 1
+
+        return True
+
+    def store(self, key, output_folder, run_id):
+        """
+        Adds the outputs of a JULES run to the cache
+        :param key: cache key (str)
+        :param output_folder: JULES output folder holding the run's outputs (str)
+        :param run_id: run id the outputs are named with (str)
+        """
+
+        entry_folder = self.entry_folder(key)
+
+        with self._lock:
+            if os.path.isdir(entry_folder):
+                return
+
+            # Build the entry in a separate folder so a partly stored entry is never used
+            partial_folder = entry_folder[:-1] + f".partial_{threading.get_ident()}/"
+            os.makedirs(partial_folder, exist_ok=True)
+            for file in os.listdir(output_folder):
+                if run_id in file and not file.endswith(".out"):
+                    link_file(output_folder + file, partial_folder + file.replace(run_id, RUN_ID_PLACEHOLDER))
+
+            # Don't cache runs that produced no output
+            if len(os.listdir(partial_folder)) == 0:
+                os.rmdir(partial_folder)
+                return
+
+            os.rename(partial_folder, entry_folder)
+
+            self.evict()
+
+    def size(self):
+        """
+        Calculates the total size of the cached outputs
+        :return: size in bytes (int)
+        """
+
+        return sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        """
+        Lists the cache entries
+        :return: folder, size in bytes and last use time of each entry (list of tuples)
+        """
+
+        entries = []
+        for prefix in os.listdir(self.cache_folder):
+            for key in os.listdir(self.cache_folder + prefix):
+                # Skip entries still being stored
+                if ".partial_" in key:
+                    continue
+                entry_folder = self.cache_folder + prefix + "/" + key + "/"
+                size = sum(os.path.getsize(entry_folder + file) for file in os.listdir(entry_folder))
+                entries.append((entry_folder, size, os.path.getmtime(entry_folder)))
+
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its size budget
+        """
+
+        if self.max_size_bytes is None:
+            return
+
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+
+        for entry_folder, size, _ in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            total_size -= size
+
+def link_file(file_address, link_address):
+    """
+    Hard links a file to a new address, copying it if a hard link isn't possible (e.g. across file systems)
+    :param file_address: Address of the file (str)
+    :param link_address: Address of the link (str)
+    """
+
+    if os.path.exists(link_address):
+        os.remove(link_address)
+
+    try:
+        os.link(file_address, link_address)
+    except OSError:
+        shutil.copy2(file_address, link_address)
@@ -0,0 +1,89 @@
+"""
+General code used to run tasks in parallel.
+"""
+import threading
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_in_parallel(function, arguments, n_workers = 1, max_pending = None):
+    """
+    Calls a function on each item of an iterable using a pool of threads.
+    The iterable is consumed incrementally, so it can be a generator of any length.
+    :param function: Function to call on each item (callable)
+    :param arguments: Items to call the function on (iterable)
+    :param n_workers: Number of threads (int) (optional)
+    :param max_pending: Maximum number of items taken from the iterable but not yet finished (int) (optional)
+                        Defaults to n_workers.
+    :return: generator of the function results in the order they finish
+    """
+
+    if max_pending is None:
+        max_pending = n_workers
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for argument in arguments:
+
+            # Wait for a task to finish before taking more items from the iterable
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+            pending.add(executor.submit(function, argument))
+
+        # Wait for the remaining tasks
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def prefetch(function, arguments, n_ahead = 1):
+    """
+    Calls a function on each item of an iterable in a background thread, keeping the results for the
+    next n_ahead items ready before they are asked for. Used to prepare the next piece of work while
+    the current one runs.
+    :param function: Function to call on each item (callable)
+    :param arguments: Items to call the function on (iterable)
+    :param n_ahead: Number of results to keep ready (int) (optional)
+    :return: generator of the function results in the order of the items
+    """
+
+    results = Queue(maxsize=n_ahead)
+    stop = threading.Event()
+    finished = object()
+
+    def put(result):
+        # Give up if the generator has been closed, rather than waiting for space forever
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def prefetch_items():
+        try:
+            for argument in arguments:
+                if not put((True, function(argument))):
+                    return
+        except BaseException as error:
+            put((False, error))
+            return
+        put((True, finished))
+
+    thread = threading.Thread(target=prefetch_items, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            success, result = results.get()
+            if not success:
+                raise result
+            if result is finished:
+                return
+            yield result
+    finally:
+        stop.set()
@@ -0,0 +1,77 @@
+"""
+Background pipeline used to post-process JULES runs while the next run is going.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PostProcessingPipeline:
+    """
+    Runs post-processing jobs (moving outputs, archiving, scoring, writing run records) on a pool of
+    background threads. The number of jobs waiting or running is bounded, so submitting blocks once the
+    pipeline is full and the memory held by queued jobs stays capped.
+    """
+
+    def __init__(self, n_threads = 2, max_pending = 4):
+        """
+        Starts the pipeline
+        :param n_threads: Number of background threads (int) (optional)
+        :param max_pending: Maximum number of jobs waiting or running at once (int) (optional)
+        """
+
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures = []
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Adds a job to the pipeline, waiting for space if the pipeline is full
+        :param function: Job to run (callable)
+        :param args: Positional arguments of the job
+        :param kwargs: Keyword arguments of the job
+        :return: Future of the job's result (concurrent.futures.Future)
+        """
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        with self._lock:
+            # Keep only unfinished jobs and failed jobs, whose errors are raised by wait
+            self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+            self._futures.append(future)
+
+        return future
+
+    def wait(self):
+        """
+        Waits for every submitted job to finish, raising the first error from any of them
+        """
+
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        Waits for every submitted job to finish and stops the background threads
+        """
+
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
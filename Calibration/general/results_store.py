@@ -0,0 +1,311 @@
+"""
+SQLite store of the run records written by the calibration process.
+"""
+import csv
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+class ResultsStore:
+    """
+    Stores one record per JULES run (parameters, timings, scores, status and output path) in an SQLite
+    database in WAL mode. Records are written in batches and the store is safe to share between threads.
+    """
+
+    def __init__(self, database_address, batch_size = 50):
+        """
+        Opens the results store, creating the database if needed
+        :param database_address: Address of the SQLite database file (str)
+        :param batch_size: Number of records to hold before writing them to the database (int) (optional)
+        """
+
+        self.database_address = database_address
+        self.batch_size = batch_size
+
+        self._lock = threading.RLock()
+        self._pending_runs = []
+        self._pending_parameters = []
+        self._pending_scores = []
+
+        self._connection = sqlite3.connect(database_address, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        """
+        Creates the tables and indexes if they don't already exist
+        """
+
+        with self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    campaign TEXT,
+                    sweep_index INTEGER,
+                    run_date TEXT,
+                    start_time REAL,
+                    end_time REAL,
+                    run_time REAL,
+                    status TEXT,
+                    score REAL,
+                    output_path TEXT,
+                    attempts INTEGER,
+                    outcome TEXT
+                );
+                CREATE TABLE IF NOT EXISTS run_parameters (
+                    run_id TEXT,
+                    position INTEGER,
+                    name TEXT,
+                    value TEXT,
+                    numeric_value REAL,
+                    PRIMARY KEY (run_id, name)
+                );
+                CREATE TABLE IF NOT EXISTS run_scores (
+                    run_id TEXT,
+                    position INTEGER,
+                    name TEXT,
+                    value REAL,
+                    PRIMARY KEY (run_id, name)
+                );
+                CREATE INDEX IF NOT EXISTS runs_score ON runs (score);
+                CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+                CREATE INDEX IF NOT EXISTS runs_campaign ON runs (campaign, sweep_index);
+                CREATE INDEX IF NOT EXISTS run_parameters_numeric_value ON run_parameters (name, numeric_value);
+                CREATE INDEX IF NOT EXISTS run_parameters_value ON run_parameters (name, value);
+                CREATE INDEX IF NOT EXISTS run_scores_value ON run_scores (name, value);
+            """)
+
+            # Add the columns missing from stores made by earlier versions
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(runs)")]
+            for column, column_type in (("attempts", "INTEGER"), ("outcome", "TEXT")):
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE runs ADD COLUMN {column} {column_type}")
+
+    def add_run(self,
+                run_id,
+                parameters,
+                campaign = None,
+                sweep_index = None,
+                start_time = None,
+                end_time = None,
+                status = "complete",
+                score = None,
+                scores = None,
+                output_path = None,
+                attempts = None,
+                outcome = None):
+        """
+        Adds the record of a run. A record with the same run_id replaces the existing one.
+        :param run_id: JULES run id (str)
+        :param parameters: Parameter names and values used for the run, in order (dict of str)
+        :param campaign: Name of the sweep or optimisation the run belongs to (str) (optional)
+        :param sweep_index: Position of the run within the campaign (int) (optional)
+        :param start_time: Time the run started, in seconds since the epoch (float) (optional)
+        :param end_time: Time the run ended, in seconds since the epoch (float) (optional)
+        :param status: Status of the run, e.g. "running", "complete" or "failed" (str) (optional)
+        :param score: Overall score of the run (float) (optional)
+        :param scores: Score of each compared variable (dict of float) (optional)
+        :param output_path: Address of the run output (str) (optional)
+        :param attempts: Number of times JULES was started for the run (int) (optional)
+        :param outcome: How the run went, e.g. "ok", "retried", "duplicate" or "failed", see RunSupervisor
+                        (str) (optional)
+        """
+
+        if start_time is None:
+            start_time = time.time()
+
+        run_time = None
+        if end_time is not None:
+            run_time = end_time - start_time
+
+        with self._lock:
+            self._pending_runs.append((run_id,
+                                       campaign,
+                                       sweep_index,
+                                       f"{datetime.fromtimestamp(start_time):%Y-%m-%d %H:%M:%S}",
+                                       start_time,
+                                       end_time,
+                                       run_time,
+                                       status,
+                                       score,
+                                       output_path,
+                                       attempts,
+                                       outcome))
+
+            for position, (name, value) in enumerate(parameters.items()):
+                self._pending_parameters.append((run_id, position, name, str(value), to_float(value)))
+
+            if scores is not None:
+                for position, (name, value) in enumerate(scores.items()):
+                    self._pending_scores.append((run_id, position, name, value))
+
+            if len(self._pending_runs) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes any held records to the database
+        """
+
+        with self._lock:
+            if len(self._pending_runs) == 0:
+                return
+
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO runs (run_id, campaign, sweep_index, run_date, "
+                                             + "start_time, end_time, run_time, status, score, output_path, attempts, "
+                                             + "outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                             self._pending_runs)
+                self._connection.executemany("INSERT OR REPLACE INTO run_parameters VALUES (?, ?, ?, ?, ?)",
+                                             self._pending_parameters)
+                self._connection.executemany("INSERT OR REPLACE INTO run_scores VALUES (?, ?, ?, ?)",
+                                             self._pending_scores)
+
+            self._pending_runs = []
+            self._pending_parameters = []
+            self._pending_scores = []
+
+    def close(self):
+        """
+        Writes any held records and closes the database
+        """
+
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def query(self, sql, arguments = ()):
+        """
+        Runs an SQL query on the store
+        :param sql: SQL query (str)
+        :param arguments: Arguments of the query (tuple) (optional)
+        :return: rows returned by the query (list of tuples)
+        """
+
+        with self._lock:
+            self.flush()
+            return self._connection.execute(sql, arguments).fetchall()
+
+    def run_ids(self, campaign = None, status = None):
+        """
+        Gets the run ids in the store
+        :param campaign: Only return runs from this campaign (str) (optional)
+        :param status: Only return runs with this status (str) (optional)
+        :return: run ids (list of str)
+        """
+
+        sql = "SELECT run_id FROM runs WHERE 1=1"
+        arguments = []
+        if campaign is not None:
+            sql += " AND campaign = ?"
+            arguments.append(campaign)
+        if status is not None:
+            sql += " AND status = ?"
+            arguments.append(status)
+
+        return [row[0] for row in self.query(sql + " ORDER BY start_time", tuple(arguments))]
+
+    def best_runs(self, n_runs = 1):
+        """
+        Gets the completed runs with the lowest score
+        :param n_runs: Number of runs to return (int) (optional)
+        :return: run id and score of each run (list of tuples)
+        """
+
+        return self.query("SELECT run_id, score FROM runs WHERE score IS NOT NULL AND status = 'complete' "
+                          + "ORDER BY score LIMIT ?", (n_runs,))
+
+    def table(self):
+        """
+        Builds a table with one row per run and one column per parameter and score
+        :return: column names (list of str), rows (list of lists)
+        """
+
+        with self._lock:
+            self.flush()
+            runs = self._connection.execute("SELECT run_id, campaign, sweep_index, run_date, run_time, status, "
+                                            + "score, output_path, attempts, outcome FROM runs "
+                                            + "ORDER BY start_time").fetchall()
+            parameters = self._connection.execute("SELECT run_id, name, value FROM run_parameters "
+                                                  + "ORDER BY position").fetchall()
+            scores = self._connection.execute("SELECT run_id, name, value FROM run_scores "
+                                              + "ORDER BY position").fetchall()
+
+        # Keep the parameters and scores in the order they were first added
+        parameter_names = list(dict.fromkeys(name for _, name, _ in parameters))
+        score_names = list(dict.fromkeys(name for _, name, _ in scores))
+
+        run_parameters = {}
+        for run_id, name, value in parameters:
+            run_parameters.setdefault(run_id, {})[name] = value
+        run_scores = {}
+        for run_id, name, value in scores:
+            run_scores.setdefault(run_id, {})[name] = value
+
+        header = ["run_id", "run_date"] + parameter_names + score_names \
+                 + ["score", "run_time", "status", "campaign", "sweep_index", "output_path", "attempts", "outcome"]
+        rows = []
+        for run_id, campaign, sweep_index, run_date, run_time, status, score, output_path, attempts, outcome in runs:
+            rows.append([run_id, run_date]
+                        + [run_parameters.get(run_id, {}).get(name) for name in parameter_names]
+                        + [run_scores.get(run_id, {}).get(name) for name in score_names]
+                        + [score, run_time, status, campaign, sweep_index, output_path, attempts, outcome])
+
+        return header, rows
+
+    def to_dataframe(self):
+        """
+        Gets the run records as a pandas dataframe with one row per run
+        :return: pandas dataframe
+        """
+
+        import pandas as pd
+
+        header, rows = self.table()
+        return pd.DataFrame(rows, columns=header)
+
+    def export_csv(self, csv_address):
+        """
+        Writes the run records to a csv file with one row per run
+        :param csv_address: Address of the csv file (str)
+        """
+
+        header, rows = self.table()
+        with open(csv_address, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def export_parquet(self, parquet_address):
+        """
+        Writes the run records to a parquet file with one row per run (needs pyarrow or fastparquet)
+        :param parquet_address: Address of the parquet file (str)
+        """
+
+        self.to_dataframe().to_parquet(parquet_address)
+
+def to_float(value):
+    """
+    Converts a namelist value to a float where possible, e.g. "5*1.0e-9" gives 1.0e-9
+    :param value: value to convert (str or float)
+    :return: value as a float, or None if it isn't numeric
+    """
+
+    value = str(value).strip()
+    if "*" in value:
+        value = value.split("*")[1]
+    value = value.split(",")[0]
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
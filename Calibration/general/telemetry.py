@@ -0,0 +1,224 @@
+"""
+Structured progress and throughput reporting for calibration campaigns.
+"""
+import json
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger("Calibration.telemetry")
+
+
+class CampaignMonitor:
+    """
+    Collects events from a campaign (run start, run end, failure, score) and keeps a live summary:
+    runs per hour, mean and percentile run times, ETA, best score so far and worker utilisation.
+    Every event is a dictionary sent to the "Calibration.telemetry" logger as JSON, appended to a JSON lines
+    file if one is given and passed to any callbacks. A summary event is sent every summary_interval seconds.
+    """
+
+    def __init__(self,
+                 campaign,
+                 n_runs = None,
+                 n_workers = 1,
+                 log_address = None,
+                 callbacks = None,
+                 summary_interval = 60,
+                 verbose = True):
+        """
+        Starts monitoring a campaign
+        :param campaign: Name of the campaign, e.g. the run id prefix (str)
+        :param n_runs: Total number of runs in the campaign, if known, used for the ETA (int) (optional)
+        :param n_workers: Number of JULES runs going at the same time (int) (optional)
+        :param log_address: Address of a JSON lines file to append the events to (str) (optional)
+        :param callbacks: Functions called with each event (list of callables) (optional)
+        :param summary_interval: Seconds between summary events, or None for no summaries (float) (optional)
+        :param verbose: If True, prints a line for each run (bool) (optional)
+        """
+
+        self.campaign = campaign
+        self.n_runs = n_runs
+        self.n_workers = n_workers
+        self.log_address = log_address
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.summary_interval = summary_interval
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._last_summary = self._start_time
+
+        self.n_started = 0
+        self.n_complete = 0
+        self.n_failed = 0
+        self.n_skipped = 0
+        self.run_times = []
+        self.busy_time = 0.0
+        self.best_score = None
+        self.best_run_id = None
+
+        self.emit("campaign_start", n_runs = n_runs, n_workers = n_workers)
+
+    def add_callback(self, callback):
+        """
+        Registers a function called with each event
+        :param callback: callback function (callable)
+        """
+
+        self.callbacks.append(callback)
+
+    def emit(self, event, **fields):
+        """
+        Sends an event to the logger, the JSON lines file and the callbacks
+        :param event: Name of the event (str)
+        :param fields: Information about the event
+        """
+
+        record = {"event": event, "time": time.time(), "campaign": self.campaign}
+        record.update(fields)
+
+        line = json.dumps(record, default=str)
+        logger.info(line)
+
+        if self.log_address is not None:
+            with self._lock:
+                with open(self.log_address, "a") as log_file:
+                    log_file.write(line + "\n")
+
+        for callback in self.callbacks:
+            callback(record)
+
+    def run_started(self, run_id, sweep_index = None, worker = None):
+        """
+        Records the start of a run
+        :param run_id: JULES run id (str)
+        :param sweep_index: Position of the run in the campaign (int) (optional)
+        :param worker: Worker running JULES (int or str) (optional)
+        """
+
+        with self._lock:
+            self.n_started += 1
+
+        if self.verbose:
+            print(f"-- Running run_id {run_id} --")
+
+        self.emit("run_start", run_id = run_id, sweep_index = sweep_index, worker = worker)
+
+    def run_skipped(self, run_id, sweep_index = None):
+        """
+        Records a run skipped because its output already exists
+        :param run_id: JULES run id (str)
+        :param sweep_index: Position of the run in the campaign (int) (optional)
+        """
+
+        with self._lock:
+            self.n_skipped += 1
+
+        if self.verbose:
+            print(f"-- Skipping run_id {run_id}, output already complete --")
+
+        self.emit("run_skipped", run_id = run_id, sweep_index = sweep_index)
+
+    def run_finished(self, run_id, start_time, end_time, status = "complete", score = None, sweep_index = None):
+        """
+        Records the end of a run and its score
+        :param run_id: JULES run id (str)
+        :param start_time: Time the run started, in seconds since the epoch (float)
+        :param end_time: Time JULES finished, in seconds since the epoch (float)
+        :param status: Status of the run, "complete" or "failed" (str) (optional)
+        :param score: Score of the run (float) (optional)
+        :param sweep_index: Position of the run in the campaign (int) (optional)
+        """
+
+        run_time = end_time - start_time
+
+        with self._lock:
+            self.busy_time += run_time
+            if status == "complete":
+                self.n_complete += 1
+                self.run_times.append(run_time)
+            else:
+                self.n_failed += 1
+
+            if score is not None and not math.isnan(score) and (self.best_score is None or score < self.best_score):
+                self.best_score = score
+                self.best_run_id = run_id
+
+        if status == "complete":
+            self.emit("run_end", run_id = run_id, sweep_index = sweep_index, run_time = run_time, score = score)
+        else:
+            self.emit("run_failed", run_id = run_id, sweep_index = sweep_index, run_time = run_time)
+
+        if score is not None:
+            self.emit("run_score", run_id = run_id, sweep_index = sweep_index, score = score,
+                      best_score = self.best_score, best_run_id = self.best_run_id)
+
+        # Send a summary if one is due
+        if self.summary_interval is not None and time.time() - self._last_summary >= self.summary_interval:
+            self._last_summary = time.time()
+            self.emit("summary", **self.summary())
+
+    def summary(self):
+        """
+        Summarises the progress of the campaign
+        :return: campaign progress and throughput statistics (dict)
+        """
+
+        with self._lock:
+            elapsed = time.time() - self._start_time
+            n_finished = self.n_complete + self.n_failed
+            run_times = sorted(self.run_times)
+
+            summary = {"elapsed": elapsed,
+                       "runs_started": self.n_started,
+                       "runs_complete": self.n_complete,
+                       "runs_failed": self.n_failed,
+                       "runs_skipped": self.n_skipped,
+                       "runs_per_hour": 3600 * n_finished / elapsed if elapsed > 0 else None,
+                       "mean_run_time": sum(run_times) / len(run_times) if len(run_times) > 0 else None,
+                       "p50_run_time": percentile(run_times, 50),
+                       "p90_run_time": percentile(run_times, 90),
+                       "p99_run_time": percentile(run_times, 99),
+                       "best_score": self.best_score,
+                       "best_run_id": self.best_run_id,
+                       "worker_utilisation": self.busy_time / (elapsed * self.n_workers) if elapsed > 0 else None,
+                       "eta": None}
+
+            # Estimate the time left from the rate runs have finished so far
+            if self.n_runs is not None and n_finished > 0:
+                n_remaining = max(self.n_runs - n_finished - self.n_skipped, 0)
+                summary["eta"] = n_remaining * elapsed / n_finished
+
+        return summary
+
+    def close(self):
+        """
+        Sends the final summary of the campaign
+        :return: final summary (dict)
+        """
+
+        summary = self.summary()
+        self.emit("campaign_end", **summary)
+
+        if self.verbose:
+            print(f"{self.campaign} finished: {summary['runs_complete']} runs complete, "
+                  + f"{summary['runs_failed']} failed, {summary['runs_skipped']} skipped"
+                  + (f", best score {summary['best_score']} ({summary['best_run_id']})"
+                     if summary['best_score'] is not None else ""))
+
+        return summary
+
+def percentile(sorted_values, q):
+    """
+    Finds a percentile of a sorted list by the nearest rank method
+    :param sorted_values: values in ascending order (list of float)
+    :param q: percentile, between 0 and 100 (float)
+    :return: percentile (float), or None if there are no values
+    """
+
+    if len(sorted_values) == 0:
+        return None
+
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
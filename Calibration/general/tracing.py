@@ -0,0 +1,267 @@
+"""
+Lightweight tracing of the stages of a calibration run (namelist edits, JULES, file moves, output reading, scoring).
+Tracing is off by default, when it costs a single check per traced stage.
+"""
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import nullcontext
+
+# The active tracer, or None when tracing is off
+_tracer = None
+
+# Returned by span when tracing is off
+_NO_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Records named spans with their start time, duration, thread and any arguments given, optionally with the
+    memory allocated by python (tracemalloc) at the end of each span. Spans can be exported as a Chrome trace
+    (viewable in Perfetto or chrome://tracing) or summarised per stage. Hooks registered with add_hook are
+    called at the start and end of every span.
+    """
+
+    def __init__(self, trace_memory = False, memory_snapshots = False, max_spans = None):
+        """
+        Creates the tracer
+        :param trace_memory: If True, records the current and peak traced memory at the end of each span
+                             (bool) (optional)
+        :param memory_snapshots: If True, keeps a tracemalloc snapshot at the end of each top level span
+                                 (bool) (optional)
+        :param max_spans: Maximum number of spans to keep, the oldest are dropped first (int) (optional)
+        """
+
+        self.trace_memory = trace_memory or memory_snapshots
+        self.memory_snapshots = memory_snapshots
+        self.max_spans = max_spans
+
+        self.spans = []
+        self.snapshots = []
+        self.hooks = []
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+        # Only stop tracemalloc when tracing stops if it was started here
+        self.started_tracemalloc = self.trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def add_hook(self, hook):
+        """
+        Registers a function called as hook(event, span) at the start ("start") and end ("end") of every span
+        :param hook: hook function (callable)
+        """
+
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+        Removes a registered hook
+        :param hook: hook function (callable)
+        """
+
+        self.hooks.remove(hook)
+
+    def span(self, name, **arguments):
+        """
+        Makes a span timing the code run inside a with block
+        :param name: Name of the stage (str)
+        :param arguments: Extra information to record with the span, e.g. the run id
+        :return: context manager (Span)
+        """
+
+        return Span(self, name, arguments)
+
+    def _start(self, span):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        span.depth = len(stack)
+        stack.append(span)
+
+        for hook in self.hooks:
+            hook("start", span)
+
+    def _end(self, span):
+        self._local.stack.pop()
+
+        if self.trace_memory:
+            span.memory, span.peak_memory = tracemalloc.get_traced_memory()
+            if self.memory_snapshots and span.depth == 0:
+                with self._lock:
+                    self.snapshots.append((span.name, span.start, tracemalloc.take_snapshot()))
+
+        with self._lock:
+            self.spans.append(span)
+            if self.max_spans is not None and len(self.spans) > self.max_spans:
+                del self.spans[:len(self.spans) - self.max_spans]
+
+        for hook in self.hooks:
+            hook("end", span)
+
+    def export_chrome_trace(self, trace_address):
+        """
+        Writes the spans to a Chrome trace JSON file, which can be opened in Perfetto (ui.perfetto.dev)
+        :param trace_address: Address of the JSON file (str)
+        """
+
+        with self._lock:
+            spans = list(self.spans)
+
+        events = []
+        for span in spans:
+            arguments = {key: str(value) for key, value in span.arguments.items()}
+            if span.memory is not None:
+                arguments["memory_bytes"] = span.memory
+                arguments["peak_memory_bytes"] = span.peak_memory
+
+            events.append({"name": span.name,
+                           "ph": "X",
+                           "ts": (span.start - self._origin) * 1e6,
+                           "dur": span.duration * 1e6,
+                           "pid": os.getpid(),
+                           "tid": span.thread,
+                           "args": arguments})
+
+        with open(trace_address, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def summary(self):
+        """
+        Summarises the time spent in each stage
+        :return: count, total, mean and maximum duration in seconds of each stage, keyed by stage name (dict)
+        """
+
+        with self._lock:
+            spans = list(self.spans)
+
+        summary = {}
+        for span in spans:
+            stage = summary.setdefault(span.name, {"count": 0, "total": 0.0, "mean": 0.0, "max": 0.0})
+            stage["count"] += 1
+            stage["total"] += span.duration
+            stage["max"] = max(stage["max"], span.duration)
+
+        for stage in summary.values():
+            stage["mean"] = stage["total"] / stage["count"]
+
+        return summary
+
+    def print_summary(self):
+        """
+        Prints the time spent in each stage, longest total first
+        """
+
+        summary = sorted(self.summary().items(), key=lambda stage: stage[1]["total"], reverse=True)
+
+        print(f"{'stage':<40}{'count':>8}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}")
+        for name, stage in summary:
+            print(f"{name:<40}{stage['count']:>8}{stage['total']:>12.3f}{stage['mean']:>12.4f}{stage['max']:>12.4f}")
+
+class Span:
+    """
+    A timed stage recorded by a Tracer
+    """
+
+    __slots__ = ("tracer", "name", "arguments", "start", "duration", "thread", "depth", "memory", "peak_memory")
+
+    def __init__(self, tracer, name, arguments):
+        self.tracer = tracer
+        self.name = name
+        self.arguments = arguments
+        self.start = None
+        self.duration = None
+        self.thread = threading.get_ident()
+        self.depth = 0
+        self.memory = None
+        self.peak_memory = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.tracer._start(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.arguments["error"] = exc_type.__name__
+        self.tracer._end(self)
+
+def enable_tracing(trace_memory = False, memory_snapshots = False, max_spans = None):
+    """
+    Starts tracing the stages of calibration runs
+    :param trace_memory: If True, records the traced memory at the end of each span (bool) (optional)
+    :param memory_snapshots: If True, keeps a tracemalloc snapshot at the end of each top level span (bool) (optional)
+    :param max_spans: Maximum number of spans to keep (int) (optional)
+    :return: the tracer recording the spans (Tracer)
+    """
+
+    global _tracer
+    _tracer = Tracer(trace_memory = trace_memory, memory_snapshots = memory_snapshots, max_spans = max_spans)
+
+    return _tracer
+
+def disable_tracing():
+    """
+    Stops tracing
+    :return: the tracer that was recording the spans (Tracer), or None if tracing was off
+    """
+
+    global _tracer
+    tracer, _tracer = _tracer, None
+
+    if tracer is not None and tracer.started_tracemalloc:
+        tracemalloc.stop()
+
+    return tracer
+
+def get_tracer():
+    """
+    Gets the active tracer
+    :return: tracer (Tracer), or None if tracing is off
+    """
+
+    return _tracer
+
+def span(name, **arguments):
+    """
+    Times the code run inside a with block as a named stage, if tracing is on
+    :param name: Name of the stage (str)
+    :param arguments: Extra information to record with the span, e.g. the run id
+    :return: context manager
+    """
+
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+
+    return tracer.span(name, **arguments)
+
+def traced(name = None):
+    """
+    Decorator timing every call of a function as a named stage, if tracing is on
+    :param name: Name of the stage, defaults to the function's module and name (str) (optional)
+    :return: decorator
+    """
+
+    def decorator(function):
+        stage_name = name if name is not None else function.__module__.split(".")[-1] + "." + function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return function(*args, **kwargs)
+
+            with tracer.span(stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -13,5 +13,6 @@ setup(name='Calibration',
       description='A package for calibrating JULES namelist variables',
       author='Cale Baguley',
       url='https://github.com/CaleBaguley/Jules_Namelist_management',
-      packages=packages
+      packages=packages,
+      entry_points={'console_scripts': ['jules-calibrate=Calibration.Calibration.command_line:main']}
       )